@@ -0,0 +1,91 @@
+"""
+Benchmark of decoding the CLIXML stderr of PowerShell commands.
+
+The sample is a stderr as PowerShell writes it for a verbose script: mostly progress records, with an error record
+every 'error_every' records, split into 'documents' concatenated CLIXML documents. The legacy decoder (the whole
+stderr parsed with ET.fromstring) is measured side by side with the streaming ClixmlDecoder, fed in Receive sized
+chunks as the executor does. The peak memory is the growth of the process' max RSS, so each decoder runs in a
+process of its own.
+
+usage: python benchmarks/clixml_decode.py [megabytes] [documents] [error_every]
+"""
+import os
+import re
+import resource
+import sys
+import time
+import xml.etree.ElementTree as ET
+from multiprocessing import Process, Queue
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'package'))
+
+from cloudshell.cm.customscript.domain.clixml_decoder import ClixmlDecoder
+
+RECEIVE_SIZE = 8 * 1024
+HEADER = '#< CLIXML\r\n<Objs Version="1.1.0.1" xmlns="http://schemas.microsoft.com/powershell/2004/04">'
+PROGRESS = '<Obj S="progress" RefId="%d"><TN RefId="0"><T>System.Management.Automation.PSCustomObject</T>' \
+           '<T>System.Object</T></TN><MS><I64 N="SourceId">1</I64><PR N="Record"><AV>Preparing modules for first ' \
+           'use.</AV><AI>0</AI><Nil /><PI>-1</PI><PC>-1</PC><T>Completed</T><SR>-1</SR><SD> </SD></PR></MS></Obj>'
+ERROR = '<S S="Error">Error %d: something failed_x000D__x000A_</S>'
+
+
+def make_stderr(size, documents, error_every):
+    records_per_document = size // len(PROGRESS % 0) // documents
+    parts = []
+    for document in range(documents):
+        parts.append(HEADER)
+        for i in range(records_per_document):
+            parts.append(ERROR % i if i % error_every == error_every - 1 else PROGRESS % i)
+        parts.append('</Objs>')
+    return ''.join(parts)
+
+
+def legacy_decode(text):
+    # the decoding _try_decode_error_xml did before the streaming decoder
+    text = re.sub(re.escape('#< CLIXML'), '', text, 1)
+    root = ET.fromstring(text)
+    text = ''.join([e.text for e in root.findall('*/[@S="Error"]')])
+    return re.sub('_x([0-9a-fA-F]{4})_', lambda match: unichr(int(match.group(1), 16)), text)
+
+
+def streaming_decode(text):
+    decoder = ClixmlDecoder()
+    for offset in range(0, len(text), RECEIVE_SIZE):
+        decoder.feed(text[offset:offset + RECEIVE_SIZE])
+    decoder.close()
+    return decoder.get_text()
+
+
+def measure(decode, size, documents, error_every, results):
+    text = make_stderr(size, documents, error_every)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start_time = time.time()
+    try:
+        decoded = decode(text)
+        error = None
+    except Exception as e:
+        decoded = u''
+        error = str(e)
+    elapsed = time.time() - start_time
+    rss_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+    results.put((elapsed, rss_growth, len(decoded), error))
+
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    documents = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    error_every = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+
+    print('%dMB of stderr in %d document(s), an error every %d records' % (megabytes, documents, error_every))
+    for name, decode in [('ET.fromstring (legacy)', legacy_decode), ('streaming decoder', streaming_decode)]:
+        results = Queue()
+        process = Process(target=measure, args=(decode, megabytes * 1024 * 1024, documents, error_every, results))
+        process.start()
+        elapsed, rss_growth, decoded_size, error = results.get()
+        process.join()
+        print('%-24s %7.2fs, %7.1fMB peak memory growth, %8d characters decoded%s' %
+              (name, elapsed, rss_growth / 1024.0, decoded_size, ' (failed: %s)' % error if error else ''))
+
+
+if __name__ == '__main__':
+    main()
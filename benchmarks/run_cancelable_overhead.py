@@ -0,0 +1,61 @@
+"""
+Micro-benchmark of the per-step overhead of LinuxScriptExecutor._run_cancelable.
+
+Every remote step (mktemp, scp, run, rm) goes through _run_cancelable, the remote command itself is replaced here by
+one which completes after 'command_seconds', so what is measured is the time spent waiting on top of it.
+The legacy loop (sleeping 1 second between polls) is measured side by side with the current event based wait.
+
+usage: python benchmarks/run_cancelable_overhead.py [steps] [command_seconds]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'package'))
+
+from mock import Mock, patch
+
+from cloudshell.cm.customscript.domain.linux_script_executor import LinuxScriptExecutor
+from cloudshell.cm.customscript.domain.script_configuration import HostConfiguration
+
+
+def legacy_run_cancelable(executor, txt, *args):
+    # the loop _run_cancelable used before switching to the event based wait
+    async_result = executor.pool.apply_async(executor._run, kwds={'code': txt % args})
+    while not async_result.ready():
+        if executor.cancel_sampler.is_cancelled():
+            executor.session.close()
+            executor.cancel_sampler.throw()
+        time.sleep(1)
+    return async_result.get()
+
+
+def measure(run_cancelable, executor, steps, command_seconds):
+    overheads = []
+    for i in range(steps):
+        start_time = time.time()
+        run_cancelable(executor, 'true')
+        overheads.append(time.time() - start_time - command_seconds)
+    overheads.sort()
+    return overheads[len(overheads) // 2], overheads[-1]
+
+
+def main():
+    steps = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    command_seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+
+    cancel_sampler = Mock()
+    cancel_sampler.is_cancelled.return_value = False
+    with patch('cloudshell.cm.customscript.domain.linux_script_executor.SSHClient'):
+        executor = LinuxScriptExecutor(Mock(), HostConfiguration(), cancel_sampler)
+    executor._run = lambda code, **kwargs: time.sleep(command_seconds)
+
+    print('%d steps, remote command of %.0fms' % (steps, command_seconds * 1000))
+    for name, run_cancelable in [('sleep polling (legacy)', legacy_run_cancelable),
+                                 ('event based wait', lambda e, txt: e._run_cancelable(txt))]:
+        median, worst = measure(run_cancelable, executor, steps, command_seconds)
+        print('%-24s overhead per step: median %7.1fms, worst %7.1fms' % (name, median * 1000, worst * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Throughput of the linux executor's upload backends, scp against pipelined sftp, for 1KB to 100MB payloads.
+
+Needs a reachable ssh host:
+usage: python benchmarks/scp_vs_sftp_throughput.py <host> <username> <password> [repeats]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'package'))
+
+from mock import Mock
+
+from cloudshell.cm.customscript.domain.linux_script_executor import LinuxScriptExecutor
+from cloudshell.cm.customscript.domain.script_configuration import HostConfiguration
+from cloudshell.cm.customscript.domain.script_file import ScriptFile
+
+SIZES = [1024, 10 * 1024, 100 * 1024, 1024 * 1024, 10 * 1024 * 1024, 100 * 1024 * 1024]
+
+
+def make_payload(size):
+    script_file = ScriptFile('payload.bin')
+    chunk = os.urandom(64 * 1024)
+    while script_file.size < size:
+        script_file.write(chunk[:size - script_file.size])
+    return script_file
+
+
+def measure(executor, tmp_folder, script_file, repeats):
+    timings = []
+    for i in range(repeats):
+        start_time = time.time()
+        executor.copy_script(tmp_folder, script_file)
+        timings.append(time.time() - start_time)
+    return min(timings)
+
+
+def main():
+    if len(sys.argv) < 4:
+        print(__doc__)
+        sys.exit(1)
+    host = HostConfiguration()
+    host.ip, host.username, host.password = sys.argv[1:4]
+    repeats = int(sys.argv[4]) if len(sys.argv) > 4 else 3
+    cancel_sampler = Mock()
+    cancel_sampler.is_cancelled.return_value = False
+
+    executor = LinuxScriptExecutor(Mock(), host, cancel_sampler)
+    executor.connect()
+    tmp_folder = executor.create_temp_folder()
+    try:
+        print('%12s %14s %14s' % ('size', 'scp MB/s', 'sftp MB/s'))
+        for size in SIZES:
+            script_file = make_payload(size)
+            rates = []
+            for transfer_method in ['scp', 'sftp']:
+                host.transfer_method = transfer_method
+                seconds = measure(executor, tmp_folder, script_file, repeats)
+                rates.append(size / seconds / 1024 / 1024)
+            script_file.close()
+            print('%12d %14.2f %14.2f' % (size, rates[0], rates[1]))
+    finally:
+        executor.delete_temp_folder(tmp_folder)
+        executor.close()
+
+
+if __name__ == '__main__':
+    main()
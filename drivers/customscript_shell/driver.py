@@ -4,7 +4,7 @@ from cloudshell.cm.customscript.customscript_shell import CustomScriptShell
 
 class CustomScriptShellDriver(ResourceDriverInterface):
     def cleanup(self):
-        pass
+        self.customscript_shell.cleanup()
 
     def __init__(self):
         self.customscript_shell = CustomScriptShell()
@@ -15,4 +15,5 @@ class CustomScriptShellDriver(ResourceDriverInterface):
     def execute_script(self, context, script_configuration_json, cancellation_context):
         return self.customscript_shell.execute_script(context, script_configuration_json, cancellation_context)
 
-
+    def prefetch_scripts(self, context, script_configurations_json, cancellation_context):
+        return self.customscript_shell.prefetch_scripts(context, script_configurations_json, cancellation_context)
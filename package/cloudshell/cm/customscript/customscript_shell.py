@@ -1,5 +1,6 @@
 import json
 import os
+from multiprocessing.pool import ThreadPool
 
 import errno
 
@@ -10,20 +11,48 @@ from cloudshell.shell.core.session.cloudshell_session import CloudShellSessionCo
 from cloudshell.shell.core.session.logging_session import LoggingSessionContext
 
 from cloudshell.cm.customscript.domain.cancellation_sampler import CancellationSampler
+from cloudshell.cm.customscript.domain.connection_pool import ConnectionPool
+from cloudshell.cm.customscript.domain.download_policy import MirrorLatencyTracker
+from cloudshell.cm.customscript.domain.http_session_pool import HttpSessionPool
+from cloudshell.cm.customscript.domain.linux_script_executor import LinuxScriptExecutor
+from cloudshell.cm.customscript.domain.port_probe import PortProbe
 from cloudshell.cm.customscript.domain.reservation_output_writer import ReservationOutputWriter
 from cloudshell.cm.customscript.domain.sandbox_reporter import SandboxReporter
+from cloudshell.cm.customscript.domain.script_cache import ScriptCache
 from cloudshell.cm.customscript.domain.script_configuration import ScriptConfigurationParser, ScriptRepository, \
     HostConfiguration, ScriptConfiguration
 from cloudshell.cm.customscript.domain.script_downloader import ScriptDownloader, HttpAuth
 from cloudshell.cm.customscript.domain.script_executor import IScriptExecutor, ExcutorConnectionError
 from cloudshell.cm.customscript.domain.script_executor_selector import ScriptExecutorSelector
 from cloudshell.cm.customscript.domain.script_file import ScriptFile
+from cloudshell.cm.customscript.domain.windows_script_executor import WindowsScriptExecutor
+from cloudshell.cm.customscript.domain.worker_pool import WorkerPool
 
 
 class CustomScriptShell(object):
+    PREFETCH_PARALLELISM = 8
+    # the most threads which run remote commands and uploads at once, for all the executions of the process
+    MAX_WORKERS = 64
+    SHUTDOWN_TIMEOUT_SECONDS = 30
+    CONNECT_INITIAL_INTERVAL_SECONDS = 1
+    CONNECT_MAX_INTERVAL_SECONDS = 10
 
     def __init__(self):
-        pass
+        self.script_cache = ScriptCache()
+        self.http_session_pool = HttpSessionPool()
+        self.mirror_latency_tracker = MirrorLatencyTracker()
+        self.ssh_connection_pool = ConnectionPool(is_alive=LinuxScriptExecutor.is_session_alive, name='ssh-pool')
+        # http.sys drops idle keep-alive connections after 2 minutes
+        self.winrm_session_pool = ConnectionPool(is_alive=WindowsScriptExecutor.is_session_alive, idle_ttl_seconds=120,
+                                                 name='winrm-pool',
+                                                 close_connection=WindowsScriptExecutor.close_session)
+        self.worker_pool = WorkerPool(max_workers=CustomScriptShell.MAX_WORKERS)
+
+    def cleanup(self):
+        self.http_session_pool.close()
+        self.ssh_connection_pool.close()
+        self.winrm_session_pool.close()
+        self.worker_pool.shutdown(timeout=CustomScriptShell.SHUTDOWN_TIMEOUT_SECONDS)
 
     def execute_script(self, command_context, script_conf_json, cancellation_context):
         """
@@ -46,22 +75,85 @@ class CustomScriptShell(object):
                     reporter.debug_out(script_conf.get_pretty_json(), log_only=True)
                     host_ip = script_conf.host_conf.ip
 
-                    script_file = ScriptDownloader(script_conf, reporter, cancel_sampler).download()
-                    service = ScriptExecutorSelector.get(script_conf.host_conf, logger, cancel_sampler)
-                    self._warn_for_unexpected_file_type(script_conf.host_conf, service, script_file, output_writer)
+                    script_file = ScriptDownloader(script_conf, reporter, cancel_sampler, self.script_cache,
+                                                   self.http_session_pool, self.mirror_latency_tracker).download()
+                    try:
+                        service = ScriptExecutorSelector.get(script_conf.host_conf, logger, cancel_sampler,
+                                                             self.ssh_connection_pool, self.worker_pool, reporter,
+                                                             self.winrm_session_pool)
+                        logger.debug(self.worker_pool.get_stats_message())
+                        self._warn_for_unexpected_file_type(script_conf.host_conf, service, script_file, output_writer)
+
+                        reporter.info_out('Connecting to host {}...'.format(host_ip))
+                        try:
+                            self._connect(service, cancel_sampler, script_conf.timeout_minutes, reporter)
+                        except Exception as e:
+                            exc_msg = "Error connecting to host '{}': {}".format(host_ip, str(e))
+                            reporter.exc_out(exc_msg)
+                            raise Exception(exc_msg)
+                        reporter.info_out('Successfully connected to host: {}.'.format(host_ip))
+
+                        try:
+                            reporter.info_out("Running script on host '{}'...".format(host_ip))
+                            service.execute(script_file, script_conf.host_conf.parameters, output_writer, script_conf.print_output)
+                            reporter.warn_out("Script done running on host '{}'".format(host_ip))
+                        finally:
+                            service.close()
+                    finally:
+                        script_file.close()
+
+    def prefetch_scripts(self, command_context, script_confs_json, cancellation_context):
+        """
+        Downloads and validates the scripts of the given configurations in parallel, so they are already in the
+        script cache when 'execute_script' is called.
+        :type command_context: ResourceCommandContext
+        :type script_confs_json: str
+        :type cancellation_context: CancellationContext
+        :rtype str
+        """
+        with LoggingSessionContext(command_context) as logger:
+            logger.debug('\'prefetch_scripts\' is called with the configurations json: \n' + script_confs_json)
 
-                    reporter.info_out('Connecting to host {}...'.format(host_ip))
+            with ErrorHandlingContext(logger):
+                with CloudShellSessionContext(command_context) as api:
+                    reporter = SandboxReporter(api, command_context.reservation.reservation_id, logger)
+                    cancel_sampler = CancellationSampler(cancellation_context)
+                    script_confs = ScriptConfigurationParser(api).json_to_prefetch_objects(script_confs_json)
+
+                    reporter.info_out('Prefetching {} scripts...'.format(len(script_confs)))
+                    pool = ThreadPool(processes=min(len(script_confs), CustomScriptShell.PREFETCH_PARALLELISM))
                     try:
-                        self._connect(service, cancel_sampler, script_conf.timeout_minutes)
-                    except Exception as e:
-                        exc_msg = "Error connecting to host '{}': {}".format(host_ip, str(e))
-                        reporter.exc_out(exc_msg)
-                        raise Exception(exc_msg)
-                    reporter.info_out('Successfully connected to host: {}.'.format(host_ip))
+                        errors = pool.map(lambda conf: self._prefetch(conf, reporter, cancel_sampler), script_confs)
+                    finally:
+                        pool.close()
+                        pool.join()
+                    cancel_sampler.throw_if_canceled()
 
-                    reporter.info_out("Running script on host '{}'...".format(host_ip))
-                    service.execute(script_file, script_conf.host_conf.parameters, output_writer, script_conf.print_output)
-                    reporter.warn_out("Script done running on host '{}'".format(host_ip))
+                    failures = [(conf.script_repo.url, error) for conf, error in zip(script_confs, errors) if error]
+                    for url, error in failures:
+                        reporter.err_out("Failed to prefetch '{}': {}".format(url, error))
+                    summary = 'Prefetched {} of {} scripts.'.format(len(script_confs) - len(failures), len(script_confs))
+                    reporter.info_out(summary)
+                    return summary
+
+    def _prefetch(self, script_conf, reporter, cancel_sampler):
+        """
+        :type script_conf: ScriptConfiguration
+        :type reporter: SandboxReporter
+        :type cancel_sampler: CancellationSampler
+        :return: the error message, or None on success
+        :rtype str
+        """
+        script_conf.stream_transfer = False
+        script_conf.script_repo.bypass_cache = False
+        try:
+            script_file = ScriptDownloader(script_conf, reporter, cancel_sampler, self.script_cache,
+                                           self.http_session_pool, self.mirror_latency_tracker).download()
+            script_file.close()
+            return None
+        except Exception as e:
+            reporter.exc_out("Failed to prefetch '{}'".format(script_conf.script_repo.url), log_only=True)
+            return str(e) or type(e).__name__
 
     def _warn_for_unexpected_file_type(self, target_host, service, script_file, output_writer):
         """
@@ -74,10 +166,15 @@ class CustomScriptShell(object):
         if not file_ext in service.get_expected_file_extensions():
             output_writer.write_warning('Trying to run "%s" file via %s on host %s' % (file_ext, target_host.connection_method, target_host.ip))
 
-    def _connect(self, executor, cancel_sampler, timeout_minutes):
+    def _connect(self, executor, cancel_sampler, timeout_minutes, reporter=None):
         """
+        Waits for the connection port of the host to accept tcp connections (a cheap probe), and only then connects
+        and authenticates, retrying at an interval which grows from CONNECT_INITIAL_INTERVAL_SECONDS to
+        CONNECT_MAX_INTERVAL_SECONDS.
         :type executor: IScriptExecutor
         :type cancel_sampler: CancellationSampler
+        :type timeout_minutes: float
+        :type reporter: SandboxReporter
         """
         # 10060  ETIMEDOUT                      Operation timed out
         # 10061  ECONNREFUSED                   Connection refused (happense when host found, port not)
@@ -88,10 +185,22 @@ class CustomScriptShell(object):
         # 111    ERROR_SSH_APPLICATION_CLOSED   User on the other side of connection closed application that led to disconnection
         # 110    ERROR_SSH_CONNECTION_LOST      Connection was lost by some reason
         valid_errnos = [10060, 10061, 10064, 10065, 500, 113, 111, 110]
-        interval_seconds = 10
+        interval_seconds = CustomScriptShell.CONNECT_INITIAL_INTERVAL_SECONDS
         start_time = time.time()
+
+        address = executor.get_connection_address()
+        if address:
+            probe = PortProbe(address[0], address[1], cancel_sampler)
+            if not probe.wait_until_open(timeout_minutes*60):
+                raise Exception(probe.get_error_message())
+            if reporter:
+                reporter.info_out('Port {} on host {} is open (after {} probes, {:.1f} seconds).'.format(
+                    probe.port, probe.ip, probe.attempts, probe.time_to_open))
+
+        attempts = 0
         while True:
             cancel_sampler.throw_if_canceled()
+            attempts += 1
             try:
                 executor.connect()
                 break
@@ -101,6 +210,10 @@ class CustomScriptShell(object):
                 if time.time() - start_time >= timeout_minutes*60:
                     raise e.inner_error
                 time.sleep(interval_seconds)
+                interval_seconds = min(interval_seconds * 2, CustomScriptShell.CONNECT_MAX_INTERVAL_SECONDS)
+        if reporter:
+            reporter.info_out('Authenticated after {} attempts ({:.1f} seconds).'.format(
+                attempts, time.time() - start_time), log_only=True)
 
 # conf = '''{
 # 	"repositoryDetails": {
@@ -0,0 +1,217 @@
+import re
+from collections import deque
+from logging import Logger
+from xml.parsers import expat
+
+ESCAPE_PATTERN = re.compile(r'_x([0-9a-fA-F]{4})_')
+
+
+def _unescape(match):
+    return unichr(int(match.group(1), 16))
+
+
+class _DocumentEnd(Exception):
+    """
+    Stops the parser at the end of the <Objs> element, the text which follows it is not part of the document.
+    """
+
+
+class _ErrorRecordsHandlers(object):
+    """
+    Expat handlers which pass the text of each Error record of an <Objs> document to 'on_record', and drop
+    everything else. 'on_end' is called at the end of the <Objs> element.
+    """
+    def __init__(self, parser, on_record, on_end):
+        """
+        :type parser: expat.XMLParserType
+        """
+        self.parser = parser
+        self.on_record = on_record
+        self.on_end = on_end
+        self._depth = 0
+        self._record = None
+        parser.StartElementHandler = self.start
+        parser.EndElementHandler = self.end
+
+    def start(self, tag, attrib):
+        self._depth += 1
+        # the records are the children of <Objs>, errors are strings with an 'S' attribute of 'Error'
+        # (the names are not resolved against their namespaces, which expat does at a high cost)
+        if self._depth == 2 and attrib.get('S') == 'Error' and (tag == 'S' or tag.endswith(':S')):
+            self._record = []
+            # the text of any other element is not even passed to python
+            self.parser.CharacterDataHandler = self._record.append
+
+    def end(self, tag):
+        if self._depth == 2 and self._record is not None:
+            self.parser.CharacterDataHandler = None
+            self.on_record(u''.join(self._record))
+            self._record = None
+        self._depth -= 1
+        if self._depth == 0:
+            self.on_end()
+
+
+class ClixmlDecoder(object):
+    """
+    Incremental decoder of the CLIXML which PowerShell writes to stderr ('#< CLIXML' followed by an <Objs> document).
+    The stream is fed as it arrives, each document is parsed as a stream of tags, and only the text of the Error
+    records is kept, so progress and verbose records cost no memory. A stream may hold several documents, one after
+    the other (e.g. one per PowerShell process), and plain text outside of them is kept as is.
+    The last 'max_size' characters of the decoded text are kept.
+    """
+    MARKER = '#< CLIXML'
+    DEFAULT_MAX_SIZE = 1024 * 1024
+
+    def __init__(self, max_size=None, logger=None):
+        """
+        :param int max_size: the most characters of decoded text to keep, DEFAULT_MAX_SIZE when not given
+        :type logger: Logger
+        """
+        self.max_size = max_size or ClixmlDecoder.DEFAULT_MAX_SIZE
+        self.logger = logger
+        self.documents = 0
+        self.records = 0
+        self.size = 0
+        self._chunks = deque()
+        self._buffered_size = 0
+        self._pending = ''
+        self._parser = None
+        self._parsed_size = 0
+        self._end_tag_index = None
+        self._failed = False
+
+    def feed(self, data):
+        """
+        :type data: str
+        """
+        if not data:
+            return
+        data = self._pending + data
+        self._pending = ''
+        while data:
+            index = data.find(ClixmlDecoder.MARKER)
+            if index < 0:
+                # the marker may be split between this chunk and the next one
+                keep = self._get_partial_marker_length(data)
+                self._feed_document(data[:len(data) - keep])
+                self._pending = data[len(data) - keep:]
+                return
+            self._feed_document(data[:index])
+            self._start_document()
+            data = data[index + len(ClixmlDecoder.MARKER):]
+
+    def close(self):
+        """
+        Ends the last document.
+        """
+        pending, self._pending = self._pending, ''
+        self._feed_document(pending)
+        self._end_document()
+
+    def get_text(self):
+        """
+        The decoded text, with a note in front when its beginning was cut off.
+        :rtype str
+        """
+        text = u''.join(self._chunks)
+        if len(text) < self.size:
+            return u'[... %d characters of stderr truncated ...]\n%s' % (self.size - len(text), text)
+        return text
+
+    def _add_record(self, text):
+        self.records += 1
+        self._append(ESCAPE_PATTERN.sub(_unescape, text) if '_x' in text else text)
+
+    def _start_document(self):
+        self._end_document()
+        self.documents += 1
+        self._parser = expat.ParserCreate()
+        self._parser.buffer_text = True
+        _ErrorRecordsHandlers(self._parser, self._add_record, self._on_document_end)
+        self._parsed_size = 0
+        self._end_tag_index = None
+        self._failed = False
+
+    def _end_document(self):
+        if self._parser and not self._failed:
+            try:
+                self._parser.Parse('', True)
+            except expat.ExpatError as e:
+                self._log_failure(e)
+        self._parser = None
+
+    def _feed_document(self, text):
+        if not text:
+            return
+        if self._parser is None or self._failed:
+            # plain text outside of the documents, or the rest of a document which could not be parsed
+            self._append(text)
+            return
+        try:
+            self._parser.Parse(text, False)
+            self._parsed_size += len(text)
+        except _DocumentEnd:
+            # the end tag may have started in an earlier chunk, it ends in this one
+            start = max(self._end_tag_index - self._parsed_size, 0)
+            self._parser = None
+            self._feed_document(text[text.index('>', start) + 1:])
+        except expat.ExpatError as e:
+            self._failed = True
+            self._log_failure(e)
+            # the records before the error were already decoded, only the rest of the text is kept as is
+            self._append(text[max(self._parser.ErrorByteIndex - self._parsed_size, 0):])
+
+    def _on_document_end(self):
+        self._end_tag_index = self._parser.CurrentByteIndex
+        raise _DocumentEnd()
+
+    def _log_failure(self, error):
+        if self.logger:
+            self.logger.warning('Failed to decode CLIXML document %s of stderr, kept the rest of it as is. Error: %s' %
+                                (self.documents, error))
+
+    def _append(self, text):
+        self.size += len(text)
+        self._chunks.append(text)
+        self._buffered_size += len(text)
+        while self._buffered_size > self.max_size:
+            excess = self._buffered_size - self.max_size
+            first = self._chunks[0]
+            if len(first) <= excess:
+                self._chunks.popleft()
+                self._buffered_size -= len(first)
+            else:
+                self._chunks[0] = first[excess:]
+                self._buffered_size -= excess
+
+    @staticmethod
+    def _get_partial_marker_length(data):
+        """
+        The length of the longest end of 'data' which is a beginning of the marker.
+        :type data: str
+        :rtype int
+        """
+        tail = data[-(len(ClixmlDecoder.MARKER) - 1):]
+        index = tail.find('#')
+        while index >= 0:
+            if ClixmlDecoder.MARKER.startswith(tail[index:]):
+                return len(tail) - index
+            index = tail.find('#', index + 1)
+        return 0
+
+
+def decode_clixml(text, logger=None, max_size=None):
+    """
+    Decodes a whole stderr, which is returned as is when it has no CLIXML.
+    :type text: str
+    :type logger: Logger
+    :type max_size: int
+    :rtype str
+    """
+    if not text:
+        return text
+    decoder = ClixmlDecoder(max_size, logger)
+    decoder.feed(text)
+    decoder.close()
+    return decoder.get_text() if decoder.documents else text
@@ -0,0 +1,238 @@
+import atexit
+import hashlib
+import weakref
+from threading import Condition, Event, Thread, current_thread
+
+import time
+
+_open_pools = weakref.WeakSet()
+
+
+class ConnectionPoolFullError(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    """
+    Process-wide pool of authenticated connections (any object with a 'close' method, or one which 'close_connection'
+    closes), keyed by their target and credentials. A connection is used by one executor at a time: it is acquired
+    for an execution, and released back to the pool when the execution is done. Released connections which stay idle
+    for 'idle_ttl_seconds' are closed, and at most 'max_connections' idle connections are kept (the least recently
+    used are closed first).
+    At most 'max_connections_per_key' connections of a key are open at once, idle or in use; an execution which needs
+    another one waits up to 'acquire_timeout_seconds' for a connection of its key to be released.
+    """
+    WAIT_INTERVAL_SECONDS = 1
+
+    def __init__(self, is_alive=None, idle_ttl_seconds=300, max_connections=16, name='connection-pool',
+                 close_connection=None, max_connections_per_key=8, acquire_timeout_seconds=300):
+        """
+        :param is_alive: liveness check, called with a pooled connection before it is reused
+        :type idle_ttl_seconds: float
+        :param int max_connections: the most idle connections, of all the keys
+        :type name: str
+        :param close_connection: closes a connection, its 'close' method when not given
+        :param int max_connections_per_key: the most open connections of a key, idle or in use
+        :type acquire_timeout_seconds: float
+        """
+        self.is_alive = is_alive or (lambda connection: True)
+        self.close_connection = close_connection or (lambda connection: connection.close())
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.max_connections = max_connections
+        self.max_connections_per_key = max_connections_per_key
+        self.acquire_timeout_seconds = acquire_timeout_seconds
+        self.name = name
+        self.created = 0
+        self.reused = 0
+        self.evicted = 0
+        self.waited = 0
+        self._idle = []  # (key, connection, release time), the most recently released is last
+        self._in_use = {}  # key -> the number of acquired connections (and of the ones being created)
+        self._lock = Condition()
+        self._closed = Event()
+        self._janitor = None
+
+    @staticmethod
+    def get_credentials_fingerprint(*credentials):
+        """
+        Identifies the credentials in a pool key without keeping them in it.
+        :rtype str
+        """
+        return hashlib.sha256('\0'.join([(c or '').encode('utf-8') if isinstance(c, unicode) else (c or '')
+                                         for c in credentials])).hexdigest()
+
+    def acquire(self, key, create, cancel_sampler=None):
+        """
+        Returns a live idle connection of the given key, or a new one made by 'create'. The connection is given back
+        with 'release' (or 'discard').
+        :type key: tuple
+        :param create: makes (and authenticates) a new connection, called when there is no idle one
+        :param CancellationSampler cancel_sampler: sampled while waiting for a connection of a full key
+        """
+        end_time = time.time() + self.acquire_timeout_seconds
+        waited = False
+        while True:
+            with self._lock:
+                expired = self._pop_expired()
+                candidate = self._pop_idle(key)
+                full = candidate is None and self._in_use.get(key, 0) >= self.max_connections_per_key
+                if full:
+                    self.waited += 0 if waited else 1
+                    waited = True
+                    self._wait_for_release(end_time, cancel_sampler)
+                else:
+                    # the place of the candidate, or of the connection which is about to be created
+                    self._in_use[key] = self._in_use.get(key, 0) + 1
+            self._close_all(expired)
+            if full:
+                continue
+            if candidate is None:
+                break
+            if self._is_alive(candidate):
+                with self._lock:
+                    self.reused += 1
+                return candidate
+            self.discard(key, candidate)
+
+        try:
+            connection = create()
+        except:
+            self._free(key)
+            raise
+        with self._lock:
+            self.created += 1
+        return connection
+
+    def release(self, key, connection):
+        """
+        Returns a connection to the pool, a dead connection is closed instead.
+        :type key: tuple
+        """
+        if self._closed.is_set() or not self._is_alive(connection):
+            self.discard(key, connection)
+            return
+        with self._lock:
+            self._decrement_in_use(key)
+            self._idle.append((key, connection, time.time()))
+            self._lock.notify_all()
+            overflow = self._idle[:max(0, len(self._idle) - self.max_connections)]
+            del self._idle[:len(overflow)]
+            self.evicted += len(overflow)
+            expired = self._pop_expired()
+            self._start_janitor()
+        self._close_all([c for k, c, t in overflow] + expired)
+
+    def discard(self, key, connection):
+        """
+        Closes an acquired connection which should not be reused (e.g. it failed), its key may open another one.
+        :type key: tuple
+        """
+        self._close_all([connection])
+        self._free(key)
+
+    def evict_idle(self):
+        """
+        Closes the idle connections which passed their ttl.
+        """
+        with self._lock:
+            expired = self._pop_expired()
+        self._close_all(expired)
+
+    def get_idle_count(self):
+        """
+        :rtype int
+        """
+        with self._lock:
+            return len(self._idle)
+
+    def get_stats_message(self):
+        """
+        :rtype str
+        """
+        with self._lock:
+            return '{}: {} idle, {} in use, {} created, {} reused, {} evicted, {} waited'.format(
+                self.name, len(self._idle), sum(self._in_use.itervalues()), self.created, self.reused, self.evicted,
+                self.waited)
+
+    def close(self):
+        """
+        Stops the janitor and closes all the idle connections, connections which are released later are closed right
+        away.
+        """
+        self._closed.set()
+        with self._lock:
+            idle = [c for k, c, t in self._idle]
+            self._idle = []
+            janitor = self._janitor
+            self._lock.notify_all()
+        if janitor is not None and janitor is not current_thread():
+            janitor.join()
+        self._close_all(idle)
+
+    def _pop_idle(self, key):
+        for i in range(len(self._idle) - 1, -1, -1):
+            if self._idle[i][0] == key:
+                return self._idle.pop(i)[1]
+        return None
+
+    def _wait_for_release(self, end_time, cancel_sampler):
+        """
+        Waits a while for a connection to be released, called with the lock.
+        """
+        if cancel_sampler:
+            cancel_sampler.throw_if_canceled()
+        remaining = end_time - time.time()
+        if remaining <= 0 or self._closed.is_set():
+            raise ConnectionPoolFullError('All the %s connections of %s to the host are in use' %
+                                          (self.max_connections_per_key, self.name))
+        self._lock.wait(min(remaining, ConnectionPool.WAIT_INTERVAL_SECONDS))
+
+    def _free(self, key):
+        with self._lock:
+            self._decrement_in_use(key)
+            self._lock.notify_all()
+
+    def _decrement_in_use(self, key):
+        count = self._in_use.get(key, 0) - 1
+        if count > 0:
+            self._in_use[key] = count
+        else:
+            self._in_use.pop(key, None)
+
+    def _pop_expired(self):
+        expire_time = time.time() - self.idle_ttl_seconds
+        expired = [c for k, c, t in self._idle if t <= expire_time]
+        self._idle = [(k, c, t) for k, c, t in self._idle if t > expire_time]
+        self.evicted += len(expired)
+        return expired
+
+    def _start_janitor(self):
+        if self._janitor is None:
+            self._janitor = Thread(target=self._evict_periodically, name=self.name + '-janitor')
+            self._janitor.daemon = True
+            self._janitor.start()
+            # a janitor which still runs while the interpreter tears down its modules fails there
+            _open_pools.add(self)
+
+    def _evict_periodically(self):
+        while not self._closed.wait(max(self.idle_ttl_seconds / 2.0, 1)):
+            self.evict_idle()
+
+    def _is_alive(self, connection):
+        try:
+            return bool(self.is_alive(connection))
+        except Exception:
+            return False
+
+    def _close_all(self, connections):
+        for connection in connections:
+            try:
+                self.close_connection(connection)
+            except Exception:
+                pass
+
+
+@atexit.register
+def _close_open_pools():
+    for pool in list(_open_pools):
+        pool.close()
@@ -0,0 +1,85 @@
+import random
+from threading import Lock
+
+
+class RetryPolicy(object):
+    """
+    Exponential backoff with jitter between download attempts.
+    """
+    def __init__(self, attempts=3, base_delay=1.0, max_delay=30.0, jitter=0.5):
+        """
+        :type attempts: int
+        :type base_delay: float
+        :type max_delay: float
+        :param float jitter: the fraction of the delay which is randomized (0 - no jitter, 1 - between 0 and delay)
+        """
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def get_delay(self, attempt):
+        """
+        :param int attempt: zero based number of the attempt which just failed
+        :rtype float
+        """
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        return random.uniform(delay * (1 - self.jitter), delay)
+
+
+class MirrorLatencyTracker(object):
+    """
+    Keeps a smoothed time-to-headers per mirror url, so the fastest mirror is tried first.
+    """
+    SMOOTHING = 0.3
+    FAILURE_PENALTY_SECONDS = 60.0
+
+    def __init__(self):
+        self._latencies = {}
+        self._lock = Lock()
+
+    def record(self, url, seconds):
+        """
+        :type url: str
+        :type seconds: float
+        """
+        with self._lock:
+            latency = self._latencies.get(url)
+            if latency is None:
+                self._latencies[url] = seconds
+            else:
+                self._latencies[url] = latency + MirrorLatencyTracker.SMOOTHING * (seconds - latency)
+
+    def record_failure(self, url):
+        """
+        :type url: str
+        """
+        self.record(url, MirrorLatencyTracker.FAILURE_PENALTY_SECONDS)
+
+    def get_latency(self, url):
+        """
+        :type url: str
+        :rtype float
+        """
+        with self._lock:
+            return self._latencies.get(url)
+
+    def order(self, urls):
+        """
+        Mirrors with a known latency come first (fastest first), the rest keep their configured order.
+        :type urls: list[str]
+        :rtype list[str]
+        """
+        with self._lock:
+            indexed = list(enumerate(urls))
+            known = sorted([(i, u) for i, u in indexed if u in self._latencies], key=lambda x: self._latencies[x[1]])
+            unknown = [(i, u) for i, u in indexed if u not in self._latencies]
+            return [u for i, u in known + unknown]
+
+    def get_stats_message(self):
+        """
+        :rtype str
+        """
+        with self._lock:
+            return 'Mirror latencies: ' + ', '.join(['%s=%.0fms' % (url, latency * 1000)
+                                                     for url, latency in sorted(self._latencies.iteritems())])
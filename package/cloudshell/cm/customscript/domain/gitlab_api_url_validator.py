@@ -25,6 +25,30 @@ def is_gitlab_rest_url(url):
     return True
 
 
+def is_gitlab_archive_url(url):
+    """"
+    should be of the following form (the format suffix and the query parameters are optional):
+    http://192.168.85.62/api/{api_version}/projects/{project_id}/repository/archive.tar.gz?sha={ref}&path={sub folder}
+    ex input - http://192.168.85.62/api/v4/projects/4/repository/archive.zip?sha=master&path=scripts
+    :param str url: the user input url
+    """
+    EXAMPLE = "http://<SERVER_IP>/api/4/projects/<PROJECT_ID>/repository/archive.tar.gz?sha=<GIT_BRANCH>&path=<SUB_FOLDER>"
+
+    # DETERMINE INTENT TO USE GITLAB ARCHIVE
+    initial_pattern_check = "api/v\d/projects/[^/]+/repository/archive"
+    matching = re.search(initial_pattern_check, url)
+    if not matching:
+        return False
+
+    # VALIDATE ENTIRE GITLAB URL STRING
+    gitlab_api_pattern = "https?://.+/api/v\d/projects/[^/]+/repository/archive(\.(tar\.gz|tgz|tar|zip))?(\?.*)?$"
+    matching = re.match(gitlab_api_pattern, url)
+    if not matching:
+        raise Exception("Gitlab archive URL failed validation. Should be of form: {}".format(EXAMPLE))
+
+    return True
+
+
 if __name__ == "__main__":
     input_url = "http://192.168.85.62/api/v4/projects/43/repository/files/hello_world.sh/raw?ref=master"
     is_gitlab = is_gitlab_rest_url(input_url)
@@ -0,0 +1,94 @@
+from cookielib import DefaultCookiePolicy
+from threading import Lock
+from urlparse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class HttpSessionPool(object):
+    """
+    Process wide registry of http sessions, one per repo origin (scheme://host:port).
+    Sessions keep their connections alive, so consecutive and concurrent downloads from the same repo reuse
+    connections instead of paying a new tcp + tls handshake for every script.
+    A session serves all the executions and all the repo credentials of its origin, so it keeps no cookies: a cookie
+    set for one user's request would be sent on the requests of the others.
+    """
+    DEFAULT_POOL_CONNECTIONS = 10
+    DEFAULT_POOL_MAXSIZE = 10
+
+    def __init__(self, pool_connections=DEFAULT_POOL_CONNECTIONS, pool_maxsize=DEFAULT_POOL_MAXSIZE, keep_alive=True):
+        """
+        :type pool_connections: int
+        :type pool_maxsize: int
+        :type keep_alive: bool
+        """
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.keep_alive = keep_alive
+        self._sessions = {}
+        self._lock = Lock()
+
+    @staticmethod
+    def get_origin(url):
+        """
+        :type url: str
+        :rtype str
+        """
+        parsed = urlparse(url)
+        return '%s://%s' % (parsed.scheme.lower(), parsed.netloc.lower())
+
+    def get_session(self, url):
+        """
+        :type url: str
+        :rtype requests.Session
+        """
+        origin = HttpSessionPool.get_origin(url)
+        with self._lock:
+            session = self._sessions.get(origin)
+            if not session:
+                session = self._create_session()
+                self._sessions[origin] = session
+            return session
+
+    def get_stats(self):
+        """
+        :rtype dict
+        """
+        stats = {'origins': 0, 'requests': 0, 'connections': 0}
+        with self._lock:
+            stats['origins'] = len(self._sessions)
+            for session in self._sessions.itervalues():
+                for adapter in set(session.adapters.itervalues()):
+                    pools = adapter.poolmanager.pools
+                    for key in pools.keys():
+                        pool = pools.get(key)
+                        if pool:
+                            stats['requests'] += pool.num_requests
+                            stats['connections'] += pool.num_connections
+        stats['reused'] = max(stats['requests'] - stats['connections'], 0)
+        return stats
+
+    def get_stats_message(self):
+        """
+        :rtype str
+        """
+        stats = self.get_stats()
+        return 'Http session pool stats: %s origins, %s requests, %s connections opened, %s requests on reused connections.' % (
+            stats['origins'], stats['requests'], stats['connections'], stats['reused'])
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.itervalues():
+                session.close()
+            self._sessions.clear()
+
+    def _create_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        if not self.keep_alive:
+            session.headers['Connection'] = 'close'
+        return session
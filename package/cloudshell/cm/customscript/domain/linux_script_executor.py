@@ -1,24 +1,37 @@
 import os
+import posixpath
 import socket
 import sys
-from StringIO import StringIO
-from multiprocessing.pool import ThreadPool
-from threading import Thread
+from threading import Thread, Event
 
-import time
-from paramiko import SSHClient, AutoAddPolicy, RSAKey
+from paramiko import SSHClient, AutoAddPolicy, SSHException
+from paramiko.sftp import SFTPError
+from paramiko.sftp_file import SFTPFile
 from paramiko.ssh_exception import NoValidConnectionsError
 from scpclient import Write, SCPError
 
 from cloudshell.cm.customscript.domain.cancellation_sampler import CancellationSampler
-from cloudshell.cm.customscript.domain.reservation_output_writer import ReservationOutputWriter
+from cloudshell.cm.customscript.domain.connection_pool import ConnectionPool
+from cloudshell.cm.customscript.domain.output_capture import OutputCapture, write_captured_output, get_artifact_prefix
+from cloudshell.cm.customscript.domain.private_key_loader import PrivateKeyLoader
+from cloudshell.cm.customscript.domain.reservation_output_writer import ReservationOutputWriter, BatchedOutputWriter
+from cloudshell.cm.customscript.domain.script_bundle import ScriptBundle, BundleFormat
 from cloudshell.cm.customscript.domain.script_configuration import HostConfiguration
 from cloudshell.cm.customscript.domain.script_executor import IScriptExecutor, ErrorMsg, ExcutorConnectionError
 from cloudshell.cm.customscript.domain.script_file import ScriptFile
+from cloudshell.cm.customscript.domain.worker_pool import WorkerPool
 
 
 class LinuxScriptExecutor(IScriptExecutor):
     PasswordEnvVarName = 'cs_machine_pass'
+    ENV_FILE_NAME = '.customscript_env'
+    SSH_PORT = 22
+    RECV_CHUNK_SIZE = 32 * 1024
+    SCRIPT_FILE_MODE = 0o601
+    SFTP_REQUEST_SIZE = SFTPFile.MAX_REQUEST_SIZE
+    PROGRESS_MIN_FILE_SIZE = 1024 * 1024
+    PROGRESS_STEP_PERCENT = 10
+    CANCEL_POLL_INTERVAL_SECONDS = 0.2
 
     class ExecutionResult(object):
         def __init__(self, exit_code, std_out, std_err):
@@ -26,26 +39,76 @@ class LinuxScriptExecutor(IScriptExecutor):
             self.std_out = std_out
             self.success = exit_code == 0
 
-    def __init__(self, logger, target_host, cancel_sampler):
+    def __init__(self, logger, target_host, cancel_sampler, connection_pool=None, worker_pool=None, reporter=None,
+                 key_loader=None):
         """
         :type logger: Logger
         :type target_host: HostConfiguration
         :type cancel_sampler: CancellationSampler
+        :param ConnectionPool connection_pool: authenticated ssh sessions shared across executions
+        :param WorkerPool worker_pool: runs the remote commands, the shared pool when not given
+        :param SandboxReporter reporter: reports the upload progress of big files
+        :param PrivateKeyLoader key_loader: parses (and caches) the access key, the shared loader when not given
         """
         self.logger = logger
+        self.reporter = reporter
+        self._sftp_available = None
         self.cancel_sampler = cancel_sampler
-        self.pool = ThreadPool(processes=1)
+        self.connection_pool = connection_pool
+        self.pool = worker_pool or WorkerPool.shared()
+        self.key_loader = key_loader or PrivateKeyLoader.shared()
         self.session = SSHClient()
         self.session.set_missing_host_key_policy(AutoAddPolicy())
         self.target_host = target_host
 
+    @staticmethod
+    def is_session_alive(session):
+        """
+        Liveness check of a pooled session, an ignore message fails fast on a dropped connection.
+        :type session: SSHClient
+        :rtype bool
+        """
+        transport = session.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        transport.send_ignore()
+        return True
+
+    def get_pool_key(self):
+        """
+        :rtype tuple
+        """
+        return (self.target_host.ip, LinuxScriptExecutor.SSH_PORT, self.target_host.username,
+                ConnectionPool.get_credentials_fingerprint(self.target_host.password, self.target_host.access_key))
+
+    def get_connection_address(self):
+        """
+        :rtype tuple
+        """
+        return self.target_host.ip, LinuxScriptExecutor.SSH_PORT
+
     def connect(self):
+        if self.connection_pool:
+            self.session = self.connection_pool.acquire(self.get_pool_key(), self._connect_session, self.cancel_sampler)
+            self.logger.debug(self.connection_pool.get_stats_message())
+        else:
+            self._connect_session()
+
+    def close(self):
+        if self.connection_pool:
+            self.connection_pool.release(self.get_pool_key(), self.session)
+        else:
+            self.session.close()
+
+    def _connect_session(self):
+        """
+        :rtype SSHClient
+        """
         try:
             if self.target_host.password:
                 self.session.connect(self.target_host.ip, username=self.target_host.username, password=self.target_host.password)
             elif self.target_host.access_key:
-                key_stream = StringIO(self.target_host.access_key)
-                key_obj = RSAKey.from_private_key(key_stream)
+                key_obj = self.key_loader.load(self.target_host.access_key)
                 self.session.connect(self.target_host.ip, username=self.target_host.username, pkey=key_obj)
             elif self.target_host.username:
                 raise Exception('Both password and access key are empty.')
@@ -58,6 +121,7 @@ class LinuxScriptExecutor(IScriptExecutor):
             raise ExcutorConnectionError(e.errno, e)
         except Exception as e:
             raise ExcutorConnectionError(0, e)
+        return self.session
 
     def get_expected_file_extensions(self):
         """
@@ -74,12 +138,18 @@ class LinuxScriptExecutor(IScriptExecutor):
         :type output_writer: ReservationOutputWriter
         :type print_output: bool
         """
+        if self.target_host.single_round_trip and not script_file.bundle_format:
+            self.logger.info('Running "%s" (%s bytes) on target machine in a single round trip ...' % (script_file.name, script_file.expected_size))
+            self.run_script_in_single_round_trip(script_file, env_vars, output_writer, print_output)
+            self.logger.info('Done.')
+            return
+
         self.logger.info('Creating temp folder on target machine ...')
         tmp_folder = self.create_temp_folder()
         self.logger.info('Done (%s).' % tmp_folder)
 
         try:
-            self.logger.info('Copying "%s" (%s chars) to "%s" target machine ...' % (script_file.name, len(script_file.text), tmp_folder))
+            self.logger.info('Copying "%s" (%s bytes) to "%s" target machine ...' % (script_file.name, script_file.expected_size, tmp_folder))
             self.copy_script(tmp_folder, script_file)
             self.logger.info('Done.')
 
@@ -106,18 +176,178 @@ class LinuxScriptExecutor(IScriptExecutor):
         :type tmp_folder: str
         :type script_file: ScriptFile
         """
-        file_stream = StringIO(script_file.text)
-        file_size = len(file_stream.getvalue())
+        if script_file.bundle_format:
+            self._copy_bundle(tmp_folder, script_file)
+            return
+
+        if self.target_host.compress_transfer:
+            if self._can_decompress():
+                self._copy_compressed_script(tmp_folder, script_file)
+                return
+            self.logger.warning('gzip was not found on target machine, copying the script uncompressed.')
+
+        self._send_file(tmp_folder, script_file)
+
+    def _copy_compressed_script(self, tmp_folder, script_file):
+        """
+        :type tmp_folder: str
+        :type script_file: ScriptFile
+        """
+        compressed_file = script_file.compress()
+        try:
+            self.logger.info('Compressed "%s" from %s to %s bytes.' % (script_file.name, script_file.size, compressed_file.size))
+            self._send_file(tmp_folder, compressed_file)
+        finally:
+            compressed_file.close()
+        result = self._run_cancelable('gzip -d -f %s', tmp_folder + '/' + compressed_file.name)
+        if not result.success:
+            raise Exception(ErrorMsg.COPY_SCRIPT % result.std_err)
+
+    def _copy_bundle(self, tmp_folder, script_file):
+        """
+        Uploads the bundle as one tar.gz archive, and extracts it to the 'bundle' folder.
+        :type tmp_folder: str
+        :type script_file: ScriptFile
+        """
+        bundle = ScriptBundle(script_file, script_file.bundle_format)
+        try:
+            packed_file = bundle.repack(BundleFormat.TAR)
+        finally:
+            bundle.close()
+        try:
+            self.logger.info('Packed the bundle of "%s" to %s bytes.' % (script_file.entry_point, packed_file.size))
+            self._send_file(tmp_folder, packed_file)
+        finally:
+            packed_file.close()
+        bundle_folder = tmp_folder + '/' + ScriptBundle.FOLDER_NAME
+        archive_path = tmp_folder + '/' + packed_file.name
+        result = self._run_cancelable('mkdir %s && tar -xzf %s -C %s && rm -f %s',
+                                      bundle_folder, archive_path, bundle_folder, archive_path)
+        if not result.success:
+            raise Exception(ErrorMsg.COPY_SCRIPT % result.std_err)
+
+    def _send_file(self, tmp_folder, script_file):
+        """
+        Uploads the file with the host's transfer method: 'scp' (default), 'sftp', or 'auto' (sftp when the host
+        has the sftp subsystem, scp otherwise).
+        :type tmp_folder: str
+        :type script_file: ScriptFile
+        """
+        transfer_method = (self.target_host.transfer_method or 'scp').lower()
+        if transfer_method == 'sftp' or (transfer_method == 'auto' and self._is_sftp_available()):
+            self._send_file_sftp(tmp_folder, script_file)
+        else:
+            self._send_file_scp(tmp_folder, script_file)
+
+    def _send_file_scp(self, tmp_folder, script_file):
+        """
+        :type tmp_folder: str
+        :type script_file: ScriptFile
+        """
+        file_size = script_file.expected_size
+        if file_size is None:
+            # scp must declare the size up front, so a script of unknown length is downloaded completely first
+            script_file.wait_complete()
+            file_size = script_file.size
         scp = None
         try:
             scp = Write(self.session.get_transport(), tmp_folder)
-            scp.send(file_stream, script_file.name, '0601', file_size)
+            script_file.seek(0)
+            scp.send(script_file, script_file.name, '%04o' % LinuxScriptExecutor.SCRIPT_FILE_MODE, file_size)
         except SCPError as e:
             raise Exception,ErrorMsg.COPY_SCRIPT % str(e),sys.exc_info()[2]
         finally:
             if scp:
                 scp.close()
 
+    def _send_file_sftp(self, tmp_folder, script_file):
+        """
+        Pipelined sftp upload: write requests are sent without waiting for each acknowledgment, and the mode of the
+        file is set before any content is written. Unlike scp, the size needs not be known up front.
+        :type tmp_folder: str
+        :type script_file: ScriptFile
+        """
+        request_size = min(self.target_host.sftp_request_size or LinuxScriptExecutor.SFTP_REQUEST_SIZE,
+                           SFTPFile.MAX_REQUEST_SIZE)
+        sftp = None
+        try:
+            sftp = self.session.open_sftp()
+            remote_file = self._sftp_create(sftp, tmp_folder + '/' + script_file.name, LinuxScriptExecutor.SCRIPT_FILE_MODE)
+            try:
+                remote_file.set_pipelined(True)
+                progress = self._get_progress_callback(script_file)
+                transferred = 0
+                for chunk in script_file.iter_chunks(request_size):
+                    remote_file.write(chunk)
+                    transferred += len(chunk)
+                    progress(transferred)
+            finally:
+                # waits for the acknowledgments of all the pipelined writes
+                remote_file.close()
+        except (IOError, SFTPError, SSHException) as e:
+            raise Exception,ErrorMsg.COPY_SCRIPT % str(e),sys.exc_info()[2]
+        finally:
+            if sftp:
+                sftp.close()
+
+    def _sftp_create(self, sftp, path, mode):
+        """
+        Creates (or truncates) the file, and sets its mode while it is still empty.
+        :type sftp: paramiko.SFTPClient
+        :type path: str
+        :type mode: int
+        :rtype SFTPFile
+        """
+        remote_file = sftp.open(path, 'wb')
+        try:
+            remote_file.chmod(mode)
+        except Exception:
+            remote_file.close()
+            raise
+        return remote_file
+
+    def _is_sftp_available(self):
+        """
+        :rtype bool
+        """
+        if self._sftp_available is None:
+            try:
+                self.session.open_sftp().close()
+                self._sftp_available = True
+            except (SSHException, IOError) as e:
+                self.logger.warning('sftp is not available on target machine (%s), copying with scp.' % e)
+                self._sftp_available = False
+        return self._sftp_available
+
+    def _get_progress_callback(self, script_file):
+        """
+        Reports every PROGRESS_STEP_PERCENT of the upload of big files (files of an unknown size report each MB).
+        :type script_file: ScriptFile
+        :rtype (int) -> None
+        """
+        total = script_file.expected_size
+        if total is not None and total < LinuxScriptExecutor.PROGRESS_MIN_FILE_SIZE:
+            return lambda transferred: None
+        report = self.reporter.info_out if self.reporter else self.logger.info
+        step = total * LinuxScriptExecutor.PROGRESS_STEP_PERCENT / 100 if total else LinuxScriptExecutor.PROGRESS_MIN_FILE_SIZE
+        next_report = [step]
+
+        def progress(transferred):
+            if transferred < next_report[0]:
+                return
+            next_report[0] = (transferred // step + 1) * step
+            if total:
+                report('Uploading "%s": %s%% (%s of %s bytes)' % (script_file.name, transferred * 100 // total, transferred, total))
+            else:
+                report('Uploading "%s": %s bytes' % (script_file.name, transferred))
+        return progress
+
+    def _can_decompress(self):
+        """
+        :rtype bool
+        """
+        return self._run_cancelable('command -v gzip').success
+
     def run_script(self, tmp_folder, script_file, env_vars, output_writer, print_output=True):
         """
         :type tmp_folder: str
@@ -126,16 +356,98 @@ class LinuxScriptExecutor(IScriptExecutor):
         :type output_writer: ReservationOutputWriter
         :type print_output: bool
         """
+        stdin_files = []
+        if self.target_host.env_file:
+            # the parameters are written over stdin to a file in the temp folder, and sourced before the script runs
+            env_path = tmp_folder + '/' + LinuxScriptExecutor.ENV_FILE_NAME
+            code = '(umask 077; cat > %s) && . %s && ' % (env_path, env_path)
+            stdin_files.append(self._get_env_file(env_vars))
+        else:
+            code = self._get_exports_code(env_vars)
+        if script_file.entry_point:
+            # scripts of a bundle run from their own folder, so they can refer to the other files relatively
+            entry_folder, entry_name = posixpath.split(tmp_folder + '/' + ScriptBundle.FOLDER_NAME + '/' + script_file.entry_point)
+            code += 'cd %s && sh %s' % (self._escape(entry_folder), self._escape(entry_name))
+        else:
+            code += 'sh '+tmp_folder+'/'+script_file.name
+        self._run_script_code(code, output_writer, print_output, stdin_files)
+
+    def run_script_in_single_round_trip(self, script_file, env_vars, output_writer, print_output=True):
+        """
+        Creates the temp folder, writes the script (streamed over stdin), runs it and deletes the folder, all in one
+        remote command. The exit code and the stderr are the script's, just as in 'run_script'.
+        :type script_file: ScriptFile
+        :type env_vars: dict
+        :type output_writer: ReservationOutputWriter
+        :type print_output: bool
+        """
+        code = 'tmp_folder=$(mktemp -d) || exit 1;'
+        code += 'trap \'rm -rf "$tmp_folder"\' EXIT;'
+        stdin_files = [script_file]
+        if self.target_host.env_file:
+            # the parameters file goes first on stdin. dd reads it one byte per read() call, so it never consumes the
+            # beginning of the script (as a buffered 'head -c' may, which is not POSIX either); the file is small
+            env_file = self._get_env_file(env_vars)
+            code += 'dd bs=1 count=%d of="$tmp_folder/%s" 2>/dev/null || exit 1;' % (
+                env_file.size, LinuxScriptExecutor.ENV_FILE_NAME)
+            code += 'cat > "$tmp_folder/%s" || exit 1;' % script_file.name
+            code += '. "$tmp_folder/%s";' % LinuxScriptExecutor.ENV_FILE_NAME
+            stdin_files.insert(0, env_file)
+        else:
+            code += 'cat > "$tmp_folder/%s" || exit 1;' % script_file.name
+            code += self._get_exports_code(env_vars)
+        code += 'sh "$tmp_folder/%s"' % script_file.name
+        self._run_script_code(code, output_writer, print_output, stdin_files)
+
+    def _get_exports_code(self, env_vars):
+        """
+        :type env_vars: dict
+        :rtype str
+        """
         code = ''
         for key, value in (env_vars or {}).iteritems():
             code += 'export %s=%s;' % (key,self._escape(value))
         if self.target_host.password:
             code += 'export %s=%s;' % (self.PasswordEnvVarName, self._escape(self.target_host.password))
-        code += 'sh '+tmp_folder+'/'+script_file.name
-        result = self._run_cancelable(code)
-        if print_output:
-            output_writer.write(result.std_out)
-            output_writer.write(result.std_err)
+        return code
+
+    def _get_env_file(self, env_vars):
+        """
+        Serializes the parameters (and the machine password) to a shell file of exports, in single quotes so the values
+        keep their size.
+        :type env_vars: dict
+        :rtype ScriptFile
+        """
+        env_vars = dict(env_vars or {})
+        if self.target_host.password:
+            env_vars[self.PasswordEnvVarName] = self.target_host.password
+        lines = ['export %s=%s\n' % (key, self._quote(value)) for key, value in sorted(env_vars.iteritems())]
+        return ScriptFile(LinuxScriptExecutor.ENV_FILE_NAME, ''.join(lines))
+
+    def _run_script_code(self, code, output_writer, print_output, stdin_files=None):
+        """
+        Runs the script, its output is forwarded to the reservation output while it runs (or only its tail once it is
+        done, in tail mode). Output which does not fit in memory is kept as an artifact.
+        :type code: str
+        :type output_writer: ReservationOutputWriter
+        :type print_output: bool
+        :param list[ScriptFile] stdin_files: written one after the other to the stdin of the command
+        """
+        tail_size = (self.target_host.output_tail_kb or 0) * 1024
+        buffer_size = (self.target_host.output_buffer_kb or 0) * 1024
+        captures = [OutputCapture(buffer_size, 'stdout'), OutputCapture(buffer_size, 'stderr')]
+        live_output = BatchedOutputWriter(output_writer) if print_output and not tail_size else None
+        try:
+            try:
+                result = self._run_cancelable(code, stdin_files=stdin_files, live_output=live_output, captures=captures)
+            finally:
+                if live_output:
+                    live_output.close()
+            write_captured_output(captures, output_writer, print_output, tail_size,
+                                  get_artifact_prefix(self.target_host.ip))
+        finally:
+            for capture in captures:
+                capture.close()
         if not result.success:
             raise Exception(ErrorMsg.RUN_SCRIPT % result.std_err)
 
@@ -147,15 +459,60 @@ class LinuxScriptExecutor(IScriptExecutor):
         if not result.success:
             raise Exception(ErrorMsg.DELETE_TEMP_FOLDER % result.std_err)
 
-    def _run(self, code):
+    def _run(self, code, stdin_files=None, live_output=None, captures=None, stop_event=None):
+        """
+        stdout and stderr are drained concurrently while the command runs, so a chatty command never stalls on a full
+        channel window. With 'live_output', the output is forwarded as it arrives. The output is captured in bounded
+        memory, the result holds the (possibly truncated) captured text.
+        :type code: str
+        :param list[ScriptFile] stdin_files: written one after the other to the stdin of the command
+        :type live_output: BatchedOutputWriter
+        :param list[OutputCapture] captures: the stdout and stderr captures, owned by the caller; temporary ones when
+        not given
+        :param Event stop_event: set when the command was cancelled, the channel is then closed instead of drained
+        :rtype LinuxScriptExecutor.ExecutionResult
+        """
         self.logger.debug('BashScript:' + code)
 
         #stdin, stdout, stderr = self._run_cancelable(code)
         stdin, stdout, stderr = self.session.exec_command(code)
 
-        exit_code = stdout.channel.recv_exit_status()
-        stdout_txt = ''.join(stdout.readlines())
-        stderr_txt = ''.join(stderr.readlines())
+        stdout_capture, stderr_capture = captures or (OutputCapture(name='stdout'), OutputCapture(name='stderr'))
+        try:
+            channel = stdout.channel
+            channel.settimeout(BatchedOutputWriter.FLUSH_INTERVAL_SECONDS)
+            stderr_thread = Thread(target=self._drain,
+                                   args=(channel.recv_stderr, stderr_capture, live_output, 'stderr', stop_event),
+                                   name='ssh-stderr-' + str(self.target_host.ip))
+            stderr_thread.daemon = True
+            stderr_thread.start()
+            # stdin is written while the output is drained, so a command which exits early still reports its error
+            stdin_errors = []
+            if stdin_files:
+                stdin_thread = Thread(target=self._write_stdin, args=(stdin, stdin_files, stdin_errors),
+                                      name='ssh-stdin-' + str(self.target_host.ip))
+                stdin_thread.daemon = True
+                stdin_thread.start()
+            self._drain(channel.recv, stdout_capture, live_output, 'stdout', stop_event)
+            if stop_event and stop_event.is_set():
+                channel.close()
+            stderr_thread.join()
+            if stdin_files:
+                stdin_thread.join()
+
+            exit_code = channel.recv_exit_status()
+            if stdin_errors:
+                exc_info = stdin_errors[0]
+                if not isinstance(exc_info[1], (socket.error, EOFError)) or exit_code == -1:
+                    # the content could not be read, or the connection dropped before the command exited
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                self.logger.debug('The command exited before reading all of its stdin: %s' % exc_info[1])
+            stdout_txt = stdout_capture.get_text()
+            stderr_txt = stderr_capture.get_text()
+        finally:
+            if not captures:
+                stdout_capture.close()
+                stderr_capture.close()
 
         self.logger.debug('ReturnedCode:' + str(exit_code))
         self.logger.debug('Stdout:' + stdout_txt)
@@ -163,17 +520,79 @@ class LinuxScriptExecutor(IScriptExecutor):
 
         return LinuxScriptExecutor.ExecutionResult(exit_code, stdout_txt, stderr_txt)
 
-    def _run_cancelable(self, txt, *args):
-        async_result = self.pool.apply_async(self._run, kwds={'code': txt % args})
+    def _write_stdin(self, stdin, stdin_files, errors):
+        """
+        :type stdin: paramiko.ChannelFile
+        :param list[ScriptFile] stdin_files: written one after the other
+        :param list errors: gets the exc_info of a failed write
+        """
+        try:
+            for stdin_file in stdin_files:
+                for chunk in stdin_file.iter_chunks(ScriptFile.COPY_CHUNK_SIZE):
+                    stdin.write(chunk)
+            stdin.flush()
+            stdin.channel.shutdown_write()
+        except BaseException:
+            errors.append(sys.exc_info())
+            if not isinstance(errors[0][1], (socket.error, EOFError)):
+                # the command would wait for the rest of its stdin forever
+                stdin.channel.close()
 
+    def _drain(self, recv, capture, live_output, stream, stop_event=None):
+        """
+        Reads a channel stream until it ends, or until 'stop_event' is set.
+        :param recv: channel.recv or channel.recv_stderr
+        :type capture: OutputCapture
+        :type live_output: BatchedOutputWriter
+        :type stream: str
+        :type stop_event: Event
+        """
+        while not (stop_event and stop_event.is_set()):
+            try:
+                data = recv(LinuxScriptExecutor.RECV_CHUNK_SIZE)
+            except socket.timeout:
+                if live_output:
+                    live_output.flush_if_due()
+                continue
+            if not data:
+                break
+            capture.write(data)
+            if live_output:
+                live_output.write(data, stream)
+
+    def _run_cancelable(self, txt, *args, **kwargs):
+        """
+        :param str txt: the command, formatted with args
+        :keyword list[ScriptFile] stdin_files: content to write to the stdin of the command
+        :keyword BatchedOutputWriter live_output: forwards the output of the command while it runs
+        :keyword list[OutputCapture] captures: captures the stdout and stderr of the command
+        """
+        stop_event = Event()
+        async_result = self.pool.apply_async(self._run, kwds={'code': txt % args,
+                                                              'stdin_files': kwargs.get('stdin_files'),
+                                                              'live_output': kwargs.get('live_output'),
+                                                              'captures': kwargs.get('captures'),
+                                                              'stop_event': stop_event},
+                                           queue=False)
+
+        # wakes up as soon as the command completes, the cancellation flag is sampled in between
         while not async_result.ready():
             if self.cancel_sampler.is_cancelled():
+                # the worker stops draining and closes the channel, closing the session fails a pending stdin write
+                stop_event.set()
                 self.session.close()
                 self.cancel_sampler.throw()
-            time.sleep(1)
+            async_result.wait(LinuxScriptExecutor.CANCEL_POLL_INTERVAL_SECONDS)
 
         return async_result.get()
 
+    def _quote(self, value):
+        """
+        :rtype str
+        """
+        value = value.encode('utf-8') if isinstance(value, unicode) else str(value)
+        return "'" + value.replace("'", "'\\''") + "'"
+
     def _escape(self, value):
         escaped_str = "$'" + '\\x' + '\\x'.join([x.encode("hex") for x in str(value).encode("utf-8")]) + "'"
         return escaped_str
\ No newline at end of file
@@ -0,0 +1,183 @@
+import gzip
+import os
+import re
+import shutil
+import tempfile
+import uuid
+from collections import deque
+from threading import Lock
+
+import time
+
+
+class OutputCapture(object):
+    """
+    Bounded-memory capture of one output stream of a remote command.
+    The last 'buffer_size' bytes are kept in an in-memory ring buffer. Once the output grows beyond it, the whole
+    output is also written, gzip compressed, to a temp file, which can be kept as an artifact when the command is done.
+    Safe to write from one thread while another one reads.
+    """
+    DEFAULT_BUFFER_SIZE = 1024 * 1024
+    SPILL_COMPRESS_LEVEL = 1
+    ARTIFACTS_FOLDER = os.path.join(tempfile.gettempdir(), 'cloudshell_customscript_output')
+    MAX_ARTIFACTS = 50
+
+    def __init__(self, buffer_size=None, name='output'):
+        """
+        :param int buffer_size: the most bytes to keep in memory, DEFAULT_BUFFER_SIZE when not given
+        :param str name: the name of the stream, e.g. 'stdout'
+        """
+        self.buffer_size = buffer_size or OutputCapture.DEFAULT_BUFFER_SIZE
+        self.name = name
+        self.size = 0
+        self._chunks = deque()
+        self._buffered_size = 0
+        self._spill_path = None
+        self._spill = None
+        self._lock = Lock()
+
+    @property
+    def spilled(self):
+        """
+        Whether the output outgrew the memory buffer (the full output is in the spill file).
+        :rtype bool
+        """
+        return self._spill_path is not None
+
+    def write(self, data):
+        """
+        :type data: str
+        """
+        if not data:
+            return
+        with self._lock:
+            if self._spill_path is None and self.size + len(data) > self.buffer_size:
+                self._start_spill()
+            if self._spill:
+                self._spill.write(data)
+            self.size += len(data)
+            self._chunks.append(data)
+            self._buffered_size += len(data)
+            self._trim()
+
+    def get_tail(self, size=None):
+        """
+        The last 'size' bytes of the output (at most the buffer size).
+        :type size: int
+        :rtype str
+        """
+        with self._lock:
+            tail = ''.join(self._chunks)
+        if size is not None and len(tail) > size:
+            tail = tail[len(tail) - size:]
+        return tail
+
+    def get_text(self, size=None):
+        """
+        Like 'get_tail', with a note in front when the beginning of the output was cut off.
+        :type size: int
+        :rtype str
+        """
+        tail = self.get_tail(size)
+        if len(tail) < self.size:
+            return '[... %d bytes of %s truncated ...]\n%s' % (self.size - len(tail), self.name, tail)
+        return tail
+
+    def keep_artifact(self, name_prefix):
+        """
+        Keeps the full, compressed output in ARTIFACTS_FOLDER, when it did not fit in memory.
+        The oldest artifacts are deleted so at most MAX_ARTIFACTS are kept.
+        :param str name_prefix: identifies the command, the stream name and '.gz' are appended to it
+        :return: the path of the artifact, or None when the output fits in memory
+        :rtype str
+        """
+        with self._lock:
+            if self._spill_path is None:
+                return None
+            self._close_spill()
+            if not os.path.isdir(OutputCapture.ARTIFACTS_FOLDER):
+                os.makedirs(OutputCapture.ARTIFACTS_FOLDER)
+            name = re.sub(r'[^\w.-]', '_', '%s-%s.gz' % (name_prefix, self.name))
+            path = os.path.join(OutputCapture.ARTIFACTS_FOLDER, name)
+            shutil.move(self._spill_path, path)
+            self._spill_path = path
+        OutputCapture._prune_artifacts()
+        return path
+
+    def close(self):
+        """
+        Releases the buffer, and deletes the spill file unless it was kept as an artifact.
+        """
+        with self._lock:
+            self._close_spill()
+            if self._spill_path and os.path.dirname(self._spill_path) != OutputCapture.ARTIFACTS_FOLDER:
+                try:
+                    os.remove(self._spill_path)
+                except OSError:
+                    pass
+            self._chunks.clear()
+            self._buffered_size = 0
+
+    def _start_spill(self):
+        handle, self._spill_path = tempfile.mkstemp(prefix='customscript-%s-' % self.name, suffix='.gz')
+        self._spill = gzip.GzipFile(fileobj=os.fdopen(handle, 'wb'), mode='wb',
+                                    compresslevel=OutputCapture.SPILL_COMPRESS_LEVEL)
+        for chunk in self._chunks:
+            self._spill.write(chunk)
+
+    def _close_spill(self):
+        if self._spill:
+            spill_file = self._spill.fileobj
+            self._spill.close()
+            spill_file.close()
+            self._spill = None
+
+    def _trim(self):
+        while self._buffered_size > self.buffer_size:
+            excess = self._buffered_size - self.buffer_size
+            first = self._chunks[0]
+            if len(first) <= excess:
+                self._chunks.popleft()
+                self._buffered_size -= len(first)
+            else:
+                self._chunks[0] = first[excess:]
+                self._buffered_size -= excess
+
+    @staticmethod
+    def _prune_artifacts():
+        folder = OutputCapture.ARTIFACTS_FOLDER
+        try:
+            paths = [os.path.join(folder, name) for name in os.listdir(folder)]
+            paths.sort(key=os.path.getmtime)
+            for path in paths[:max(0, len(paths) - OutputCapture.MAX_ARTIFACTS)]:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def write_captured_output(captures, output_writer, print_output, tail_size, artifact_prefix):
+    """
+    Writes the tail of the captured output to the reservation output (in tail mode), keeps the full output of the
+    streams which did not fit in memory as artifacts, and tells where they are.
+    :type captures: list[OutputCapture]
+    :type output_writer: ReservationOutputWriter
+    :type print_output: bool
+    :param int tail_size: the most bytes of each stream to print, 0 when the output was already printed live
+    :type artifact_prefix: str
+    """
+    if print_output and tail_size:
+        for capture in captures:
+            if capture.size:
+                output_writer.write(capture.get_text(tail_size))
+    for capture in captures:
+        path = capture.keep_artifact(artifact_prefix)
+        if path:
+            output_writer.write('Full %s (%d bytes) is kept on the execution server at: %s' % (capture.name, capture.size, path))
+
+
+def get_artifact_prefix(ip):
+    """
+    :param str ip: the target host
+    :rtype str
+    """
+    return '%s-%s-%s' % (time.strftime('%Y%m%d-%H%M%S'), ip, uuid.uuid4().hex[:8])
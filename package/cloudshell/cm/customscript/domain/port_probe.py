@@ -0,0 +1,93 @@
+import errno
+import select
+import socket
+
+import time
+
+from cloudshell.cm.customscript.domain.cancellation_sampler import CancellationSampler
+
+
+class PortProbe(object):
+    """
+    Cheap reachability check of a tcp port: a non-blocking connect, without any protocol handshake.
+    Used to wait for a booting machine before paying for a full ssh/winrm connection and authentication.
+    """
+    INITIAL_INTERVAL_SECONDS = 0.25
+    MAX_INTERVAL_SECONDS = 3.0
+    BACKOFF_FACTOR = 1.5
+    ATTEMPT_TIMEOUT_SECONDS = 2.0
+    IN_PROGRESS_ERRNOS = [errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY, 10035]  # 10035 = WSAEWOULDBLOCK
+
+    def __init__(self, ip, port, cancel_sampler):
+        """
+        :type ip: str
+        :type port: int
+        :type cancel_sampler: CancellationSampler
+        """
+        self.ip = ip
+        self.port = port
+        self.cancel_sampler = cancel_sampler
+        self.attempts = 0
+        self.time_to_open = None
+        self.last_error = None
+
+    def is_open(self, timeout_seconds=ATTEMPT_TIMEOUT_SECONDS):
+        """
+        :type timeout_seconds: float
+        :rtype bool
+        """
+        self.attempts += 1
+        sock = None
+        try:
+            family, socktype, proto, canonname, address = socket.getaddrinfo(self.ip, self.port, 0, socket.SOCK_STREAM)[0]
+            sock = socket.socket(family, socktype, proto)
+            sock.setblocking(0)
+            error_code = sock.connect_ex(address)
+            if error_code in PortProbe.IN_PROGRESS_ERRNOS:
+                readable, writable, failed = select.select([], [sock], [sock], timeout_seconds)
+                if writable or failed:
+                    error_code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                else:
+                    error_code = errno.ETIMEDOUT
+            self.last_error = error_code
+            return error_code == 0
+        except socket.error as e:
+            self.last_error = e.errno or e
+            return False
+        finally:
+            if sock:
+                sock.close()
+
+    def wait_until_open(self, timeout_seconds):
+        """
+        Probes the port at an interval which grows from INITIAL_INTERVAL_SECONDS to MAX_INTERVAL_SECONDS, until it
+        accepts connections or the timeout passes. It is probed at least once, and the first probe always gets the
+        full ATTEMPT_TIMEOUT_SECONDS, so a short (or zero) timeout does not fail a host which is slow to answer.
+        :type timeout_seconds: float
+        :rtype bool
+        """
+        start_time = time.time()
+        interval_seconds = PortProbe.INITIAL_INTERVAL_SECONDS
+        attempt_timeout_seconds = PortProbe.ATTEMPT_TIMEOUT_SECONDS
+        while True:
+            self.cancel_sampler.throw_if_canceled()
+            if self.is_open(attempt_timeout_seconds):
+                self.time_to_open = time.time() - start_time
+                return True
+            remaining_seconds = start_time + timeout_seconds - time.time()
+            if remaining_seconds <= 0:
+                return False
+            time.sleep(min(interval_seconds, remaining_seconds))
+            interval_seconds = min(interval_seconds * PortProbe.BACKOFF_FACTOR, PortProbe.MAX_INTERVAL_SECONDS)
+            remaining_seconds = start_time + timeout_seconds - time.time()
+            attempt_timeout_seconds = min(PortProbe.ATTEMPT_TIMEOUT_SECONDS, max(remaining_seconds, 0.1))
+
+    def get_error_message(self):
+        """
+        :rtype str
+        """
+        error = self.last_error
+        if isinstance(error, int):
+            error = errno.errorcode.get(error, error)
+        return 'Port {} on host {} is not reachable after {} attempts (last error: {}).'.format(
+            self.port, self.ip, self.attempts, error)
@@ -0,0 +1,130 @@
+import base64
+import hashlib
+import re
+from StringIO import StringIO
+from threading import Lock
+
+import time
+from paramiko import RSAKey, DSSKey, ECDSAKey, Ed25519Key, SSHException
+
+
+class PrivateKeyLoader(object):
+    """
+    Parses ssh private keys (RSA, DSA, ECDSA and Ed25519, in PEM or OpenSSH format) into paramiko key objects.
+    Parsed keys are cached by a fingerprint of the key material for 'ttl_seconds', so connection retries and repeated
+    executions with the same key skip the parse.
+    """
+    _shared = None
+    _shared_lock = Lock()
+
+    PEM_KEY_CLASSES = {'RSA': RSAKey, 'DSA': DSSKey, 'EC': ECDSAKey}
+    OPENSSH_KEY_CLASSES = [('ssh-ed25519', Ed25519Key), ('ecdsa-sha2-', ECDSAKey), ('ssh-rsa', RSAKey),
+                           ('ssh-dss', DSSKey)]
+    HEADER_PATTERN = re.compile(r'-----BEGIN (?P<type>[A-Z ]*?) ?PRIVATE KEY-----\s*(?P<body>[^-]*)')
+
+    def __init__(self, ttl_seconds=600, max_keys=64):
+        """
+        :type ttl_seconds: float
+        :type max_keys: int
+        """
+        self.ttl_seconds = ttl_seconds
+        self.max_keys = max_keys
+        self.hits = 0
+        self.misses = 0
+        self._keys = {}  # fingerprint -> (key, expiry time)
+        self._lock = Lock()
+
+    @staticmethod
+    def shared():
+        """
+        The process-wide loader, for executors which were not given one.
+        :rtype PrivateKeyLoader
+        """
+        with PrivateKeyLoader._shared_lock:
+            if PrivateKeyLoader._shared is None:
+                PrivateKeyLoader._shared = PrivateKeyLoader()
+            return PrivateKeyLoader._shared
+
+    @staticmethod
+    def get_fingerprint(key_text):
+        """
+        :type key_text: str
+        :rtype str
+        """
+        if isinstance(key_text, unicode):
+            key_text = key_text.encode('utf-8')
+        return hashlib.sha256(key_text.strip()).hexdigest()
+
+    def load(self, key_text):
+        """
+        Returns the parsed key, from the cache when it was parsed in the last 'ttl_seconds'.
+        :type key_text: str
+        :rtype paramiko.PKey
+        """
+        fingerprint = PrivateKeyLoader.get_fingerprint(key_text)
+        now = time.time()
+        with self._lock:
+            key, expiry_time = self._keys.get(fingerprint, (None, 0))
+            if key and expiry_time > now:
+                self.hits += 1
+                return key
+            self.misses += 1
+
+        key = self._parse(key_text)
+
+        with self._lock:
+            self._keys[fingerprint] = (key, now + self.ttl_seconds)
+            self._evict(now)
+        return key
+
+    def get_key_count(self):
+        """
+        :rtype int
+        """
+        with self._lock:
+            return len(self._keys)
+
+    def clear(self):
+        with self._lock:
+            self._keys = {}
+
+    def get_key_classes(self, key_text):
+        """
+        Detects the key type from the PEM header, or from the key type name inside an OpenSSH format key.
+        Falls back to trying all the key types when the type can not be told (e.g. PKCS#8 keys).
+        :type key_text: str
+        :rtype list[type]
+        """
+        match = PrivateKeyLoader.HEADER_PATTERN.search(key_text)
+        if match and match.group('type') in PrivateKeyLoader.PEM_KEY_CLASSES:
+            return [PrivateKeyLoader.PEM_KEY_CLASSES[match.group('type')]]
+        if match and match.group('type') == 'OPENSSH':
+            try:
+                header = base64.b64decode(''.join(match.group('body').split()))[:256]
+            except (TypeError, ValueError):
+                header = ''
+            for type_name, key_class in PrivateKeyLoader.OPENSSH_KEY_CLASSES:
+                if type_name in header:
+                    return [key_class]
+        return [RSAKey, ECDSAKey, Ed25519Key, DSSKey]
+
+    def _parse(self, key_text):
+        """
+        :type key_text: str
+        :rtype paramiko.PKey
+        """
+        errors = []
+        for key_class in self.get_key_classes(key_text):
+            try:
+                return key_class.from_private_key(StringIO(key_text))
+            except (SSHException, ValueError, TypeError, IndexError) as e:
+                errors.append('%s: %s' % (key_class.__name__, e))
+        raise Exception('Failed to load the private key (%s)' % '; '.join(errors))
+
+    def _evict(self, now):
+        for fingerprint in [f for f, (k, t) in self._keys.items() if t <= now]:
+            del self._keys[fingerprint]
+        if len(self._keys) > self.max_keys:
+            by_expiry = sorted(self._keys.items(), key=lambda item: item[1][1])
+            for fingerprint, entry in by_expiry[:len(self._keys) - self.max_keys]:
+                del self._keys[fingerprint]
@@ -0,0 +1,340 @@
+import base64
+import re
+from logging import Logger
+
+import time
+from requests import ConnectionError, ConnectTimeout
+
+from cloudshell.cm.customscript.domain.cancellation_sampler import CancellationSampler
+from cloudshell.cm.customscript.domain.output_capture import OutputCapture, write_captured_output, get_artifact_prefix
+from cloudshell.cm.customscript.domain.reservation_output_writer import ReservationOutputWriter, BatchedOutputWriter
+from cloudshell.cm.customscript.domain.script_bundle import ScriptBundle, BundleFormat
+from cloudshell.cm.customscript.domain.script_configuration import HostConfiguration
+from cloudshell.cm.customscript.domain.script_executor import IScriptExecutor, ErrorMsg, ExcutorConnectionError
+from cloudshell.cm.customscript.domain.script_file import ScriptFile
+
+
+def import_pypsrp():
+    """
+    pypsrp is an optional dependency, only the 'psrp' connection method needs it.
+    :return: the WSMan, RunspacePool and PowerShell classes, and the PSInvocationState constants
+    :rtype tuple
+    """
+    try:
+        from pypsrp.complex_objects import PSInvocationState
+        from pypsrp.powershell import PowerShell, RunspacePool
+        from pypsrp.wsman import WSMan
+    except ImportError as e:
+        raise Exception('The "psrp" connection method requires the pypsrp package (pip install pypsrp): %s' % e)
+    return WSMan, RunspacePool, PowerShell, PSInvocationState
+
+
+class PSRPScriptExecutor(IScriptExecutor):
+    """
+    Runs the script over the PowerShell Remoting Protocol, in one runspace which is opened on connect and closed when
+    the execution is done. Every step (temp folder, upload, run, cleanup) is a pipeline in that runspace, instead of a
+    new powershell process per step, and the output records are forwarded as they arrive.
+    The steps are fixed scripts which get their values as parameters. A step fails on any error record, the script
+    fails on a terminating error or a non-zero exit code (its error records are written either way).
+    """
+    HTTP_PORT = 5985
+    HTTPS_PORT = 5986
+    UPLOAD_CHUNK_SIZE = 1024 * 1024
+    POLL_TIMEOUT_SECONDS = 1
+
+    CREATE_TEMP_FOLDER_SCRIPT = """
+$path = Join-Path $env:Temp ([System.Guid]::NewGuid().ToString())
+New-Item $path -type directory | Out-Null
+$path
+"""
+    APPEND_FILE_SCRIPT = """
+param($Folder, $Name, $Data)
+$bytes  = [System.Convert]::FromBase64String($Data)
+$stream = New-Object System.IO.FileStream((Join-Path $Folder $Name), [System.IO.FileMode]::Append)
+try {
+    $stream.Write($bytes, 0, $bytes.Length)
+}
+finally {
+    $stream.Close()
+}
+"""
+    EXTRACT_BUNDLE_SCRIPT = """
+param($Folder, $Name, $Destination)
+$source = Join-Path $Folder $Name
+$path   = Join-Path $Folder $Destination
+try {
+    Add-Type -AssemblyName System.IO.Compression.FileSystem
+    [System.IO.Compression.ZipFile]::ExtractToDirectory($source, $path)
+}
+catch {
+    New-Item $path -type directory -force | Out-Null
+    $shell = New-Object -ComObject Shell.Application
+    $shell.Namespace($path).CopyHere($shell.Namespace($source).Items(), 16)
+}
+Remove-Item $source
+"""
+    RUN_SCRIPT = """
+param($Folder, $Name, $Variables, $SetLocation)
+foreach ($key in $Variables.Keys) { Set-Item "env:$key" $Variables[$key] }
+$path = Join-Path $Folder $Name
+if ($SetLocation) { Set-Location (Split-Path $path) }
+$global:LASTEXITCODE = 0
+& $path
+"""
+    GET_EXIT_CODE_SCRIPT = """
+$global:LASTEXITCODE
+"""
+    DELETE_TEMP_FOLDER_SCRIPT = """
+param($Folder)
+Remove-Item $Folder -recurse -force
+"""
+
+    def __init__(self, logger, target_host, cancel_sampler):
+        """
+        :type logger: Logger
+        :type target_host: HostConfiguration
+        :type cancel_sampler: CancellationSampler
+        """
+        self.logger = logger
+        self.target_host = target_host
+        self.cancel_sampler = cancel_sampler
+        self.runspace_pool = None
+        self._pypsrp = None
+
+    def get_connection_address(self):
+        """
+        :rtype tuple
+        """
+        if self.target_host.connection_secured:
+            return self.target_host.ip, PSRPScriptExecutor.HTTPS_PORT
+        return self.target_host.ip, PSRPScriptExecutor.HTTP_PORT
+
+    def connect(self):
+        self._pypsrp = self._pypsrp or import_pypsrp()
+        wsman_class, runspace_pool_class = self._pypsrp[0], self._pypsrp[1]
+        self.close()
+        try:
+            host, port = self.get_connection_address()
+            wsman = wsman_class(host, port=port, username=self.target_host.username,
+                                password=self.target_host.password, ssl=bool(self.target_host.connection_secured))
+            runspace_pool = runspace_pool_class(wsman)
+            runspace_pool.open()
+            self.runspace_pool = runspace_pool
+        except ConnectTimeout as e:
+            raise ExcutorConnectionError(10060, e) #10060=Timeout
+        except ConnectionError as e:
+            match = re.search(r'\[Errno (?P<errno>\d+)\]', str(e.message))
+            raise ExcutorConnectionError(int(match.group('errno')) if match else 0, e)
+        except Exception as e:
+            match = re.search(r'[Cc]ode (?P<errno>\d+)', str(e))
+            raise ExcutorConnectionError(int(match.group('errno')) if match else 0, e)
+
+    def close(self):
+        runspace_pool, self.runspace_pool = self.runspace_pool, None
+        if runspace_pool:
+            try:
+                runspace_pool.close()
+            except Exception as e:
+                self.logger.debug('Failed to close the runspace: %s' % e)
+
+    def get_expected_file_extensions(self):
+        """
+        :rtype list[str]
+        """
+        return ['.ps1']
+
+    def execute(self, script_file, env_vars, output_writer, print_output=True):
+        """
+        :type script_file: ScriptFile
+        :type output_writer: ReservationOutputWriter
+        :type print_output: bool
+        """
+        self.logger.info('Creating temp folder on target machine ...')
+        tmp_folder = self.create_temp_folder()
+        self.logger.info('Done (%s).' % tmp_folder)
+
+        try:
+            self.logger.info('Copying "%s" (%s bytes) to "%s" target machine ...' % (
+                script_file.name, script_file.expected_size, tmp_folder))
+            self.copy_script(tmp_folder, script_file)
+            self.logger.info('Done.')
+
+            self.logger.info('Running "%s" on target machine ...' % script_file.name)
+            self.run_script(tmp_folder, script_file, env_vars, output_writer, print_output)
+            self.logger.info('Done.')
+
+        finally:
+            self.logger.info('Deleting "%s" folder from target machine ...' % tmp_folder)
+            self.delete_temp_folder(tmp_folder)
+            self.logger.info('Done.')
+
+    def create_temp_folder(self):
+        """
+        :rtype str
+        """
+        output, errors, failed = self._invoke(PSRPScriptExecutor.CREATE_TEMP_FOLDER_SCRIPT)
+        if failed or errors:
+            raise Exception(ErrorMsg.CREATE_TEMP_FOLDER % errors)
+        return output.strip()
+
+    def copy_script(self, tmp_folder, script_file):
+        """
+        :type tmp_folder: str
+        :type script_file: ScriptFile
+        """
+        if not script_file.bundle_format:
+            self._send_file(tmp_folder, script_file)
+            return
+        bundle = ScriptBundle(script_file, script_file.bundle_format)
+        try:
+            packed_file = bundle.repack(BundleFormat.ZIP)
+        finally:
+            bundle.close()
+        try:
+            self.logger.info('Packed the bundle of "%s" to %s bytes.' % (script_file.entry_point, packed_file.size))
+            self._send_file(tmp_folder, packed_file)
+        finally:
+            packed_file.close()
+        output, errors, failed = self._invoke(PSRPScriptExecutor.EXTRACT_BUNDLE_SCRIPT,
+                                              {'Folder': tmp_folder, 'Name': packed_file.name,
+                                               'Destination': ScriptBundle.FOLDER_NAME})
+        if failed or errors:
+            raise Exception(ErrorMsg.COPY_SCRIPT % errors)
+
+    def _send_file(self, tmp_folder, script_file):
+        """
+        Appends the file to the target path in UPLOAD_CHUNK_SIZE pieces, each one a pipeline of the runspace.
+        :type tmp_folder: str
+        :type script_file: ScriptFile
+        """
+        start_time = time.time()
+        size = 0
+        for chunk in script_file.iter_chunks(PSRPScriptExecutor.UPLOAD_CHUNK_SIZE):
+            self.cancel_sampler.throw_if_canceled()
+            output, errors, failed = self._invoke(PSRPScriptExecutor.APPEND_FILE_SCRIPT,
+                                                  {'Folder': tmp_folder, 'Name': script_file.name,
+                                                   'Data': base64.b64encode(chunk)})
+            if failed or errors:
+                raise Exception(ErrorMsg.COPY_SCRIPT % errors)
+            size += len(chunk)
+        elapsed = max(time.time() - start_time, 0.001)
+        self.logger.info('Uploaded "%s" (%s bytes) in %.2f seconds (%.1f KB/s).' %
+                         (script_file.name, size, elapsed, size / 1024.0 / elapsed))
+
+    def run_script(self, tmp_folder, script_file, env_vars, output_writer, print_output=True):
+        """
+        :type tmp_folder: str
+        :type script_file: ScriptFile
+        :type env_vars: dict
+        :type output_writer: ReservationOutputWriter
+        :type print_output: bool
+        """
+        if script_file.entry_point:
+            # scripts of a bundle run from their own folder, so they can refer to the other files relatively
+            parameters = {'Folder': tmp_folder, 'SetLocation': True,
+                          'Name': '%s\\%s' % (ScriptBundle.FOLDER_NAME, script_file.entry_point.replace('/', '\\'))}
+        else:
+            parameters = {'Folder': tmp_folder, 'Name': script_file.name, 'SetLocation': False}
+        parameters['Variables'] = dict((key, value if isinstance(value, unicode) else str(value))
+                                       for key, value in (env_vars or {}).iteritems())
+        tail_size = (self.target_host.output_tail_kb or 0) * 1024
+        buffer_size = (self.target_host.output_buffer_kb or 0) * 1024
+        captures = [OutputCapture(buffer_size, 'stdout'), OutputCapture(buffer_size, 'stderr')]
+        live_output = BatchedOutputWriter(output_writer) if print_output and not tail_size else None
+        try:
+            try:
+                output, errors, failed = self._invoke(PSRPScriptExecutor.RUN_SCRIPT, parameters, captures,
+                                                      live_output)
+            finally:
+                if live_output:
+                    live_output.close()
+            if live_output and errors:
+                output_writer.write(errors)
+            write_captured_output(captures, output_writer, print_output, tail_size,
+                                  get_artifact_prefix(self.target_host.ip))
+        finally:
+            for capture in captures:
+                capture.close()
+        exit_code = self._get_exit_code()
+        if failed or exit_code:
+            raise Exception(ErrorMsg.RUN_SCRIPT % (errors or 'exit code %s' % exit_code))
+
+    def _get_exit_code(self):
+        """
+        The exit code of the last native command or script of the runspace.
+        :rtype int
+        """
+        output, errors, failed = self._invoke(PSRPScriptExecutor.GET_EXIT_CODE_SCRIPT)
+        try:
+            return int(output.strip() or 0)
+        except ValueError:
+            return 0
+
+    def delete_temp_folder(self, tmp_folder):
+        """
+        :type tmp_folder: str
+        """
+        output, errors, failed = self._invoke(PSRPScriptExecutor.DELETE_TEMP_FOLDER_SCRIPT, {'Folder': tmp_folder})
+        if failed or errors:
+            raise Exception(ErrorMsg.DELETE_TEMP_FOLDER % errors)
+
+    def _invoke(self, script, parameters=None, captures=None, live_output=None):
+        """
+        Runs a script as a pipeline of the runspace, and reads its output records as they arrive.
+        :type script: str
+        :type parameters: dict
+        :param list[OutputCapture] captures: the stdout and stderr captures, owned by the caller; temporary ones when
+        not given
+        :param BatchedOutputWriter live_output: forwards the output records while the script runs
+        :return: the output and the error records (as text), and whether the script ended with a terminating error
+        :rtype tuple
+        """
+        power_shell_class, invocation_state = self._pypsrp[2], self._pypsrp[3]
+        power_shell = power_shell_class(self.runspace_pool)
+        power_shell.add_script(script)
+        for name, value in sorted((parameters or {}).iteritems()):
+            power_shell.add_parameter(name, value)
+        stdout_capture, stderr_capture = captures or (OutputCapture(name='stdout'), OutputCapture(name='stderr'))
+        try:
+            power_shell.begin_invoke()
+            read_records = 0
+            while True:
+                read_records = self._read_output(power_shell.output, read_records, stdout_capture, live_output)
+                if power_shell.state != invocation_state.RUNNING:
+                    break
+                if self.cancel_sampler.is_cancelled():
+                    power_shell.stop()
+                    self.cancel_sampler.throw()
+                power_shell.poll_invoke(PSRPScriptExecutor.POLL_TIMEOUT_SECONDS)
+                if live_output:
+                    live_output.flush_if_due()
+            for record in power_shell.streams.error:
+                stderr_capture.write('%s\n' % record)
+            failed = power_shell.state == invocation_state.FAILED
+            output, errors = stdout_capture.get_text(), stderr_capture.get_text().rstrip('\n')
+        finally:
+            if not captures:
+                stdout_capture.close()
+                stderr_capture.close()
+        self.logger.debug('Failed:' + str(failed))
+        self.logger.debug('Stdout:' + output)
+        self.logger.debug('Stderr:' + errors)
+        return output, errors, failed
+
+    def _read_output(self, records, read_records, capture, live_output):
+        """
+        Writes the output records which arrived since the last call.
+        :type records: list
+        :type read_records: int
+        :type capture: OutputCapture
+        :type live_output: BatchedOutputWriter
+        :return: the number of records read so far
+        :rtype int
+        """
+        for record in records[read_records:]:
+            text = record if isinstance(record, basestring) else str(record)
+            text = (text.encode('utf-8') if isinstance(text, unicode) else text) + '\n'
+            capture.write(text)
+            if live_output:
+                live_output.write(text, 'stdout')
+        return len(records)
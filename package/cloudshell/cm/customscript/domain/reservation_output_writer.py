@@ -1,4 +1,8 @@
 import re
+from collections import OrderedDict
+from threading import RLock
+
+import time
 
 
 class ReservationOutputWriter(object):
@@ -20,4 +24,79 @@ class ReservationOutputWriter(object):
 
     def _remove_illegal_chars(self, str):
         rx = re.compile(u'\x00')
-        return rx.sub('', str)
\ No newline at end of file
+        return rx.sub('', str)
+
+
+class BatchedOutputWriter(object):
+    """
+    Forwards the output of a running script to the reservation output while it runs.
+    Output is sent in batches of whole lines: a batch is flushed once it reaches 'max_batch_size', or once
+    'flush_interval_seconds' passed since the last flush. Each stream (stdout / stderr) keeps its own partial line,
+    so lines of concurrent streams are not mixed. Safe to use from several threads.
+    """
+    FLUSH_INTERVAL_SECONDS = 1.0
+    MAX_BATCH_SIZE = 64 * 1024
+
+    def __init__(self, output_writer, flush_interval_seconds=FLUSH_INTERVAL_SECONDS, max_batch_size=MAX_BATCH_SIZE):
+        """
+        :type output_writer: ReservationOutputWriter
+        :type flush_interval_seconds: float
+        :type max_batch_size: int
+        """
+        self.output_writer = output_writer
+        self.flush_interval_seconds = flush_interval_seconds
+        self.max_batch_size = max_batch_size
+        self._partial_lines = OrderedDict()
+        self._pending = []
+        self._pending_size = 0
+        self._last_flush_time = time.time()
+        self._lock = RLock()
+
+    def write(self, data, stream=None):
+        """
+        :type data: str
+        :param str stream: the name of the stream the data came from
+        """
+        with self._lock:
+            lines = (self._partial_lines.pop(stream, '') + data).splitlines(True)
+            if lines and not lines[-1].endswith(('\n', '\r')):
+                partial_line = lines.pop()
+                if len(partial_line) >= self.max_batch_size:
+                    lines.append(partial_line)
+                else:
+                    self._partial_lines[stream] = partial_line
+            self._pending.extend(lines)
+            self._pending_size += sum(len(line) for line in lines)
+            self.flush_if_due()
+
+    def flush_if_due(self):
+        """
+        Flushes the pending batch when it is big enough or old enough. A partial line waiting for longer than the
+        flush interval (e.g. a progress indicator) is flushed as well.
+        """
+        with self._lock:
+            if self._pending_size >= self.max_batch_size:
+                self.flush()
+            elif time.time() - self._last_flush_time >= self.flush_interval_seconds:
+                self.flush(include_partial_lines=True)
+
+    def flush(self, include_partial_lines=False):
+        """
+        :param bool include_partial_lines: also send the partial lines, each stream's in its own message
+        """
+        with self._lock:
+            self._last_flush_time = time.time()
+            if self._pending:
+                batch = ''.join(self._pending)
+                self._pending = []
+                self._pending_size = 0
+                self.output_writer.write(batch)
+            if include_partial_lines:
+                while self._partial_lines:
+                    self.output_writer.write(self._partial_lines.popitem(last=False)[1])
+
+    def close(self):
+        """
+        Flushes everything which was written.
+        """
+        self.flush(include_partial_lines=True)
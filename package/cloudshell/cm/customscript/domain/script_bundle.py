@@ -0,0 +1,174 @@
+import os
+import posixpath
+import shutil
+import tarfile
+import tempfile
+import zipfile
+
+from cloudshell.cm.customscript.domain.script_file import ScriptFile
+
+
+class BundleFormat(object):
+    TAR = 'tar'
+    ZIP = 'zip'
+
+
+def get_bundle_format(first_bytes):
+    """
+    Detects the archive format by its magic bytes.
+    :type first_bytes: str
+    :rtype str
+    """
+    if first_bytes.startswith('PK\x03\x04'):
+        return BundleFormat.ZIP
+    if first_bytes.startswith('\x1f\x8b') or first_bytes[257:262] == 'ustar':
+        return BundleFormat.TAR
+    return None
+
+
+class ScriptBundle(object):
+    """
+    Multi-file script payload (a tar / tar.gz / zip archive) with a designated entry point script.
+    A single top level folder, as in Gitlab repository archives, is stripped from the member paths.
+    """
+    FOLDER_NAME = 'bundle'
+
+    def __init__(self, archive_file, bundle_format):
+        """
+        :type archive_file: ScriptFile
+        :type bundle_format: str
+        """
+        self.archive_file = archive_file
+        self.bundle_format = bundle_format
+        self._zip = None
+        self._tar = None
+
+    def get_member_paths(self):
+        """
+        The paths of the files in the bundle, after the top level folder was stripped.
+        :rtype list[str]
+        """
+        return [path for path, name, member in self._iter_members()]
+
+    def find_entry_point(self, entry_point):
+        """
+        Resolves the entry point to a member path. The entry point may be given with or without the top level folder,
+        or as a unique path suffix.
+        :type entry_point: str
+        :rtype str
+        """
+        entry_point = entry_point.replace('\\', '/').strip('/')
+        members = [(path, name) for path, name, member in self._iter_members()]
+        for path, name in members:
+            if entry_point in (path, name):
+                return path
+        matches = [path for path, name in members if name.endswith('/' + entry_point)]
+        if len(matches) == 1:
+            return matches[0]
+        if matches:
+            raise Exception("Entry point '%s' is ambiguous in the script bundle: %s" % (entry_point, ', '.join(matches)))
+        raise Exception("Entry point '%s' was not found in the script bundle" % entry_point)
+
+    def repack(self, bundle_format):
+        """
+        Writes the (stripped) bundle members to a new archive, a tar.gz or a zip, named 'bundle.tar.gz'/'bundle.zip'.
+        :type bundle_format: str
+        :rtype ScriptFile
+        """
+        if bundle_format == BundleFormat.ZIP:
+            return self._repack_zip()
+        packed = ScriptFile(name=ScriptBundle.FOLDER_NAME + '.tar.gz')
+        tar_out = tarfile.open(fileobj=packed, mode='w:gz')
+        try:
+            for path, name, member in self._iter_members():
+                info = tarfile.TarInfo(path)
+                info.size = self._get_member_size(member)
+                info.mode = member.mode if isinstance(member, tarfile.TarInfo) else 0o644
+                tar_out.addfile(info, self._open_member(member))
+        finally:
+            tar_out.close()
+        return packed
+
+    def close(self):
+        """
+        Closes the archive reader, the archive file itself is left open.
+        """
+        if self._zip:
+            self._zip.close()
+            self._zip = None
+        if self._tar:
+            self._tar.close()
+            self._tar = None
+
+    def _repack_zip(self):
+        """
+        zipfile streams a member only from a file on disk, and seeks back to its header once it is written, while a
+        ScriptFile is only appended to. So each member is copied to a temp file, the archive is written to a temp file,
+        and then copied to the ScriptFile, all in chunks.
+        :rtype ScriptFile
+        """
+        packed = ScriptFile(name=ScriptBundle.FOLDER_NAME + '.zip')
+        archive = tempfile.TemporaryFile()
+        try:
+            zip_out = zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+            try:
+                for path, name, member in self._iter_members():
+                    self._write_zip_member(zip_out, path, member)
+            finally:
+                zip_out.close()
+            archive.seek(0)
+            for chunk in iter(lambda: archive.read(ScriptFile.COPY_CHUNK_SIZE), ''):
+                packed.write(chunk)
+        except:
+            packed.close()
+            raise
+        finally:
+            archive.close()
+        return packed
+
+    def _write_zip_member(self, zip_out, path, member):
+        """
+        :type zip_out: zipfile.ZipFile
+        :type path: str
+        """
+        handle, member_path = tempfile.mkstemp()
+        try:
+            with os.fdopen(handle, 'wb') as member_file:
+                shutil.copyfileobj(self._open_member(member), member_file, ScriptFile.COPY_CHUNK_SIZE)
+            zip_out.write(member_path, path)
+        finally:
+            os.remove(member_path)
+
+    def _iter_members(self):
+        members = self._get_file_members()
+        names = [self._get_member_name(m) for m in members]
+        roots = set(name.split('/', 1)[0] for name in names)
+        strip_root = len(roots) == 1 and all('/' in name for name in names)
+        for name, member in zip(names, members):
+            path = name.split('/', 1)[1] if strip_root else name
+            if posixpath.isabs(path) or '..' in path.split('/'):
+                raise Exception("Script bundle contains an unsafe path: '%s'" % name)
+            yield path, name, member
+
+    def _get_file_members(self):
+        self.close()
+        self.archive_file.seek(0)
+        if self.bundle_format == BundleFormat.ZIP:
+            self._zip = zipfile.ZipFile(self.archive_file)
+            return [m for m in self._zip.infolist() if not m.filename.endswith('/')]
+        self._tar = tarfile.open(fileobj=self.archive_file, mode='r:*')
+        return [m for m in self._tar.getmembers() if m.isfile()]
+
+    def _get_member_name(self, member):
+        name = (member.filename if isinstance(member, zipfile.ZipInfo) else member.name).replace('\\', '/')
+        while name.startswith('./'):
+            name = name[2:]
+        return name
+
+    def _get_member_size(self, member):
+        return member.file_size if isinstance(member, zipfile.ZipInfo) else member.size
+
+    def _open_member(self, member):
+        if isinstance(member, zipfile.ZipInfo):
+            return self._zip.open(member)
+        return self._tar.extractfile(member)
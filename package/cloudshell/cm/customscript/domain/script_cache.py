@@ -0,0 +1,248 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+import uuid
+from threading import RLock
+
+from cloudshell.cm.customscript.domain.script_file import ScriptFile
+
+
+class ScriptCacheEntry(object):
+    def __init__(self, key, content_hash, file_name, size, etag=None, last_modified=None, last_access=None):
+        """
+        :type key: str
+        :type content_hash: str
+        :type file_name: str
+        :type size: int
+        :type etag: str
+        :type last_modified: str
+        :type last_access: float
+        """
+        self.key = key
+        self.content_hash = content_hash
+        self.file_name = file_name
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+        self.last_access = last_access or time.time()
+
+    def get_conditional_headers(self):
+        """
+        :rtype dict
+        """
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class ScriptCache(object):
+    """
+    On-disk, size bounded cache of downloaded scripts.
+    Entries are keyed by the url and the identity of the credentials used to fetch it, the content itself is stored
+    once per content hash (under 'objects'), and the least recently used entries are evicted when the cache grows
+    beyond 'max_size' bytes.
+    """
+    DEFAULT_MAX_SIZE = 512 * 1024 * 1024
+    INDEX_FILE_NAME = 'index.json'
+    OBJECTS_FOLDER_NAME = 'objects'
+    COPY_CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, cache_dir=None, max_size=DEFAULT_MAX_SIZE):
+        """
+        :type cache_dir: str
+        :type max_size: int
+        """
+        self.cache_dir = cache_dir or os.path.join(tempfile.gettempdir(), 'cloudshell_customscript_cache')
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self._lock = RLock()
+        self._entries = None
+
+    @staticmethod
+    def get_key(url, *credentials):
+        """
+        :type url: str
+        :type credentials: str
+        :rtype str
+        """
+        key = hashlib.sha256()
+        key.update(url.encode('utf-8'))
+        for credential in credentials:
+            key.update('\x00')
+            key.update((credential or '').encode('utf-8'))
+        return key.hexdigest()
+
+    def get(self, key):
+        """
+        Returns the cached entry, which the caller is expected to revalidate against the remote side.
+        :type key: str
+        :rtype ScriptCacheEntry
+        """
+        with self._lock:
+            entry = self._get_entries().get(key)
+            if entry and not os.path.isfile(self._get_object_path(entry.content_hash)):
+                self._remove_entry(key)
+                entry = None
+            if entry:
+                self.revalidations += 1
+            else:
+                self.misses += 1
+            return entry
+
+    def read(self, entry, reporter=None):
+        """
+        :type entry: ScriptCacheEntry
+        :param SandboxReporter reporter: warned when the cached copy can not be read
+        :return: the cached copy, or None when it can not be read (and the entry is dropped)
+        :rtype ScriptFile
+        """
+        script_file = ScriptFile(name=entry.file_name)
+        try:
+            with open(self._get_object_path(entry.content_hash), 'rb') as f:
+                for chunk in iter(lambda: f.read(ScriptCache.COPY_CHUNK_SIZE), ''):
+                    script_file.write(chunk)
+        except (IOError, OSError) as e:
+            script_file.close()
+            ScriptCache._warn(reporter, 'failed to read the cached copy of {}'.format(entry.file_name), e)
+            with self._lock:
+                if self._get_entries().get(entry.key) is entry:
+                    self._remove_entry(entry.key)
+            return None
+        return script_file
+
+    def mark_hit(self, entry, reporter=None):
+        """
+        The remote side approved the cached content (304 Not Modified).
+        :type entry: ScriptCacheEntry
+        :param SandboxReporter reporter: warned when the index can not be saved
+        """
+        with self._lock:
+            self.hits += 1
+            entry.last_access = time.time()
+            try:
+                self._save_index()
+            except (IOError, OSError) as e:
+                ScriptCache._warn(reporter, 'failed to save the script cache index', e)
+
+    def put(self, key, script_file, etag=None, last_modified=None, reporter=None):
+        """
+        Caching is an optimization, a cache folder which can not be written to does not fail the download.
+        :type key: str
+        :type script_file: ScriptFile
+        :type etag: str
+        :type last_modified: str
+        :param SandboxReporter reporter: warned when the script can not be cached
+        :return: the new entry, or None when the script could not be cached
+        :rtype ScriptCacheEntry
+        """
+        content_hash = script_file.sha256
+        with self._lock:
+            object_path = self._get_object_path(content_hash)
+            try:
+                if not os.path.isfile(object_path):
+                    self._makedirs(os.path.dirname(object_path))
+                    self._write_atomic(object_path, script_file.iter_chunks(ScriptCache.COPY_CHUNK_SIZE))
+            except (IOError, OSError) as e:
+                ScriptCache._warn(reporter, 'failed to cache {}'.format(script_file.name), e)
+                return None
+            entry = ScriptCacheEntry(key, content_hash, script_file.name, script_file.size, etag, last_modified)
+            old_entry = self._get_entries().get(key)
+            self._entries[key] = entry
+            if old_entry and old_entry.content_hash != content_hash:
+                self._remove_object_if_unused(old_entry.content_hash)
+            self._evict()
+            try:
+                self._save_index()
+            except (IOError, OSError) as e:
+                # the entry is still used by this process, the object file is verified before every use
+                ScriptCache._warn(reporter, 'failed to save the script cache index', e)
+            return entry
+
+    def get_stats_message(self):
+        """
+        :rtype str
+        """
+        with self._lock:
+            entries = self._get_entries()
+            return 'Script cache stats: %s hits, %s misses, %s revalidations, %s entries, %s bytes.' % (
+                self.hits, self.misses, self.revalidations, len(entries), self._get_total_size())
+
+    def _get_entries(self):
+        if self._entries is None:
+            self._entries = {}
+            try:
+                with open(os.path.join(self.cache_dir, ScriptCache.INDEX_FILE_NAME), 'rb') as f:
+                    for key, value in json.load(f).iteritems():
+                        self._entries[key] = ScriptCacheEntry(key=key, **value)
+            except (IOError, ValueError, TypeError):
+                # missing or corrupted index - start over with an empty cache
+                self._entries = {}
+        return self._entries
+
+    def _get_total_size(self):
+        return sum(dict((e.content_hash, e.size) for e in self._get_entries().itervalues()).itervalues())
+
+    def _evict(self):
+        entries = sorted(self._get_entries().itervalues(), key=lambda e: e.last_access)
+        while entries and self._get_total_size() > self.max_size:
+            self._remove_entry(entries.pop(0).key)
+
+    def _remove_entry(self, key):
+        entry = self._get_entries().pop(key, None)
+        if entry:
+            self._remove_object_if_unused(entry.content_hash)
+
+    def _remove_object_if_unused(self, content_hash):
+        if any(e.content_hash == content_hash for e in self._get_entries().itervalues()):
+            return
+        try:
+            os.remove(self._get_object_path(content_hash))
+        except OSError:
+            pass
+
+    def _save_index(self):
+        index = dict((key, {'content_hash': e.content_hash, 'file_name': e.file_name, 'size': e.size,
+                            'etag': e.etag, 'last_modified': e.last_modified, 'last_access': e.last_access})
+                     for key, e in self._get_entries().iteritems())
+        self._makedirs(self.cache_dir)
+        self._write_atomic(os.path.join(self.cache_dir, ScriptCache.INDEX_FILE_NAME), [json.dumps(index)])
+
+    def _get_object_path(self, content_hash):
+        return os.path.join(self.cache_dir, ScriptCache.OBJECTS_FOLDER_NAME, content_hash)
+
+    def _write_atomic(self, path, chunks):
+        tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+        try:
+            with open(tmp_path, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            try:
+                if os.path.exists(path):
+                    os.remove(path)  # os.rename does not override existing files on windows
+                os.rename(tmp_path, path)
+            except OSError:
+                # another process which shares the cache folder may have removed or replaced the file meanwhile
+                if not os.path.exists(path):
+                    raise
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _makedirs(self, path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+
+    @staticmethod
+    def _warn(reporter, message, error):
+        if reporter:
+            reporter.warn_out('{}, continuing without the script cache: {}'.format(message, error), log_only=True)
@@ -9,18 +9,20 @@ CONNECTION_METHOD_PARAM = "CONNECTION_METHOD"
 
 
 class ScriptConfiguration(object):
-    def __init__(self, script_repo=None, host_conf=None, timeout_minutes=None, print_output=True):
+    def __init__(self, script_repo=None, host_conf=None, timeout_minutes=None, print_output=True, stream_transfer=False):
         """
         :type script_repo: ScriptRepository
         :type host_conf: HostConfiguration
         :type timeout_minutes: float
         :type print_output: bool
+        :type stream_transfer: bool
         :type gitlab_details: GitLabRepoDetails
         """
         self.timeout_minutes = timeout_minutes or 0.0
         self.script_repo = script_repo or ScriptRepository()
         self.host_conf = host_conf or HostConfiguration()
         self.print_output = print_output
+        self.stream_transfer = stream_transfer
 
     def get_pretty_json(self):
         return json.dumps(self, default=lambda o: getattr(o, '__dict__', str(o)), indent=4)
@@ -31,6 +33,9 @@ class ScriptRepository(object):
         self.url = None
         self.username = None
         self.password = None
+        self.bypass_cache = False
+        self.mirrors = []
+        self.entry_point = None
 
 
 class HostConfiguration(object):
@@ -41,6 +46,14 @@ class HostConfiguration(object):
         self.username = None
         self.password = None
         self.access_key = None
+        self.compress_transfer = False
+        self.single_round_trip = False
+        self.transfer_method = None
+        self.sftp_request_size = None
+        self.output_buffer_kb = None
+        self.output_tail_kb = None
+        self.env_file = False
+        self.upload_parallelism = None
         self.parameters = {}
 
 
@@ -83,24 +96,65 @@ class ScriptConfigurationParser(object):
         """
         json_obj = json.loads(json_str)
         ScriptConfigurationParser._validate(json_obj)
+        return self._json_obj_to_object(json_obj)
 
+    def json_to_prefetch_objects(self, json_str):
+        """
+        Decodes a json list of script configurations (or a single one) to be downloaded ahead of time.
+        Only the repository details are validated, the hosts details are optional (and may not be deployed yet).
+        :type json_str: str
+        :rtype list[ScriptConfiguration]
+        """
+        json_obj = json.loads(json_str)
+        if isinstance(json_obj, dict):
+            json_obj = [json_obj]
+        if not isinstance(json_obj, list) or not json_obj:
+            raise SyntaxError('Failed to parse script configurations input json: Expected a non empty list.')
+        script_confs = []
+        for item in json_obj:
+            ScriptConfigurationParser._validate_repository(item)
+            script_confs.append(self._json_obj_to_object(item))
+        return script_confs
+
+    def _json_obj_to_object(self, json_obj):
+        """
+        :type json_obj: dict
+        :rtype ScriptConfiguration
+        """
         script_conf = ScriptConfiguration()
         script_conf.timeout_minutes = json_obj.get('timeoutMinutes', 0.0)
         script_conf.print_output = bool_parse(json_obj.get('printOutput', True))
+        script_conf.stream_transfer = bool_parse(json_obj.get('streamTransfer', False))
 
         repo = json_obj['repositoryDetails']
         script_conf.script_repo.url = repo.get('url')
         script_conf.script_repo.username = repo.get('username')
         script_conf.script_repo.password = repo.get('password')
+        script_conf.script_repo.bypass_cache = bool_parse(repo.get('bypassCache', False))
+        script_conf.script_repo.mirrors = repo.get('mirrors') or []
+        script_conf.script_repo.entry_point = repo.get('entryPoint')
+
+        if not json_obj.get('hostsDetails'):
+            return script_conf
 
         host = json_obj['hostsDetails'][0]
         script_conf.host_conf = HostConfiguration()
         script_conf.host_conf.ip = host.get('ip')
-        script_conf.host_conf.connection_method = host['connectionMethod'].lower()
+        script_conf.host_conf.connection_method = (host.get('connectionMethod') or '').lower()
         script_conf.host_conf.connection_secured = bool_parse(host.get('connectionSecured'))
         script_conf.host_conf.username = host.get('username')
         script_conf.host_conf.password = self._get_password(host)
         script_conf.host_conf.access_key = self._get_access_key(host)
+        script_conf.host_conf.compress_transfer = bool_parse(host.get('compressTransfer', False))
+        script_conf.host_conf.single_round_trip = bool_parse(host.get('singleRoundTrip', False))
+        script_conf.host_conf.transfer_method = (host.get('transferMethod') or 'scp').lower()
+        script_conf.host_conf.sftp_request_size = int_parse(host.get('sftpRequestSize'),
+                                                           'hostsDetails[0].sftpRequestSize')
+        script_conf.host_conf.output_buffer_kb = int_parse(host.get('outputBufferKb'), 'hostsDetails[0].outputBufferKb')
+        script_conf.host_conf.output_tail_kb = int_parse(host.get('outputTailKb'), 'hostsDetails[0].outputTailKb')
+        script_conf.host_conf.env_file = bool_parse(host.get('envFile', False))
+        script_conf.host_conf.upload_parallelism = int_parse(host.get('uploadParallelism'),
+                                                             'hostsDetails[0].uploadParallelism')
         if host.get('parameters'):
             all_params_dict = dict((i['name'], i['value']) for i in host['parameters'])
             script_conf.host_conf.parameters = all_params_dict
@@ -137,11 +191,7 @@ class ScriptConfigurationParser(object):
             if json_obj.get('timeoutMinutes') < 0:
                 raise SyntaxError(basic_msg + 'Node "timeoutMinutes" must be greater/equal to zero.')
 
-        if json_obj.get('repositoryDetails') is None:
-            raise SyntaxError(basic_msg + 'Missing "repositoryDetails" node.')
-
-        if not json_obj.get('repositoryDetails').get('url'):
-            raise SyntaxError(basic_msg + 'Missing/Empty "repositoryDetails.url" node.')
+        ScriptConfigurationParser._validate_repository(json_obj)
 
         if not json_obj.get('hostsDetails'):
             raise SyntaxError(basic_msg + 'Missing/Empty "hostsDetails" node.')
@@ -158,6 +208,19 @@ class ScriptConfigurationParser(object):
         if json_obj.get('hostsDetails')[0].get('ip') == "NA":
             raise ValueError(basic_msg + 'HostDetails IP is NA, will not be able to connect.')
 
+    @staticmethod
+    def _validate_repository(json_obj):
+        """
+        :type json_obj: dict
+        """
+        basic_msg = 'Failed to parse script configuration input json: '
+
+        if json_obj.get('repositoryDetails') is None:
+            raise SyntaxError(basic_msg + 'Missing "repositoryDetails" node.')
+
+        if not json_obj.get('repositoryDetails').get('url'):
+            raise SyntaxError(basic_msg + 'Missing/Empty "repositoryDetails.url" node.')
+
     def get_pretty_json(self):
         return json.dumps(self, default=lambda o: getattr(o, '__dict__', str(o)), indent=4)
 
@@ -167,3 +230,21 @@ def bool_parse(b):
         return None
     else:
         return str(b).lower() == 'true'
+
+
+def int_parse(value, node_name):
+    """
+    Parses an optional non negative integer node, which may arrive as a json number or string.
+    :type node_name: str
+    :rtype int
+    """
+    if value is None or value == '':
+        return None
+    msg = 'Failed to parse script configuration input json: Node "%s" must be a non negative integer.' % node_name
+    try:
+        parsed = int(value)
+    except (TypeError, ValueError):
+        raise SyntaxError(msg)
+    if parsed < 0:
+        raise SyntaxError(msg)
+    return parsed
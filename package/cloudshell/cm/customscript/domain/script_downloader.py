@@ -1,14 +1,23 @@
+import itertools
+import posixpath
 import urllib
+from Queue import Queue, Empty
 from logging import Logger
+from threading import Thread, Lock, Event
 
 import re
 import requests
+import time
 
 from cloudshell.cm.customscript.domain.cancellation_sampler import CancellationSampler
-from cloudshell.cm.customscript.domain.script_file import ScriptFile
+from cloudshell.cm.customscript.domain.download_policy import RetryPolicy, MirrorLatencyTracker
+from cloudshell.cm.customscript.domain.http_session_pool import HttpSessionPool
+from cloudshell.cm.customscript.domain.script_bundle import ScriptBundle, get_bundle_format
+from cloudshell.cm.customscript.domain.script_cache import ScriptCache
+from cloudshell.cm.customscript.domain.script_file import ScriptFile, StreamedScriptFile
 from cloudshell.cm.customscript.domain.script_configuration import ScriptConfiguration
 from cloudshell.cm.customscript.domain.sandbox_reporter import SandboxReporter
-from cloudshell.cm.customscript.domain.gitlab_api_url_validator import is_gitlab_rest_url
+from cloudshell.cm.customscript.domain.gitlab_api_url_validator import is_gitlab_rest_url, is_gitlab_archive_url
 
 
 class HttpAuth(object):
@@ -19,16 +28,29 @@ class HttpAuth(object):
 
 class ScriptDownloader(object):
     CHUNK_SIZE = 1024 * 1024
+    STREAM_CHUNK_SIZE = 64 * 1024
+    CONNECT_TIMEOUT_SECONDS = 10
+    READ_TIMEOUT_SECONDS = 60
+    HEDGE_DELAY_SECONDS = 2
+    WAIT_INTERVAL_SECONDS = 1
 
-    def __init__(self, script_config, reporter, cancel_sampler):
+    def __init__(self, script_config, reporter, cancel_sampler, script_cache=None, session_pool=None,
+                 latency_tracker=None):
         """
         :type script_config: ScriptConfiguration
         :type reporter: SandboxReporter
         :type cancel_sampler: CancellationSampler
+        :type script_cache: ScriptCache
+        :type session_pool: HttpSessionPool
+        :type latency_tracker: MirrorLatencyTracker
         """
         self.script_config = script_config
         self.reporter = reporter
         self.cancel_sampler = cancel_sampler
+        self.script_cache = script_cache
+        self.session_pool = session_pool
+        self.latency_tracker = latency_tracker
+        self.retry_policy = RetryPolicy()
         self.filename_pattern = "(?P<filename>\s*[\w,\s-]+\.(sh|bash|ps1)\s*)"
         self.filename_patterns = {
             "content-disposition": "\s*((?i)inline|attachment|extension-token)\s*;\s*filename=" + self.filename_pattern,
@@ -54,14 +76,45 @@ class ScriptDownloader(object):
         :rtype ScriptFile
         """
         script_repo = self.script_config.script_repo
+        if not script_repo.entry_point:
+            if is_gitlab_archive_url(script_repo.url):
+                raise Exception("Gitlab archive url requires an 'entryPoint' script in the repository details")
+            return self._download(self.script_config.stream_transfer)
+
+        # a bundle is listed (and later repacked) as a whole, so it is never streamed
+        script_file = self._download(stream_transfer=False,
+                                     file_name=posixpath.basename(script_repo.entry_point.replace('\\', '/')))
+        try:
+            self._resolve_bundle(script_file, script_repo.entry_point)
+        except:
+            script_file.close()
+            raise
+        return script_file
+
+    def _download(self, stream_transfer, file_name=None, use_cache=True):
+        """
+        :type stream_transfer: bool
+        :param str file_name: the name to give the downloaded file, detected from the response when None
+        :param bool use_cache: False when the cached copy could not be read, and the download is repeated
+        :rtype ScriptFile
+        """
+        script_repo = self.script_config.script_repo
         repo_url = script_repo.url
-        is_gitlab_url = is_gitlab_rest_url(repo_url)
+        is_gitlab_url = self._is_gitlab_url(repo_url)
+
+        cache_entry = None
+        cache_key = None
+        headers = {'Accept-Encoding': 'gzip'}
+        if self.script_cache and use_cache and not script_repo.bypass_cache:
+            cache_key = ScriptCache.get_key(repo_url, script_repo.username, script_repo.password)
+            cache_entry = self.script_cache.get(cache_key)
+            if cache_entry:
+                headers.update(cache_entry.get_conditional_headers())
 
         if is_gitlab_url:
             # GITLAB REST API CALL - ADDING TOKEN HEADER
             self.reporter.info_out("downloading script via Gitlab Rest call: {}".format(repo_url))
-            headers = {"PRIVATE-TOKEN": script_repo.password}
-            response = requests.get(repo_url, stream=True, verify=False, headers=headers)
+            auth = None
         else:
             # STANDARD FLOW (GITHUB etc)
             auth = self._get_auth_and_validate(script_repo.username, script_repo.password)
@@ -69,22 +122,245 @@ class ScriptDownloader(object):
                 self.reporter.info_out("downloading script from 'auth' url: {}".format(script_repo.url))
             else:
                 self.reporter.info_out("downloading script from 'no-auth' url: {}".format(script_repo.url))
-            response = requests.get(script_repo.url, auth=auth, stream=True, verify=False)
+
+        urls = [repo_url] + [url for url in (script_repo.mirrors or []) if url != repo_url]
+        if self.latency_tracker:
+            urls = self.latency_tracker.order(urls)
+        response = self._get_response(urls, headers, auth)
+
+        if self.latency_tracker and len(urls) > 1:
+            self.reporter.info_out(self.latency_tracker.get_stats_message(), log_only=True)
+
+        if self.session_pool:
+            self.reporter.info_out(self.session_pool.get_stats_message(), log_only=True)
+
+        if cache_entry and response.status_code == 304:
+            response.close()
+            script_file = self.script_cache.read(cache_entry, self.reporter)
+            if script_file is None:
+                return self._download(stream_transfer, file_name, use_cache=False)
+            self.script_cache.mark_hit(cache_entry, self.reporter)
+            self.reporter.info_out("file not modified, using cached copy: {}".format(cache_entry.file_name))
+            self.reporter.info_out(self.script_cache.get_stats_message(), log_only=True)
+            return script_file
 
         self._validate_response_status_code(response)
-        self._invalidate_gitlab_login_page(response.url, response.content)
 
-        file_name = self._get_filename(response)
-        file_txt = ''
+        chunk_size = ScriptDownloader.STREAM_CHUNK_SIZE if stream_transfer else ScriptDownloader.CHUNK_SIZE
+        chunks = self._iter_response(response, chunk_size)
+        first_chunk = next(chunks, '')
+        # validating the first bytes, no need to download a whole html page
+        try:
+            self._invalidate_gitlab_login_page(response.url, first_chunk)
+            self._invalidate_html(first_chunk)
+        except Exception:
+            chunks.close()
+            raise
+        file_name = file_name or self._get_filename(response)
+
+        def on_complete(script_file):
+            self.reporter.info_out("file downloaded: {} ({} bytes)".format(script_file.name, script_file.size))
+            if cache_key:
+                self.script_cache.put(cache_key, script_file,
+                                      etag=response.headers.get('ETag'),
+                                      last_modified=response.headers.get('Last-Modified'),
+                                      reporter=self.reporter)
+                self.reporter.info_out(self.script_cache.get_stats_message(), log_only=True)
+
+        if stream_transfer:
+            self.reporter.info_out("streaming script: {}".format(file_name))
+            return StreamedScriptFile(file_name, itertools.chain([first_chunk], chunks),
+                                      expected_size=self._get_content_length(response),
+                                      cancel_sampler=self.cancel_sampler, on_complete=on_complete,
+                                      on_close=chunks.close)
+
+        script_file = ScriptFile(name=file_name, text=first_chunk)
+        try:
+            for chunk in chunks:
+                script_file.write(chunk)
+                self.cancel_sampler.throw_if_canceled()
+        finally:
+            chunks.close()
+        on_complete(script_file)
+        return script_file
+
+    def _resolve_bundle(self, script_file, entry_point):
+        """
+        Validates the downloaded archive, and resolves its entry point script.
+        :type script_file: ScriptFile
+        :type entry_point: str
+        """
+        bundle_format = get_bundle_format(script_file.head(512))
+        if not bundle_format:
+            raise Exception('Failed to download script bundle: url does not point to a tar or zip archive')
+        script_file.bundle_format = bundle_format
+        bundle = ScriptBundle(script_file, bundle_format)
+        try:
+            script_file.entry_point = bundle.find_entry_point(entry_point)
+        finally:
+            bundle.close()
+        script_file.name = posixpath.basename(script_file.entry_point)
+        self.reporter.info_out("script bundle entry point: {}".format(script_file.entry_point))
+
+    def _is_gitlab_url(self, url):
+        """
+        :type url: str
+        :rtype bool
+        """
+        return is_gitlab_rest_url(url) or is_gitlab_archive_url(url)
+
+    def _get_response(self, urls, headers, auth):
+        """
+        :type urls: list[str]
+        :type headers: dict
+        :type auth: tuple
+        :rtype requests.Response
+        """
+        attempts = self.retry_policy.attempts
+        for attempt in range(0, attempts):
+            try:
+                response = self._race(urls, headers, auth)
+                if response.status_code < 500 or attempt == attempts - 1:
+                    return response
+                response.close()
+                error_msg = '{} {}'.format(response.status_code, response.reason)
+            except requests.RequestException as e:
+                if attempt == attempts - 1:
+                    raise
+                error_msg = str(e)
+            delay = self.retry_policy.get_delay(attempt)
+            self.reporter.info_out("download attempt {} failed ({}), retrying in {:.1f} seconds".format(
+                attempt + 1, error_msg, delay), log_only=True)
+            self._sleep(delay)
 
-        for chunk in response.iter_content(ScriptDownloader.CHUNK_SIZE):
-            if chunk:
-                file_txt += ''.join(chunk)
+    def _race(self, urls, headers, auth):
+        """
+        Requests the first url, and hedges with the next one whenever no headers arrived within HEDGE_DELAY_SECONDS
+        (or right away when a request fails). The first good (2xx/304) response wins, the other responses are closed.
+        An error status (e.g. a mirror's fast 404) only wins when every url failed, the last one is returned then.
+        :type urls: list[str]
+        :type headers: dict
+        :type auth: tuple
+        :rtype requests.Response
+        """
+        results = Queue()
+        lock = Lock()
+        finished = Event()
+
+        def fetch(url):
+            start_time = time.time()
+            try:
+                result = (url, self._request(url, headers, auth), None, time.time() - start_time)
+            except Exception as e:
+                result = (url, None, e, time.time() - start_time)
+            with lock:
+                if not finished.is_set():
+                    results.put(result)
+                    return
+            if result[1] is not None:
+                result[1].close()
+
+        pending = list(urls)
+        running = 0
+        last_start_time = 0
+        failed_response = None
+        error = None
+        try:
+            while pending or running:
+                self.cancel_sampler.throw_if_canceled()
+                wait_seconds = ScriptDownloader.WAIT_INTERVAL_SECONDS
+                if pending:
+                    wait_seconds = last_start_time + ScriptDownloader.HEDGE_DELAY_SECONDS - time.time()
+                    if running == 0 or wait_seconds <= 0:
+                        url = pending.pop(0)
+                        if running:
+                            self.reporter.info_out("no response yet, trying mirror: {}".format(url), log_only=True)
+                        thread = Thread(target=fetch, args=(url,), name='script-download-request')
+                        thread.daemon = True
+                        thread.start()
+                        running += 1
+                        last_start_time = time.time()
+                        continue
+                try:
+                    url, response, error, elapsed = results.get(timeout=wait_seconds)
+                except Empty:
+                    continue
+                running -= 1
+                if error or not ScriptDownloader._is_good_response(response):
+                    if self.latency_tracker:
+                        self.latency_tracker.record_failure(url)
+                    self.reporter.info_out("failed to download from {}: {}".format(
+                        url, error or response.status_code), log_only=True)
+                    if response is not None:
+                        if failed_response is not None:
+                            failed_response.close()
+                        failed_response = response
+                    last_start_time = 0
+                    continue
+                if self.latency_tracker:
+                    self.latency_tracker.record(url, elapsed)
+                if failed_response is not None:
+                    failed_response.close()
+                return response
+        finally:
+            with lock:
+                finished.set()
+                while not results.empty():
+                    response = results.get()[1]
+                    if response is not None:
+                        response.close()
+
+        if failed_response is not None:
+            return failed_response
+        raise error
+
+    @staticmethod
+    def _is_good_response(response):
+        """
+        :type response: requests.Response
+        :rtype bool
+        """
+        return 200 <= response.status_code < 300 or response.status_code == 304
+
+    def _request(self, url, headers, auth):
+        """
+        :type url: str
+        :type headers: dict
+        :type auth: tuple
+        :rtype requests.Response
+        """
+        http = self.session_pool.get_session(url) if self.session_pool else requests
+        timeout = (ScriptDownloader.CONNECT_TIMEOUT_SECONDS, ScriptDownloader.READ_TIMEOUT_SECONDS)
+        if self._is_gitlab_url(url):
+            headers = dict(headers, **{"PRIVATE-TOKEN": self.script_config.script_repo.password})
+            return http.get(url, stream=True, verify=False, headers=headers, timeout=timeout)
+        return http.get(url, auth=auth, stream=True, verify=False, headers=headers, timeout=timeout)
+
+    def _sleep(self, seconds):
+        end_time = time.time() + seconds
+        while time.time() < end_time:
             self.cancel_sampler.throw_if_canceled()
+            time.sleep(min(ScriptDownloader.WAIT_INTERVAL_SECONDS, max(end_time - time.time(), 0)))
+
+    def _iter_response(self, response, chunk_size):
+        try:
+            for chunk in response.iter_content(chunk_size):
+                if chunk:
+                    yield chunk
+        finally:
+            response.close()
 
-        self._invalidate_html(file_txt)
-        self.reporter.info_out("file downloaded: {}".format(file_name))
-        return ScriptFile(name=file_name, text=file_txt)
+    def _get_content_length(self, response):
+        """
+        The size of the decoded content, when the server tells it.
+        :rtype int
+        """
+        if response.headers.get('Content-Encoding', 'identity').lower() != 'identity':
+            return None
+        try:
+            return int(response.headers['Content-Length'])
+        except (KeyError, ValueError):
+            return None
 
     def _validate_response_status_code(self, response):
         if response.status_code < 200 or response.status_code > 300:
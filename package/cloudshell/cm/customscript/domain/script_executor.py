@@ -26,6 +26,19 @@ class IScriptExecutor(object):
         """
         pass
 
+    def get_connection_address(self):
+        """
+        The (ip, port) which 'connect' connects to, probed for reachability before connecting. None skips the probe.
+        :rtype tuple
+        """
+        return None
+
+    def close(self):
+        """
+        Releases the connection to the target machine (back to its pool, when pooled).
+        """
+        pass
+
 
 class ErrorMsg(object):
     CREATE_TEMP_FOLDER = 'Failed to create temp folder on target machine. Error: ' + os.linesep + '%s'
@@ -1,17 +1,25 @@
 from cloudshell.cm.customscript.domain.linux_script_executor import LinuxScriptExecutor
+from cloudshell.cm.customscript.domain.psrp_script_executor import PSRPScriptExecutor
 from cloudshell.cm.customscript.domain.windows_script_executor import WindowsScriptExecutor
 
 
 class ScriptExecutorSelector(object):
     @staticmethod
-    def get(host_conf, logger, cancel_sampler):
+    def get(host_conf, logger, cancel_sampler, ssh_connection_pool=None, worker_pool=None, reporter=None,
+            winrm_session_pool=None):
         """
         :type host_conf: HostConfiguration
         :type logger: Logger
         :type cancel_sampler: CancellationSampler
+        :type ssh_connection_pool: ConnectionPool
+        :type worker_pool: WorkerPool
+        :type reporter: SandboxReporter
+        :type winrm_session_pool: ConnectionPool
         :rtype IScriptExecutor
         """
         if host_conf.connection_method == 'ssh':
-            return LinuxScriptExecutor(logger, host_conf, cancel_sampler)
+            return LinuxScriptExecutor(logger, host_conf, cancel_sampler, ssh_connection_pool, worker_pool, reporter)
+        elif host_conf.connection_method == 'psrp':
+            return PSRPScriptExecutor(logger, host_conf, cancel_sampler)
         else:
-            return WindowsScriptExecutor(logger, host_conf, cancel_sampler)
+            return WindowsScriptExecutor(logger, host_conf, cancel_sampler, worker_pool, winrm_session_pool)
@@ -1,5 +1,248 @@
+import hashlib
+from gzip import GzipFile
+from tempfile import SpooledTemporaryFile
+from threading import Condition, Thread, current_thread
+
 
 class ScriptFile(object):
+    """
+    File-like holder of the script content.
+    Small scripts are kept in memory, larger ones are spooled to a temp file, so the content is never held as one
+    big string. The size and the sha256 of the content are computed while it is written.
+    """
+    SPOOL_MAX_SIZE = 1024 * 1024
+    COPY_CHUNK_SIZE = 64 * 1024
+
     def __init__(self, name = None, text = None):
         self.name = name
-        self.text = text
\ No newline at end of file
+        self.size = 0
+        # set for multi-file bundles: the archive format, and the path of the script to run inside the archive
+        self.bundle_format = None
+        self.entry_point = None
+        self._hash = hashlib.sha256()
+        self._stream = SpooledTemporaryFile(max_size=ScriptFile.SPOOL_MAX_SIZE)
+        if text:
+            self.write(text)
+
+    @property
+    def sha256(self):
+        """
+        :rtype str
+        """
+        return self._hash.hexdigest()
+
+    @property
+    def expected_size(self):
+        """
+        The final size of the file, or None when it is not known yet.
+        :rtype int
+        """
+        return self.size
+
+    def wait_complete(self):
+        """
+        Blocks until all the content was written.
+        """
+        pass
+
+    @property
+    def text(self):
+        """
+        The whole content as one string, prefer 'iter_chunks' or 'read' for anything but small scripts.
+        :rtype str
+        """
+        self.seek(0)
+        return self.read()
+
+    def write(self, data):
+        """
+        Appends data to the end of the file.
+        :type data: str
+        """
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self._stream.seek(0, 2)
+        self._stream.write(data)
+        self.size += len(data)
+        self._hash.update(data)
+
+    def read(self, size=-1):
+        """
+        :type size: int
+        :rtype str
+        """
+        return self._stream.read(size)
+
+    def seek(self, offset, whence=0):
+        self._stream.seek(offset, whence)
+
+    def tell(self):
+        return self._stream.tell()
+
+    def head(self, size):
+        """
+        Returns the first 'size' bytes of the file.
+        :type size: int
+        :rtype str
+        """
+        self.seek(0)
+        return self.read(size)
+
+    def iter_chunks(self, chunk_size):
+        """
+        Iterates the whole content from its beginning.
+        :type chunk_size: int
+        :rtype collections.Iterable[str]
+        """
+        self.seek(0)
+        while True:
+            chunk = self.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def flush(self):
+        pass
+
+    def compress(self):
+        """
+        Returns a gzip compressed copy of the content, named '<name>.gz'.
+        :rtype ScriptFile
+        """
+        compressed = ScriptFile(name=self.name + '.gz')
+        gzip_file = GzipFile(filename=self.name, mode='wb', fileobj=compressed)
+        for chunk in self.iter_chunks(ScriptFile.COPY_CHUNK_SIZE):
+            gzip_file.write(chunk)
+        gzip_file.close()
+        return compressed
+
+    def close(self):
+        self._stream.close()
+
+
+class StreamedScriptFile(ScriptFile):
+    """
+    ScriptFile which is filled by a background thread while it is being read.
+    Readers get each chunk as soon as it arrives (or block until it does), so the upload to the target host
+    overlaps the download from the repo. The content is still spooled, so it can be read again when complete.
+    """
+    WAIT_INTERVAL = 1
+
+    def __init__(self, name, chunks, expected_size=None, cancel_sampler=None, on_complete=None, on_close=None):
+        """
+        :type name: str
+        :type chunks: collections.Iterable[str]
+        :type expected_size: int
+        :type cancel_sampler: CancellationSampler
+        :param on_complete: called (from the background thread) with this file once all the content was written
+        :param on_close: called (from the background thread) once the chunks are no longer read, whether the download
+                         completed, failed or was stopped, to release their source (e.g. the http response)
+        """
+        ScriptFile.__init__(self, name)
+        self._expected_size = expected_size
+        self._cancel_sampler = cancel_sampler
+        self._on_complete = on_complete
+        self._on_close = on_close
+        self._condition = Condition()
+        self._position = 0
+        self._done = False
+        self._closed = False
+        self._error = None
+        self._thread = Thread(target=self._fill, args=(chunks,), name='script-download-' + str(name))
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def expected_size(self):
+        with self._condition:
+            return self.size if self._done else self._expected_size
+
+    @property
+    def text(self):
+        self.wait_complete()
+        return ScriptFile.text.fget(self)
+
+    def wait_complete(self):
+        with self._condition:
+            while not self._done:
+                self._condition.wait(StreamedScriptFile.WAIT_INTERVAL)
+            self._raise_if_failed()
+
+    def read(self, size=-1):
+        with self._condition:
+            while not self._done and (size < 0 or self._position + size > self.size):
+                self._condition.wait(StreamedScriptFile.WAIT_INTERVAL)
+            self._raise_if_failed()
+            self._stream.seek(self._position)
+            data = self._stream.read(size)
+            self._position += len(data)
+            return data
+
+    def seek(self, offset, whence=0):
+        with self._condition:
+            if whence == 0:
+                self._position = offset
+            elif whence == 1:
+                self._position += offset
+            else:
+                self.wait_complete()
+                self._position = self.size + offset
+
+    def tell(self):
+        return self._position
+
+    def iter_chunks(self, chunk_size):
+        offset = 0
+        while True:
+            with self._condition:
+                while not self._done and offset + chunk_size > self.size:
+                    self._condition.wait(StreamedScriptFile.WAIT_INTERVAL)
+                self._raise_if_failed()
+                self._stream.seek(offset)
+                chunk = self._stream.read(chunk_size)
+            if not chunk:
+                break
+            offset += len(chunk)
+            yield chunk
+
+    def close(self):
+        """
+        Stops the download, and waits for the background thread (and its 'on_complete', which may still be reading the
+        content) before the content is dropped.
+        """
+        with self._condition:
+            self._closed = True
+        if self._thread is not current_thread():
+            self._thread.join()
+        with self._condition:
+            ScriptFile.close(self)
+
+    def _fill(self, chunks):
+        try:
+            for chunk in chunks:
+                with self._condition:
+                    if self._closed:
+                        break
+                    if chunk:
+                        self._stream.seek(0, 2)
+                        ScriptFile.write(self, chunk)
+                        self._condition.notify_all()
+                if self._cancel_sampler:
+                    self._cancel_sampler.throw_if_canceled()
+            if not self._closed and self._expected_size is not None and self._expected_size != self.size:
+                raise Exception('Script download ended after %s bytes out of %s' % (self.size, self._expected_size))
+        except Exception as e:
+            with self._condition:
+                self._error = e
+        finally:
+            if self._on_close:
+                self._on_close()
+            with self._condition:
+                self._done = True
+                self._condition.notify_all()
+        if not self._error and not self._closed and self._on_complete:
+            self._on_complete(self)
+
+    def _raise_if_failed(self):
+        if self._error:
+            raise self._error
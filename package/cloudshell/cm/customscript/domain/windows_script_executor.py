@@ -1,40 +1,169 @@
 import base64
+import codecs
+from contextlib import contextmanager
 import os
+from threading import Lock, Event
 
-import time
-from multiprocessing.pool import ThreadPool
 from uuid import uuid4
 
 import re
+import time
 import winrm
 from logging import Logger
-import xml.etree.ElementTree as ET
-from winrm.exceptions import WinRMTransportError
+from winrm.exceptions import WinRMTransportError, WinRMOperationTimeoutError
 
-from cloudshell.cm.customscript.domain.reservation_output_writer import ReservationOutputWriter
+from cloudshell.cm.customscript.domain.clixml_decoder import ClixmlDecoder, decode_clixml
+from cloudshell.cm.customscript.domain.connection_pool import ConnectionPool
+from cloudshell.cm.customscript.domain.output_capture import OutputCapture, write_captured_output, get_artifact_prefix
+from cloudshell.cm.customscript.domain.reservation_output_writer import ReservationOutputWriter, BatchedOutputWriter
+from cloudshell.cm.customscript.domain.script_bundle import ScriptBundle, BundleFormat
 from cloudshell.cm.customscript.domain.script_configuration import HostConfiguration
 from cloudshell.cm.customscript.domain.script_executor import IScriptExecutor, ErrorMsg, ExcutorConnectionError
+from cloudshell.cm.customscript.domain.script_file import ScriptFile
+from cloudshell.cm.customscript.domain.winrm_uploader import WinRMUploader
+from cloudshell.cm.customscript.domain.worker_pool import WorkerPool, WorkerFuture
+from cloudshell.cm.customscript.domain.ws_man_counter import WSManRoundTripCounter
 from requests import ConnectionError, ConnectTimeout
+from urllib3.util.connection import is_connection_dropped
 
 
 class WindowsScriptExecutor(IScriptExecutor):
-    COPY_BULK_SIZE = 2000
+    CANCEL_POLL_INTERVAL_SECONDS = 0.2
+    ENV_FILE_NAME = 'customscript_env.ps1'
+    MIN_UPLOAD_PART_SIZE = 2 * 1024 * 1024
+    HTTP_PORT = 5985
+    HTTPS_PORT = 5986
 
-    def __init__(self, logger, target_host, cancel_sampler):
+    def __init__(self, logger, target_host, cancel_sampler, worker_pool=None, connection_pool=None):
         """
         :type logger: Logger
         :type target_host: HostConfiguration
         :type cancel_sampler: CancellationContext
+        :param WorkerPool worker_pool: runs the remote commands, the shared pool when not given
+        :param ConnectionPool connection_pool: authenticated winrm sessions shared across executions
         """
         self.logger = logger
         self.cancel_sampler = cancel_sampler
-        self.pool = ThreadPool(processes=1)
-        if target_host.connection_secured:
-            self.session = winrm.Session(target_host.ip, auth=(target_host.username, target_host.password), transport='ssl')
-        else:
-            self.session = winrm.Session(target_host.ip, auth=(target_host.username, target_host.password))
+        self.target_host = target_host
+        self.pool = worker_pool or WorkerPool.shared()
+        self.connection_pool = connection_pool
+        self._shell_id = None
+        # the receive loops and part uploads which were submitted to the worker pool, and may still use the session
+        self._in_flight = []
+        # a pooled session is acquired on connect
+        self._set_session(None if connection_pool else self._create_session())
+
+    @staticmethod
+    def is_session_alive(session):
+        """
+        Health check of a pooled session, without a round trip: at least one of its keep-alive http connections (which
+        are already authenticated) is still open.
+        :type session: winrm.Session
+        :rtype bool
+        """
+        http_session = session.protocol.transport.session
+        if http_session is None:
+            return False
+        for adapter in http_session.adapters.values():
+            pools = adapter.poolmanager.pools
+            for host_pool in filter(None, [pools.get(key) for key in pools.keys()]):
+                for connection in list(host_pool.pool.queue):
+                    if connection and not is_connection_dropped(connection):
+                        return True
+        return False
+
+    @staticmethod
+    def close_session(session):
+        """
+        Closes the http connections of a session.
+        :type session: winrm.Session
+        """
+        http_session = session.protocol.transport.session
+        if http_session is not None:
+            http_session.close()
+
+    def get_pool_key(self):
+        """
+        :rtype tuple
+        """
+        host, port = self.get_connection_address()
+        return (host, port, 'ssl' if self.target_host.connection_secured else 'plaintext', self.target_host.username,
+                ConnectionPool.get_credentials_fingerprint(self.target_host.password))
+
+    def get_connection_address(self):
+        """
+        :rtype tuple
+        """
+        if self.target_host.connection_secured:
+            return self.target_host.ip, WindowsScriptExecutor.HTTPS_PORT
+        return self.target_host.ip, WindowsScriptExecutor.HTTP_PORT
 
     def connect(self):
+        if self.connection_pool:
+            self._set_session(self.connection_pool.acquire(self.get_pool_key(), self._create_session,
+                                                           self.cancel_sampler))
+            self.logger.debug(self.connection_pool.get_stats_message())
+        try:
+            self._check_session()
+        except ExcutorConnectionError:
+            if self.connection_pool:
+                # a failing session is not released back to the pool, the next attempt acquires another one
+                self.connection_pool.discard(self.get_pool_key(), self.session)
+                self._set_session(None)
+            raise
+
+    def close(self):
+        if self.session is None:
+            return
+        if not self.connection_pool:
+            WindowsScriptExecutor.close_session(self.session)
+        elif not self._is_command_in_flight():
+            self.connection_pool.release(self.get_pool_key(), self.session)
+        else:
+            # a session which a stale worker (e.g. of a cancelled command) still uses is not shared with the next
+            # execution. Closing it only drops its connections (a later request would reconnect), the worker itself
+            # stops through its stop_event
+            self.connection_pool.discard(self.get_pool_key(), self.session)
+        self._set_session(None)
+
+    def _submit(self, func, args, queue):
+        """
+        Runs a function which uses the session on the worker pool.
+        :param bool queue: the function ends on its own (e.g. an upload part), and may wait for a busy worker
+        :rtype WorkerFuture
+        """
+        async_result = self.pool.apply_async(func, args=args, queue=queue)
+        self._in_flight = [r for r in self._in_flight if not r.ready()] + [async_result]
+        return async_result
+
+    def _is_command_in_flight(self):
+        """
+        :rtype bool
+        """
+        self._in_flight = [r for r in self._in_flight if not r.ready()]
+        return bool(self._in_flight)
+
+    def _create_session(self):
+        """
+        :rtype winrm.Session
+        """
+        if self.target_host.connection_secured:
+            return winrm.Session(self.target_host.ip, auth=(self.target_host.username, self.target_host.password), transport='ssl')
+        return winrm.Session(self.target_host.ip, auth=(self.target_host.username, self.target_host.password))
+
+    def _set_session(self, session):
+        """
+        :type session: winrm.Session
+        """
+        self.session = session
+        if session:
+            self.uploader = WinRMUploader(session.protocol, self.logger, self.cancel_sampler)
+            self.round_trip_counter = WSManRoundTripCounter.attach(session.protocol)
+        else:
+            self.uploader = None
+            self.round_trip_counter = None
+
+    def _check_session(self):
         try:
             uid = str(uuid4())
             result = self.session.run_cmd('@echo '+uid)
@@ -68,24 +197,48 @@ class WindowsScriptExecutor(IScriptExecutor):
         :type output_writer: ReservationOutputWriter
         :type print_output: bool
         """
-        self.logger.info('Creating temp folder on target machine ...')
-        tmp_folder = self.create_temp_folder()
-        self.logger.info('Done (%s).' % tmp_folder)
-
+        # all the commands of the execution run in one shell
+        start_round_trips = self.round_trip_counter.count
+        self._shell_id = self.session.protocol.open_shell()
         try:
-            self.logger.info('Copying "%s" (%s chars) to "%s" target machine ...' % (
-            script_file.name, len(script_file.text), tmp_folder))
-            self.copy_script(tmp_folder, script_file)
-            self.logger.info('Done.')
+            self.logger.info('Creating temp folder on target machine ...')
+            tmp_folder = self.create_temp_folder()
+            self.logger.info('Done (%s).' % tmp_folder)
+
+            try:
+                self.logger.info('Copying "%s" (%s bytes) to "%s" target machine ...' % (
+                script_file.name, script_file.expected_size, tmp_folder))
+                self.copy_script(tmp_folder, script_file)
+                self.logger.info('Done.')
+
+                self.logger.info('Running "%s" on target machine ...' % script_file.name)
+                self.run_script(tmp_folder, script_file, env_vars, output_writer, print_output)
+                self.logger.info('Done.')
 
-            self.logger.info('Running "%s" on target machine ...' % script_file.name)
-            self.run_script(tmp_folder, script_file, env_vars, output_writer, print_output)
-            self.logger.info('Done.')
+            finally:
+                self.logger.info('Deleting "%s" folder from target machine ...' % tmp_folder)
+                self.delete_temp_folder(tmp_folder)
+                self.logger.info('Done.')
+        finally:
+            shell_id, self._shell_id = self._shell_id, None
+            try:
+                self.session.protocol.close_shell(shell_id)
+            finally:
+                self.logger.info('WS-Man round trips: %s' % (self.round_trip_counter.count - start_round_trips))
 
+    @contextmanager
+    def _shell(self):
+        """
+        The shell of the running execution, or a shell for a single command when called outside of 'execute'.
+        """
+        if self._shell_id:
+            yield self._shell_id
+            return
+        shell_id = self.session.protocol.open_shell()
+        try:
+            yield shell_id
         finally:
-            self.logger.info('Deleting "%s" folder from target machine ...' % tmp_folder)
-            self.delete_temp_folder(tmp_folder)
-            self.logger.info('Done.')
+            self.session.protocol.close_shell(shell_id)
 
     def create_temp_folder(self):
         """
@@ -106,21 +259,239 @@ Write-Output $fullPath
         :type tmp_folder: str
         :type script_file: ScriptFile
         """
-        all_size = len(script_file.text)
-        bulk_zise = WindowsScriptExecutor.COPY_BULK_SIZE
-        bulks = [script_file.text[i:min(all_size,i+bulk_zise)] for i in range(0, all_size, bulk_zise)]
-        self.logger.debug("Bulks sizes (%s): %s" % (len(bulks), ', '.join([str(len(b)) for b in bulks])))
+        if script_file.bundle_format:
+            self._copy_bundle(tmp_folder, script_file)
+            return
+
+        if self.target_host.compress_transfer:
+            if self._can_decompress():
+                self._copy_compressed_script(tmp_folder, script_file)
+                return
+            self.logger.warning('GZipStream is not available on target machine, copying the script uncompressed.')
 
-        for bulk in bulks:
-            encoded_bulk = base64.b64encode(bulk.encode("utf-8"))
-            code = """
+        self._send_file(tmp_folder, script_file)
+
+    def _copy_compressed_script(self, tmp_folder, script_file):
+        """
+        :type tmp_folder: str
+        :type script_file: ScriptFile
+        """
+        compressed_file = script_file.compress()
+        try:
+            self.logger.info('Compressed "%s" from %s to %s bytes.' % (script_file.name, script_file.size, compressed_file.size))
+            self._send_file(tmp_folder, compressed_file)
+        finally:
+            compressed_file.close()
+        code = """
+$source = Join-Path "{0}" "{1}"
+$path   = Join-Path "{0}" "{2}"
+$in     = [System.IO.File]::OpenRead($source)
+$gzip   = New-Object System.IO.Compression.GZipStream($in, [System.IO.Compression.CompressionMode]::Decompress)
+$out    = [System.IO.File]::Create($path)
+try {{
+    $buffer = New-Object byte[] 65536
+    while (($read = $gzip.Read($buffer, 0, $buffer.Length)) -gt 0) {{ $out.Write($buffer, 0, $read) }}
+}}
+finally {{
+    $out.Close()
+    $gzip.Close()
+}}
+Remove-Item $source
+""".format(tmp_folder, compressed_file.name, script_file.name)
+        result = self._run_cancelable(code)
+        if result.status_code != 0:
+            raise Exception(ErrorMsg.COPY_SCRIPT % result.std_err)
+
+    def _copy_bundle(self, tmp_folder, script_file):
+        """
+        Uploads the bundle as one zip archive, and extracts it to the 'bundle' folder.
+        :type tmp_folder: str
+        :type script_file: ScriptFile
+        """
+        bundle = ScriptBundle(script_file, script_file.bundle_format)
+        try:
+            packed_file = bundle.repack(BundleFormat.ZIP)
+        finally:
+            bundle.close()
+        try:
+            self.logger.info('Packed the bundle of "%s" to %s bytes.' % (script_file.entry_point, packed_file.size))
+            self._send_file(tmp_folder, packed_file)
+        finally:
+            packed_file.close()
+        code = """
+$source = Join-Path "{0}" "{1}"
+$path   = Join-Path "{0}" "{2}"
+try {{
+    Add-Type -AssemblyName System.IO.Compression.FileSystem
+    [System.IO.Compression.ZipFile]::ExtractToDirectory($source, $path)
+}}
+catch {{
+    New-Item $path -type directory -force | Out-Null
+    $shell = New-Object -ComObject Shell.Application
+    $shell.Namespace($path).CopyHere($shell.Namespace($source).Items(), 16)
+}}
+Remove-Item $source
+""".format(tmp_folder, packed_file.name, ScriptBundle.FOLDER_NAME)
+        result = self._run_cancelable(code)
+        if result.status_code != 0:
+            raise Exception(ErrorMsg.COPY_SCRIPT % result.std_err)
+
+    def _send_file(self, tmp_folder, script_file):
+        """
+        Uploads the file through the stdin of one PowerShell process, in envelope sized chunks.
+        Big files are uploaded in parts over concurrent shells when 'upload_parallelism' is set.
+        :type tmp_folder: str
+        :type script_file: ScriptFile
+        """
+        parts = self._get_upload_parts(script_file)
+        if parts > 1:
+            self._send_file_in_parts(tmp_folder, script_file, parts)
+            return
+        with self._shell() as shell_id:
+            std_out, std_err, status_code = self.uploader.upload(shell_id, tmp_folder, script_file)
+        if status_code != 0:
+            raise Exception(ErrorMsg.COPY_SCRIPT % self._try_decode_error_xml(std_err))
+
+    def _get_upload_parts(self, script_file):
+        """
+        The number of parts to upload the file in: up to the configured parallelism, no more than the shells the
+        host allows per user, and no smaller than MIN_UPLOAD_PART_SIZE each.
+        :type script_file: ScriptFile
+        :rtype int
+        """
+        parallelism = self.target_host.upload_parallelism or 1
+        size = script_file.expected_size
+        if parallelism < 2 or size is None:
+            return 1
+        return max(1, min(parallelism, self.uploader.get_max_shells_per_user(),
+                          size // WindowsScriptExecutor.MIN_UPLOAD_PART_SIZE))
+
+    def _send_file_in_parts(self, tmp_folder, script_file, parts):
+        """
+        Uploads offset ranges of the file to part files, each over a shell of its own (the first over the shell of the
+        execution), then joins the parts on the target machine and verifies the SHA256 of the result.
+        The first failing part stops the others, each before its next chunk.
+        :type tmp_folder: str
+        :type script_file: ScriptFile
+        :type parts: int
+        """
+        size = script_file.expected_size
+        part_size = -(-size // parts)
+        read_lock = Lock()
+        stop_event = Event()
+        start_time = time.time()
+        with self._shell() as shell_id:
+            results = [self._submit(self._send_part, (shell_id if i == 0 else None, tmp_folder, script_file, i,
+                                                      i * part_size, part_size, read_lock, stop_event), queue=True)
+                       for i in range(parts)]
+            try:
+                error = self._wait_for_parts(results, stop_event)
+            finally:
+                stop_event.set()
+            if error:
+                raise error
+            elapsed = max(time.time() - start_time, 0.001)
+            self.logger.info('Uploaded "%s" (%s bytes) in %s parts in %.2f seconds (%.1f KB/s).' %
+                             (script_file.name, size, parts, elapsed, size / 1024.0 / elapsed))
+            result = self._run_cancelable(self._get_join_parts_code(tmp_folder, script_file, parts))
+        if result.status_code != 0:
+            raise Exception(ErrorMsg.COPY_SCRIPT % result.std_err)
+
+    def _get_join_parts_code(self, tmp_folder, script_file, parts):
+        """
+        Joins the part files, in order, and fails when the SHA256 of the result differs from the one of the file.
+        :type tmp_folder: str
+        :type script_file: ScriptFile
+        :type parts: int
+        :rtype str
+        """
+        script_file.wait_complete()
+        return """
 $path   = Join-Path "{0}" "{1}"
-$data   = [System.Convert]::FromBase64String("{2}")
-Add-Content -value $data -encoding byte -path $path
-""".format(tmp_folder, script_file.name, encoded_bulk)
-            result = self._run_cancelable(code)
-            if result.status_code != 0:
-                raise Exception(ErrorMsg.COPY_SCRIPT % result.std_err)
+$out    = [System.IO.File]::Create($path)
+try {{
+    $buffer = New-Object byte[] 65536
+    for ($i = 0; $i -lt {2}; $i++) {{
+        $part = "$path.part$i"
+        $in   = [System.IO.File]::OpenRead($part)
+        try {{
+            while (($read = $in.Read($buffer, 0, $buffer.Length)) -gt 0) {{ $out.Write($buffer, 0, $read) }}
+        }}
+        finally {{
+            $in.Close()
+        }}
+        Remove-Item $part
+    }}
+}}
+finally {{
+    $out.Close()
+}}
+$in     = [System.IO.File]::OpenRead($path)
+try {{
+    $hash = [System.BitConverter]::ToString([System.Security.Cryptography.SHA256]::Create().ComputeHash($in)).Replace('-', '')
+}}
+finally {{
+    $in.Close()
+}}
+if ($hash -ne '{3}') {{
+    Write-Error "SHA256 of the uploaded file is $hash instead of {3}"
+    exit 1
+}}
+""".format(tmp_folder, script_file.name, parts, script_file.sha256.upper())
+
+    def _wait_for_parts(self, results, stop_event):
+        """
+        Waits for the uploads of all the parts, the cancellation flag is sampled in between. The first failing part
+        sets 'stop_event', and the other parts (which stop before their next chunk) are waited for, so none of them
+        still writes to the temp folder when the error is raised.
+        :type results: list[WorkerFuture]
+        :type stop_event: Event
+        :return: the error of the first failing part, None when all succeeded
+        :rtype Exception
+        """
+        error = None
+        pending = list(results)
+        while pending:
+            if self.cancel_sampler.is_cancelled():
+                self.cancel_sampler.throw()
+            for async_result in [r for r in pending if r.ready()]:
+                pending.remove(async_result)
+                try:
+                    std_out, std_err, status_code = async_result.get()
+                    if status_code != 0:
+                        raise Exception(ErrorMsg.COPY_SCRIPT % self._try_decode_error_xml(std_err))
+                except Exception as e:
+                    if not error:
+                        error = e
+                        stop_event.set()
+            if pending:
+                pending[0].wait(WindowsScriptExecutor.CANCEL_POLL_INTERVAL_SECONDS)
+        return error
+
+    def _send_part(self, shell_id, tmp_folder, script_file, index, offset, size, read_lock, stop_event):
+        """
+        Runs on the worker pool, over the given shell or over a shell of its own.
+        :rtype tuple
+        """
+        name = '%s.part%d' % (script_file.name, index)
+        if shell_id:
+            return self.uploader.upload_part(shell_id, tmp_folder, name, script_file, offset, size, read_lock,
+                                             stop_event)
+        shell_id = self.session.protocol.open_shell()
+        try:
+            return self.uploader.upload_part(shell_id, tmp_folder, name, script_file, offset, size, read_lock,
+                                             stop_event)
+        finally:
+            self.session.protocol.close_shell(shell_id)
+
+    def _can_decompress(self):
+        """
+        :rtype bool
+        """
+        code = """
+if ('System.IO.Compression.GZipStream' -as [type]) { exit 0 } else { exit 1 }
+"""
+        return self._run_cancelable(code).status_code == 0
 
     def run_script(self, tmp_folder, script_file, env_vars, output_writer, print_output=True):
         """
@@ -131,19 +502,59 @@ Add-Content -value $data -encoding byte -path $path
         :type print_output: bool
         """
         code = ''
-        for key, value in (env_vars or {}).iteritems():
-            code += '\n$env:%s = "%s"' % (key, str(value))
-        code += """
+        if self.target_host.env_file:
+            # the parameters are uploaded to a file next to the script, and dot-sourced before it runs
+            self._send_file(tmp_folder, self._get_env_file(env_vars))
+            code += '\n. (Join-Path "{0}" "{1}")'.format(tmp_folder, WindowsScriptExecutor.ENV_FILE_NAME)
+        else:
+            for key, value in (env_vars or {}).iteritems():
+                code += '\n$env:%s = "%s"' % (key, str(value))
+        if script_file.entry_point:
+            # scripts of a bundle run from their own folder, so they can refer to the other files relatively
+            code += """
+$path = Join-Path (Join-Path "{0}" "{1}") '{2}'
+Set-Location (Split-Path $path)
+Invoke-Expression "& '$path'"
+""".format(tmp_folder, ScriptBundle.FOLDER_NAME, script_file.entry_point.replace('/', '\\').replace("'", "''"))
+        else:
+            code += """
 $path = Join-Path "{0}" "{1}"
 Invoke-Expression "& '$path'"
 """.format(tmp_folder, script_file.name)
-        result = self._run_cancelable(code)
-        if print_output:
-            output_writer.write(result.std_out)
-            output_writer.write(result.std_err)
+        tail_size = (self.target_host.output_tail_kb or 0) * 1024
+        buffer_size = (self.target_host.output_buffer_kb or 0) * 1024
+        captures = [OutputCapture(buffer_size, 'stdout'), OutputCapture(buffer_size, 'stderr')]
+        live_output = BatchedOutputWriter(output_writer) if print_output and not tail_size else None
+        try:
+            try:
+                result = self._run_cancelable(code, captures, live_output)
+            finally:
+                if live_output:
+                    live_output.close()
+            if live_output:
+                # stderr comes as CLIXML, it is written once decoded
+                output_writer.write(result.std_err)
+            write_captured_output(captures, output_writer, print_output, tail_size,
+                                  get_artifact_prefix(self.target_host.ip))
+        finally:
+            for capture in captures:
+                capture.close()
         if result.status_code != 0:
             raise Exception(ErrorMsg.RUN_SCRIPT % result.std_err)
 
+    def _get_env_file(self, env_vars):
+        """
+        Serializes the parameters to a PowerShell file (UTF-8, with a BOM so Windows PowerShell reads it as such),
+        with the values in single quotes so they are taken literally.
+        :type env_vars: dict
+        :rtype ScriptFile
+        """
+        lines = []
+        for key, value in sorted((env_vars or {}).iteritems()):
+            value = value if isinstance(value, unicode) else str(value).decode('utf-8')
+            lines.append(u"$env:%s = '%s'\r\n" % (key, value.replace("'", "''")))
+        return ScriptFile(WindowsScriptExecutor.ENV_FILE_NAME, codecs.BOM_UTF8 + u''.join(lines).encode('utf-8'))
+
     def delete_temp_folder(self, tmp_folder):
         """
         :type tmp_folder: str
@@ -163,42 +574,92 @@ Remove-Item $path -recurse
     #     self.logger.debug('Stderr:' + result.std_err)
     #     return result
 
-    def _run_cancelable(self, ps_code):
+    def _run_cancelable(self, ps_code, captures=None, live_output=None):
         """
+        The output of the command is read while it runs, and captured in bounded memory. The result holds the
+        (possibly truncated) text.
         :type ps_code: str
+        :param list[OutputCapture] captures: the stdout and stderr captures, owned by the caller; temporary ones when
+        not given
+        :param BatchedOutputWriter live_output: forwards the stdout of the command while it runs
         """
         self.logger.debug('PowerShellScript:' + ps_code)
 
         bat_code = 'powershell -encodedcommand %s' % base64.b64encode(ps_code.encode('utf_16_le')).decode('ascii')
-        shell_id = self.session.protocol.open_shell()
-        command_id = self.session.protocol.run_command(shell_id, bat_code)
-
-        async_result = self.pool.apply_async(self.session.protocol.get_command_output, kwds={'shell_id': shell_id, 'command_id': command_id})
+        stdout_capture, stderr_capture = captures or (OutputCapture(name='stdout'), OutputCapture(name='stderr'))
+        # stderr is decoded as it arrives, the capture keeps it raw
+        stderr_decoder = ClixmlDecoder(stderr_capture.buffer_size, self.logger)
+        stop_event = Event()
         try:
-            while not async_result.ready():
-                if self.cancel_sampler.is_cancelled():
-                    self.cancel_sampler.throw()
-                time.sleep(1)
-            result = winrm.Response(async_result.get())
+            with self._shell() as shell_id:
+                command_id = self.session.protocol.run_command(shell_id, bat_code)
+
+                try:
+                    async_result = self._submit(self._receive_output, (shell_id, command_id, stdout_capture,
+                                                                       stderr_capture, live_output, stderr_decoder,
+                                                                       stop_event), queue=False)
+                    # wakes up as soon as the command completes, the cancellation flag is sampled in between
+                    while not async_result.ready():
+                        if self.cancel_sampler.is_cancelled():
+                            self.cancel_sampler.throw()
+                        async_result.wait(WindowsScriptExecutor.CANCEL_POLL_INTERVAL_SECONDS)
+                    status_code = async_result.get()
+                finally:
+                    # a receive loop which is still running (when cancelled) stops at its next response
+                    stop_event.set()
+                    self.session.protocol.cleanup_command(shell_id, command_id)
+
+            result = winrm.Response((stdout_capture.get_text(), stderr_capture.get_text(), status_code))
         finally:
-            self.session.protocol.cleanup_command(shell_id, command_id)
-            self.session.protocol.close_shell(shell_id)
+            if not captures:
+                stdout_capture.close()
+                stderr_capture.close()
 
         self.logger.debug('ReturnedCode:' + str(result.status_code))
         self.logger.debug('Stdout:' + result.std_out)
         self.logger.debug('Stderr:' + result.std_err)
-        result.std_err = self._try_decode_error_xml(result.std_err)
-        self.logger.debug('Stderr(Decoded):' + result.std_err)
+        stderr_decoder.close()
+        if stderr_decoder.documents:
+            result.std_err = stderr_decoder.get_text()
+            self.logger.debug('Stderr(Decoded):' + result.std_err)
         return result
 
-    def _try_decode_error_xml(self, str):
-        if str:
+    def _receive_output(self, shell_id, command_id, stdout_capture, stderr_capture, live_output, stderr_decoder=None,
+                        stop_event=None):
+        """
+        Reads the output of a command, one WS-Man Receive response at a time, until the command is done or
+        'stop_event' is set.
+        :type shell_id: str
+        :type command_id: str
+        :type stdout_capture: OutputCapture
+        :type stderr_capture: OutputCapture
+        :type live_output: BatchedOutputWriter
+        :type stderr_decoder: ClixmlDecoder
+        :type stop_event: Event
+        :return: the exit code of the command, None when stopped
+        :rtype int
+        """
+        while not (stop_event and stop_event.is_set()):
             try:
-                str = re.sub(re.escape('#< CLIXML'), '', str, 1)
-                root = ET.fromstring(str)
-                str = ''.join([e.text for e in root.findall('*/[@S="Error"]')])
-                str = re.sub('_x([0-9a-fA-F]{4})_', lambda match: unichr(int(match.group(1), 16)), str)
-                self.logger.error('Sucedded to decode stderr : ' + str)
-            except Exception as e:
-                self.logger.error('Failed to decode stderr. Error: %s' % e.message)
-        return str
\ No newline at end of file
+                std_out, std_err, status_code, command_done = \
+                    self.session.protocol._raw_get_command_output(shell_id, command_id)
+            except WinRMOperationTimeoutError:
+                # no output within the operation timeout, the command is still running
+                if live_output:
+                    live_output.flush_if_due()
+                continue
+            stdout_capture.write(std_out)
+            stderr_capture.write(std_err)
+            if stderr_decoder:
+                stderr_decoder.feed(std_err)
+            if live_output:
+                live_output.write(std_out, 'stdout')
+            if command_done:
+                return status_code
+
+    def _try_decode_error_xml(self, text):
+        """
+        :param str text: the stderr of a command, as is when it is not CLIXML
+        :rtype str
+        """
+        return decode_clixml(text, self.logger)
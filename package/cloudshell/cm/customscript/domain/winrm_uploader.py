@@ -0,0 +1,178 @@
+import base64
+import xml.etree.ElementTree as ET
+from threading import Lock
+
+import time
+import xmltodict
+from winrm.protocol import Protocol
+
+from cloudshell.cm.customscript.domain.cancellation_sampler import CancellationSampler
+from cloudshell.cm.customscript.domain.script_file import ScriptFile
+
+SHELL_RESOURCE_URI = 'http://schemas.microsoft.com/wbem/wsman/1/windows/shell/cmd'
+CONFIG_RESOURCE_URI = 'http://schemas.microsoft.com/wbem/wsman/1/config'
+SEND_ACTION = 'http://schemas.microsoft.com/wbem/wsman/1/windows/shell/Send'
+GET_ACTION = 'http://schemas.xmlsoap.org/ws/2004/09/transfer/Get'
+
+
+class WinRMUploader(object):
+    """
+    Uploads a file over WinRM through the stdin of a single PowerShell process, which writes it to the target path.
+    The file is sent in chunks as big as the host's MaxEnvelopeSizekb allows (WS-Man 'Send' operations), instead of
+    one shell and one process per small chunk.
+    """
+    DEFAULT_MAX_ENVELOPE_SIZE_KB = 150
+    DEFAULT_MAX_SHELLS_PER_USER = 5
+    ENVELOPE_OVERHEAD = 4 * 1024
+    RECEIVER_CODE = u"""
+$path   = Join-Path "{0}" "{1}"
+$in     = [System.Console]::OpenStandardInput()
+$out    = [System.IO.File]::Create($path)
+try {{
+    $buffer = New-Object byte[] 65536
+    while (($read = $in.Read($buffer, 0, $buffer.Length)) -gt 0) {{ $out.Write($buffer, 0, $read) }}
+}}
+finally {{
+    $out.Close()
+}}
+"""
+    _host_configs = {}  # endpoint -> the WS-Man config values read from the host, shared by all the uploaders
+    _host_configs_lock = Lock()
+
+    def __init__(self, protocol, logger, cancel_sampler):
+        """
+        :type protocol: Protocol
+        :type logger: Logger
+        :type cancel_sampler: CancellationSampler
+        """
+        self.protocol = protocol
+        self.logger = logger
+        self.cancel_sampler = cancel_sampler
+
+    def get_max_envelope_size_kb(self):
+        """
+        :rtype int
+        """
+        return self._get_host_config()['MaxEnvelopeSizekb']
+
+    def get_max_shells_per_user(self):
+        """
+        :rtype int
+        """
+        return self._get_host_config()['MaxShellsPerUser']
+
+    def _get_host_config(self):
+        """
+        Queries the host's WS-Man config once per endpoint. Reading the config may be denied to non-admin users, the
+        Windows defaults are assumed then.
+        :rtype dict
+        """
+        endpoint = getattr(self.protocol.transport, 'endpoint', None)
+        with WinRMUploader._host_configs_lock:
+            if endpoint in WinRMUploader._host_configs:
+                return WinRMUploader._host_configs[endpoint]
+        config = {'MaxEnvelopeSizekb': WinRMUploader.DEFAULT_MAX_ENVELOPE_SIZE_KB,
+                  'MaxShellsPerUser': WinRMUploader.DEFAULT_MAX_SHELLS_PER_USER}
+        try:
+            req = {'env:Envelope': self.protocol._get_soap_header(resource_uri=CONFIG_RESOURCE_URI, action=GET_ACTION)}
+            req['env:Envelope'].setdefault('env:Body', {})
+            root = ET.fromstring(self.protocol.send_message(xmltodict.unparse(req)))
+            for node in root.iter():
+                name = node.tag.split('}')[-1]
+                if name in config:
+                    config[name] = int(node.text)
+        except Exception as e:
+            self.logger.debug('Failed to read the WS-Man config, assuming %s. Error: %s' % (config, e))
+        with WinRMUploader._host_configs_lock:
+            WinRMUploader._host_configs[endpoint] = config
+        return config
+
+    def get_chunk_size(self):
+        """
+        The most file bytes which fit in one 'Send' envelope, after the base64 encoding.
+        :rtype int
+        """
+        return (self.get_max_envelope_size_kb() * 1024 - WinRMUploader.ENVELOPE_OVERHEAD) * 3 // 4
+
+    def upload(self, shell_id, folder, script_file):
+        """
+        :param str shell_id: an open shell to run the receiving process in
+        :param str folder: the folder on the target machine
+        :type script_file: ScriptFile
+        :return: the stdout, stderr and exit code of the receiving process
+        :rtype tuple
+        """
+        chunk_size = self.get_chunk_size()
+        return self._upload(shell_id, folder, script_file.name, script_file.iter_chunks(chunk_size), chunk_size)
+
+    def upload_part(self, shell_id, folder, name, script_file, offset, size, read_lock, stop_event=None):
+        """
+        Uploads 'size' bytes of the file, from 'offset', to a file of its own. Parts are uploaded concurrently over
+        different shells, and joined on the target machine.
+        :param str shell_id: an open shell to run the receiving process in
+        :param str folder: the folder on the target machine
+        :param str name: the name of the part file
+        :type script_file: ScriptFile
+        :type offset: int
+        :type size: int
+        :param Lock read_lock: serializes the reads of all the parts from the file
+        :param Event stop_event: set when another part failed, the part then stops before its next chunk
+        :return: the stdout, stderr and exit code of the receiving process
+        :rtype tuple
+        """
+        chunk_size = self.get_chunk_size()
+        return self._upload(shell_id, folder, name, self._iter_range(script_file, offset, size, chunk_size, read_lock),
+                            chunk_size, stop_event)
+
+    def _upload(self, shell_id, folder, name, chunks, chunk_size, stop_event=None):
+        code = WinRMUploader.RECEIVER_CODE.format(folder, name)
+        command = 'powershell -noninteractive -encodedcommand %s' % base64.b64encode(code.encode('utf_16_le')).decode('ascii')
+        command_id = self.protocol.run_command(shell_id, command, console_mode_stdin=False)
+        try:
+            start_time = time.time()
+            sent_chunks = 0
+            sent_size = 0
+            for chunk in chunks:
+                self.cancel_sampler.throw_if_canceled()
+                if stop_event and stop_event.is_set():
+                    raise Exception('The upload of "%s" was stopped' % name)
+                self.send(shell_id, command_id, chunk)
+                sent_chunks += 1
+                sent_size += len(chunk)
+            self.send(shell_id, command_id, '', end=True)
+            result = self.protocol.get_command_output(shell_id, command_id)
+            elapsed = max(time.time() - start_time, 0.001)
+            self.logger.info('Uploaded "%s" (%s bytes) in %.2f seconds (%.1f KB/s), %s chunks of up to %s bytes.' %
+                             (name, sent_size, elapsed, sent_size / 1024.0 / elapsed, sent_chunks, chunk_size))
+            return result
+        finally:
+            self.protocol.cleanup_command(shell_id, command_id)
+
+    def _iter_range(self, script_file, offset, size, chunk_size, read_lock):
+        end = offset + size
+        while offset < end:
+            with read_lock:
+                script_file.seek(offset)
+                chunk = script_file.read(min(chunk_size, end - offset))
+            if not chunk:
+                break
+            offset += len(chunk)
+            yield chunk
+
+    def send(self, shell_id, command_id, data, end=False):
+        """
+        Writes data to the stdin of a running command.
+        :type shell_id: str
+        :type command_id: str
+        :type data: str
+        :param bool end: closes the stdin after the data
+        """
+        req = {'env:Envelope': self.protocol._get_soap_header(resource_uri=SHELL_RESOURCE_URI, action=SEND_ACTION,
+                                                             shell_id=shell_id)}
+        stream = req['env:Envelope'].setdefault('env:Body', {}).setdefault('rsp:Send', {}).setdefault('rsp:Stream', {})
+        stream['@Name'] = 'stdin'
+        stream['@CommandId'] = command_id
+        stream['#text'] = base64.b64encode(data)
+        if end:
+            stream['@End'] = 'true'
+        self.protocol.send_message(xmltodict.unparse(req))
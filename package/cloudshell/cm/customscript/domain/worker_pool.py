@@ -0,0 +1,216 @@
+import atexit
+import sys
+import weakref
+from collections import deque
+from threading import Thread, Event, Lock, Condition, current_thread
+
+import time
+
+_started_pools = weakref.WeakSet()
+
+
+class WorkerFuture(object):
+    """
+    Result of a task submitted to the WorkerPool, with the interface of multiprocessing's AsyncResult.
+    """
+    def __init__(self):
+        self._event = Event()
+        self._value = None
+        self._exc_info = None
+
+    def ready(self):
+        """
+        :rtype bool
+        """
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        """
+        :type timeout: float
+        """
+        self._event.wait(timeout)
+
+    def get(self, timeout=None):
+        """
+        Returns the result of the task, or raises its error.
+        :type timeout: float
+        """
+        self.wait(timeout)
+        if not self.ready():
+            raise Exception('Timed out waiting for the task result')
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._value
+
+    def _set(self, value, exc_info):
+        self._value = value
+        self._exc_info = exc_info
+        self._event.set()
+
+
+class WorkerPoolFullError(Exception):
+    pass
+
+
+class WorkerPool(object):
+    """
+    Process-wide pool of named daemon threads, shared by all the script executors.
+    A worker is started when no idle worker is left, and an idle worker is reused by the next task, or stops after
+    'idle_timeout_seconds', so the number of threads follows the number of concurrent tasks instead of growing with
+    the number of executions.
+    With 'max_workers' the pool never grows beyond that many threads. A task of bounded length (e.g. an upload part)
+    then waits in a queue for a busy worker. A remote command blocks its worker for as long as it runs, so waiting
+    behind other executions' commands could take forever: it is submitted with queue=False and fails fast instead.
+    """
+    DEFAULT_IDLE_TIMEOUT_SECONDS = 60
+
+    _shared = None
+    _shared_lock = Lock()
+
+    def __init__(self, max_workers=None, name='customscript-worker', idle_timeout_seconds=DEFAULT_IDLE_TIMEOUT_SECONDS):
+        """
+        :param int max_workers: the most workers, no cap when not given
+        :type name: str
+        :type idle_timeout_seconds: float
+        """
+        self.max_workers = max_workers
+        self.name = name
+        self.idle_timeout_seconds = idle_timeout_seconds
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.max_queue_depth = 0
+        self._tasks = deque()
+        self._workers = []
+        self._started_workers = 0
+        self._busy_workers = 0
+        self._condition = Condition()
+        self._shutdown = False
+
+    @staticmethod
+    def shared():
+        """
+        The default pool, for executors which were not given one.
+        :rtype WorkerPool
+        """
+        with WorkerPool._shared_lock:
+            if WorkerPool._shared is None or WorkerPool._shared._shutdown:
+                WorkerPool._shared = WorkerPool()
+            return WorkerPool._shared
+
+    def apply_async(self, func, args=(), kwds=None, queue=True):
+        """
+        :param bool queue: wait for a worker when all the 'max_workers' are busy, raise WorkerPoolFullError otherwise
+        :rtype WorkerFuture
+        """
+        future = WorkerFuture()
+        with self._condition:
+            if self._shutdown:
+                raise Exception('Worker pool %s is shut down' % self.name)
+            idle_workers = len(self._workers) - self._busy_workers
+            can_start_worker = self.max_workers is None or len(self._workers) < self.max_workers
+            if not queue and idle_workers <= len(self._tasks) and not can_start_worker:
+                self.rejected += 1
+                raise WorkerPoolFullError('All the %s workers of %s are busy, try again later' %
+                                          (self.max_workers, self.name))
+            self.submitted += 1
+            self._tasks.append((future, func, args, kwds or {}))
+            if idle_workers < len(self._tasks) and can_start_worker:
+                self._start_worker()
+            self.max_queue_depth = max(self.max_queue_depth, len(self._tasks))
+            self._condition.notify()
+        return future
+
+    def get_stats(self):
+        """
+        :rtype dict
+        """
+        with self._condition:
+            return {'workers': len(self._workers),
+                    'busy': self._busy_workers,
+                    'queued': len(self._tasks),
+                    'max_queue_depth': self.max_queue_depth,
+                    'submitted': self.submitted,
+                    'completed': self.completed,
+                    'rejected': self.rejected}
+
+    def get_stats_message(self):
+        """
+        :rtype str
+        """
+        return '{name}: {workers} workers ({busy} busy), {queued} queued (max {max_queue_depth}), ' \
+               '{completed} of {submitted} tasks completed, {rejected} rejected'.format(name=self.name, **self.get_stats())
+
+    def shutdown(self, wait=True, timeout=None):
+        """
+        Stops the workers once the queued tasks are done, no tasks can be submitted afterwards.
+        :param bool wait: wait for the workers to stop
+        :param float timeout: the longest time to wait, a worker stuck on a remote command is left behind (as a daemon)
+        """
+        with self._condition:
+            if self._shutdown:
+                return
+            self._shutdown = True
+            workers = list(self._workers)
+            self._condition.notify_all()
+        if wait:
+            end_time = None if timeout is None else time.time() + timeout
+            for worker in workers:
+                worker.join(None if end_time is None else max(end_time - time.time(), 0))
+
+    def _start_worker(self):
+        # an idle worker which still waits for tasks while the interpreter tears down its modules fails there
+        _started_pools.add(self)
+        self._started_workers += 1
+        worker = Thread(target=self._work, name='%s-%d' % (self.name, self._started_workers))
+        worker.daemon = True
+        self._workers.append(worker)
+        worker.start()
+
+    def _get_task(self):
+        """
+        Waits for the next task, the task is taken and the worker marked busy at once, so a new task never counts on
+        a worker which is about to take another one.
+        :return: the task, or None when the worker should stop
+        """
+        with self._condition:
+            idle_since = time.time()
+            while not self._tasks and not self._shutdown:
+                remaining = self.idle_timeout_seconds - (time.time() - idle_since)
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            if not self._tasks:
+                self._workers.remove(current_thread())
+                return None
+            self._busy_workers += 1
+            return self._tasks.popleft()
+
+    def _work(self):
+        while True:
+            task = self._get_task()
+            if task is None:
+                break
+            future, func, args, kwds = task
+            value, exc_info = None, None
+            try:
+                value = func(*args, **kwds)
+            except BaseException:
+                exc_info = sys.exc_info()
+            with self._condition:
+                self.completed += 1
+                self._busy_workers -= 1
+            future._set(value, exc_info)
+
+
+@atexit.register
+def _shutdown_started_pools(timeout=1):
+    pools = list(_started_pools)
+    for pool in pools:
+        pool.shutdown(wait=False)
+    end_time = time.time() + timeout
+    for pool in pools:
+        with pool._condition:
+            workers = list(pool._workers)
+        for worker in workers:
+            worker.join(max(end_time - time.time(), 0))
@@ -0,0 +1,36 @@
+from threading import Lock
+
+from winrm.protocol import Protocol
+
+
+class WSManRoundTripCounter(object):
+    """
+    Counts the WS-Man messages sent with a winrm protocol, each one is an http round trip to the host.
+    """
+    def __init__(self):
+        self.count = 0
+        self._lock = Lock()
+
+    @staticmethod
+    def attach(protocol):
+        """
+        Wraps the 'send_message' of the protocol (once) with a counter.
+        :type protocol: Protocol
+        :rtype WSManRoundTripCounter
+        """
+        counter = vars(protocol).get('_round_trip_counter')
+        if counter is None:
+            counter = WSManRoundTripCounter()
+            send_message = protocol.send_message
+
+            def counting_send_message(message):
+                counter.increment()
+                return send_message(message)
+
+            protocol.send_message = counting_send_message
+            protocol._round_trip_counter = counter
+        return counter
+
+    def increment(self):
+        with self._lock:
+            self.count += 1
@@ -1,6 +1,30 @@
+import tarfile
+import zipfile
+from StringIO import StringIO
 
 class Any(object):
     def __init__(self, predicate=None):
         self.predicate = predicate
     def __eq__(self, other):
         return not self.predicate or self.predicate(other)
+
+
+def make_archive(files, bundle_format='tar'):
+    """
+    Builds an archive in memory, as a tar.gz or a zip.
+    :param dict files: member path -> content
+    :rtype str
+    """
+    data = StringIO()
+    if bundle_format == 'zip':
+        with zipfile.ZipFile(data, 'w') as archive:
+            for path, content in sorted(files.iteritems()):
+                archive.writestr(path, content)
+    else:
+        archive = tarfile.open(fileobj=data, mode='w:gz')
+        for path, content in sorted(files.iteritems()):
+            info = tarfile.TarInfo(path)
+            info.size = len(content)
+            archive.addfile(info, StringIO(content))
+        archive.close()
+    return data.getvalue()
@@ -0,0 +1,187 @@
+"""
+Fake of the pypsrp module for a Windows host, with the subset of its API PSRPScriptExecutor uses, which is patched in
+place of the import. It is not a server: there is no HTTP, WS-Man or PSRP traffic at all.
+The host's temp folder is a local temp folder, and the fixed scripts of the executor are carried out in python, picked
+by the script text and given the parameters as the executor passes them.
+The uploaded scripts are "run" by a tiny interpreter of Write-Output, Write-Error, throw and exit lines.
+
+What it does not cover, as it only follows the executor's own assumptions about pypsrp and PowerShell:
+- the WS-Man/PSRP messages, their encoding, fragmenting and the transport options (auth, TLS, timeouts)
+- how begin_invoke/poll_invoke/end_invoke behave against a real server, e.g. the states reported while a pipeline runs
+  or is stopped, and the errors of a lost connection
+- whether PowerShell binds the parameters of the fixed scripts as expected, and runs those scripts correctly
+Testing these needs a real Windows host.
+"""
+import base64
+import os
+import re
+import shutil
+import tempfile
+import uuid
+import zipfile
+from functools import partial
+
+from requests import ConnectionError
+
+from cloudshell.cm.customscript.domain.psrp_script_executor import PSRPScriptExecutor
+
+
+class PSInvocationState(object):
+    NOT_STARTED = 0
+    RUNNING = 1
+    STOPPING = 2
+    STOPPED = 3
+    COMPLETED = 4
+    FAILED = 5
+
+
+class StandInHost(object):
+    def __init__(self):
+        self.temp_folder = tempfile.mkdtemp()
+        self.refused_connections = 0
+        self.wsman_args = []
+        self.opened_runspaces = 0
+        self.closed_runspaces = 0
+        self.pipelines = []
+        self.on_poll = None
+        self.last_exit_code = 0
+        self.environment = {}
+
+    def get_pypsrp(self):
+        """
+        :return: what import_pypsrp returns, bound to this host
+        :rtype tuple
+        """
+        return partial(WSMan, self), RunspacePool, PowerShell, PSInvocationState
+
+    def close(self):
+        shutil.rmtree(self.temp_folder, ignore_errors=True)
+
+    def run_pipeline(self, script, parameters):
+        """
+        :return: the records of the pipeline, ('output'|'error'|'throw', text)
+        :rtype list[tuple]
+        """
+        self.pipelines.append((script, parameters))
+        if script == PSRPScriptExecutor.CREATE_TEMP_FOLDER_SCRIPT:
+            path = os.path.join(self.temp_folder, str(uuid.uuid4()))
+            os.mkdir(path)
+            return [('output', path)]
+        if script == PSRPScriptExecutor.APPEND_FILE_SCRIPT:
+            with open(os.path.join(parameters['Folder'], parameters['Name']), 'ab') as f:
+                f.write(base64.b64decode(parameters['Data']))
+            return []
+        if script == PSRPScriptExecutor.EXTRACT_BUNDLE_SCRIPT:
+            source = os.path.join(parameters['Folder'], parameters['Name'])
+            zipfile.ZipFile(source).extractall(os.path.join(parameters['Folder'], parameters['Destination']))
+            os.remove(source)
+            return []
+        if script == PSRPScriptExecutor.RUN_SCRIPT:
+            self.environment.update(parameters['Variables'])
+            self.last_exit_code = 0
+            path = os.path.join(parameters['Folder'], *parameters['Name'].split('\\'))
+            return self._interpret(open(path).read())
+        if script == PSRPScriptExecutor.GET_EXIT_CODE_SCRIPT:
+            return [('output', self.last_exit_code)]
+        if script == PSRPScriptExecutor.DELETE_TEMP_FOLDER_SCRIPT:
+            shutil.rmtree(parameters['Folder'])
+            return []
+        raise Exception('The stand-in does not know the script: %s' % script)
+
+    def _interpret(self, code):
+        records = []
+        for line in code.splitlines():
+            match = re.match(r"\s*(Write-Output|Write-Error|throw|exit)\s+(.*)$", line)
+            if not match:
+                continue
+            command, argument = match.groups()
+            if argument.startswith('$env:'):
+                argument = self.environment.get(argument[len('$env:'):], '')
+            else:
+                argument = argument.strip("'")
+            if command == 'Write-Output':
+                records.append(('output', argument))
+            elif command == 'Write-Error':
+                records.append(('error', argument))
+            elif command == 'throw':
+                records.append(('throw', argument))
+                break
+            else:
+                self.last_exit_code = int(argument)
+                break
+        return records
+
+
+class WSMan(object):
+    def __init__(self, host, server, port=None, username=None, password=None, ssl=True, **kwargs):
+        self.host = host
+        host.wsman_args.append((server, port, username, password, ssl))
+
+
+class RunspacePool(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.host = connection.host
+
+    def open(self):
+        if self.host.refused_connections:
+            self.host.refused_connections -= 1
+            raise ConnectionError('[Errno 111] Connection refused')
+        self.host.opened_runspaces += 1
+
+    def close(self):
+        self.host.closed_runspaces += 1
+
+
+class Streams(object):
+    def __init__(self):
+        self.error = []
+
+
+class PowerShell(object):
+    """
+    Releases one record of the pipeline per poll, as if they arrived in separate Receive responses.
+    """
+    def __init__(self, runspace_pool):
+        self.runspace_pool = runspace_pool
+        self.host = runspace_pool.host
+        self.state = PSInvocationState.NOT_STARTED
+        self.output = []
+        self.streams = Streams()
+        self._script = None
+        self._parameters = {}
+        self._records = []
+
+    def add_script(self, script):
+        self._script = script
+        return self
+
+    def add_parameter(self, name, value=None):
+        self._parameters[name] = value
+        return self
+
+    def begin_invoke(self):
+        self._records = self.host.run_pipeline(self._script, self._parameters)
+        self.state = PSInvocationState.RUNNING
+        if not self._records:
+            self.state = PSInvocationState.COMPLETED
+
+    def poll_invoke(self, timeout=None):
+        if self.host.on_poll:
+            self.host.on_poll(self)
+        if self.state != PSInvocationState.RUNNING:
+            return
+        kind, text = self._records.pop(0)
+        if kind == 'output':
+            self.output.append(text)
+        elif kind == 'error':
+            self.streams.error.append(text)
+        else:
+            self.streams.error.append(text)
+            self.state = PSInvocationState.FAILED
+            return
+        if not self._records:
+            self.state = PSInvocationState.COMPLETED
+
+    def stop(self):
+        self.state = PSInvocationState.STOPPED
@@ -0,0 +1,79 @@
+from unittest import TestCase
+
+from mock import Mock
+
+from cloudshell.cm.customscript.domain.clixml_decoder import ClixmlDecoder, decode_clixml
+
+DOCUMENT = '''#< CLIXML\r
+<Objs Version="1.1.0.1" xmlns="http://schemas.microsoft.com/powershell/2004/04">\
+<Obj S="progress" RefId="0"><TN RefId="0"><T>System.Management.Automation.PSCustomObject</T></TN>\
+<MS><I64 N="SourceId">1</I64><S N="StatusDescription">Preparing modules for first use.</S></MS></Obj>\
+<S S="Error">some error1_x000D__x000A_</S>\
+<S S="verbose">some verbose</S>\
+<S S="Error">some error2</S>\
+</Objs>'''
+
+
+class TestClixmlDecoder(TestCase):
+
+    def test_keeps_only_the_error_records(self):
+        self.assertEqual(u'some error1\r\nsome error2', decode_clixml(DOCUMENT))
+
+    def test_text_without_clixml_is_returned_as_is(self):
+        self.assertEqual('plain error', decode_clixml('plain error'))
+        self.assertEqual('', decode_clixml(''))
+
+    def test_fed_byte_by_byte(self):
+        decoder = ClixmlDecoder()
+        for c in DOCUMENT:
+            decoder.feed(c)
+        decoder.close()
+        self.assertEqual(u'some error1\r\nsome error2', decoder.get_text())
+        self.assertEqual(1, decoder.documents)
+        self.assertEqual(2, decoder.records)
+
+    def test_concatenated_documents_and_plain_text(self):
+        decoder = ClixmlDecoder()
+        decoder.feed('native error\n' + DOCUMENT)
+        decoder.feed(DOCUMENT[:5])
+        decoder.feed(DOCUMENT[5:])
+        decoder.close()
+        self.assertEqual(u'native error\nsome error1\r\nsome error2some error1\r\nsome error2', decoder.get_text())
+        self.assertEqual(2, decoder.documents)
+
+    def test_retained_text_is_capped(self):
+        decoder = ClixmlDecoder(max_size=10)
+        decoder.feed(DOCUMENT * 3)
+        decoder.close()
+        self.assertEqual(u'[... 62 characters of stderr truncated ...]\nome error2', decoder.get_text())
+        self.assertEqual(72, decoder.size)
+
+    def test_invalid_document_keeps_the_decoded_records_and_the_rest_as_is(self):
+        logger = Mock()
+        text = decode_clixml('#< CLIXML\n<Objs><S S="Error">a</S><S S="Error">b</X></Objs>', logger)
+        self.assertTrue(text.startswith(u'a'))
+        self.assertTrue(text.endswith(u'</Objs>'))
+        self.assertNotIn(u'<S S="Error">a', text)
+        logger.warning.assert_called_once()
+
+    def test_text_after_the_document_is_kept_as_plain_text(self):
+        logger = Mock()
+        text = decode_clixml('#< CLIXML\n<Objs><S S="Error">a</S></Objs> trailing text', logger)
+        self.assertEqual(u'a trailing text', text)
+        logger.warning.assert_not_called()
+
+    def test_document_followed_by_plain_text_in_one_feed(self):
+        decoder = ClixmlDecoder()
+        decoder.feed('plain text boom\r\n' + DOCUMENT + '\r\nmore plain text')
+        decoder.feed(' and more')
+        decoder.close()
+        self.assertEqual(u'plain text boom\r\nsome error1\r\nsome error2\r\nmore plain text and more',
+                         decoder.get_text())
+        self.assertEqual(2, decoder.records)
+
+    def test_end_tag_split_between_feeds(self):
+        decoder = ClixmlDecoder()
+        decoder.feed(DOCUMENT[:-4])
+        decoder.feed(DOCUMENT[-4:] + ' trailing text')
+        decoder.close()
+        self.assertEqual(u'some error1\r\nsome error2 trailing text', decoder.get_text())
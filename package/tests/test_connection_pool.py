@@ -0,0 +1,156 @@
+from threading import Thread
+from unittest import TestCase
+
+import time
+from mock import Mock
+
+from cloudshell.cm.customscript.domain.connection_pool import ConnectionPool, ConnectionPoolFullError
+
+
+class TestConnectionPool(TestCase):
+
+    def setUp(self):
+        self.alive = set()
+        self.pool = ConnectionPool(is_alive=lambda c: c in self.alive, idle_ttl_seconds=60, max_connections=2)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def _connection(self):
+        connection = Mock()
+        self.alive.add(connection)
+        return connection
+
+    def test_released_connection_is_reused(self):
+        connection = self.pool.acquire('key1', self._connection)
+        self.pool.release('key1', connection)
+        self.assertIs(connection, self.pool.acquire('key1', self._connection))
+        self.assertEqual((1, 1), (self.pool.created, self.pool.reused))
+
+    def test_connection_is_not_shared_while_acquired(self):
+        connection1 = self.pool.acquire('key1', self._connection)
+        connection2 = self.pool.acquire('key1', self._connection)
+        self.assertIsNot(connection1, connection2)
+
+    def test_keys_are_not_mixed(self):
+        connection = self.pool.acquire('key1', self._connection)
+        self.pool.release('key1', connection)
+        self.assertIsNot(connection, self.pool.acquire('key2', self._connection))
+
+    def test_dead_connection_is_replaced(self):
+        connection = self.pool.acquire('key1', self._connection)
+        self.pool.release('key1', connection)
+        self.alive.remove(connection)
+        self.assertIsNot(connection, self.pool.acquire('key1', self._connection))
+        connection.close.assert_called_once()
+
+    def test_dead_connection_is_not_pooled(self):
+        connection = self.pool.acquire('key1', self._connection)
+        self.alive.remove(connection)
+        self.pool.release('key1', connection)
+        self.assertEqual(0, self.pool.get_idle_count())
+        connection.close.assert_called_once()
+
+    def test_failing_liveness_check_is_dead(self):
+        pool = ConnectionPool(is_alive=Mock(side_effect=EOFError()))
+        connection = Mock()
+        pool.release('key1', connection)
+        connection.close.assert_called_once()
+
+    def test_max_connections(self):
+        connections = [self.pool.acquire('key%s' % i, self._connection) for i in range(3)]
+        for i, connection in enumerate(connections):
+            self.pool.release('key%s' % i, connection)
+        self.assertEqual(2, self.pool.get_idle_count())
+        connections[0].close.assert_called_once()
+        self.assertEqual(1, self.pool.evicted)
+
+    def test_idle_ttl(self):
+        connection = self.pool.acquire('key1', self._connection)
+        self.pool.release('key1', connection)
+        self.pool.idle_ttl_seconds = 0
+        self.pool.evict_idle()
+        self.assertEqual(0, self.pool.get_idle_count())
+        connection.close.assert_called_once()
+
+    def test_idle_connections_are_evicted_in_background(self):
+        pool = ConnectionPool(idle_ttl_seconds=0.01)
+        connection = Mock()
+        pool.release('key1', connection)
+        end_time = time.time() + 5
+        while pool.get_idle_count() and time.time() < end_time:
+            time.sleep(0.05)
+        self.assertEqual(0, pool.get_idle_count())
+        pool.close()
+
+    def test_connections_per_key_are_bounded(self):
+        self.pool.max_connections_per_key = 2
+        self.pool.acquire_timeout_seconds = 5
+        connections = [self.pool.acquire('key1', self._connection) for i in range(2)]
+        self.pool.acquire('key2', self._connection)
+        acquired = []
+        waiter = Thread(target=lambda: acquired.append(self.pool.acquire('key1', self._connection)))
+        waiter.start()
+        time.sleep(0.2)
+        self.assertEqual([], acquired)
+        self.pool.release('key1', connections[0])
+        waiter.join(5)
+        self.assertEqual([connections[0]], acquired)
+        self.assertEqual((3, 1, 1), (self.pool.created, self.pool.reused, self.pool.waited))
+
+    def test_full_key_times_out(self):
+        self.pool.max_connections_per_key = 1
+        self.pool.acquire_timeout_seconds = 0.1
+        self.pool.acquire('key1', self._connection)
+        with self.assertRaises(ConnectionPoolFullError):
+            self.pool.acquire('key1', self._connection)
+
+    def test_wait_for_a_full_key_is_cancelled(self):
+        self.pool.max_connections_per_key = 1
+        self.pool.acquire('key1', self._connection)
+        cancel_sampler = Mock()
+        cancel_sampler.throw_if_canceled.side_effect = Exception('cancelled')
+        with self.assertRaises(Exception) as e:
+            self.pool.acquire('key1', self._connection, cancel_sampler)
+        self.assertEqual('cancelled', e.exception.message)
+
+    def test_failed_and_discarded_connections_free_their_place(self):
+        self.pool.max_connections_per_key = 1
+        self.pool.acquire_timeout_seconds = 0.1
+        with self.assertRaises(ValueError):
+            self.pool.acquire('key1', Mock(side_effect=ValueError()))
+        connection = self.pool.acquire('key1', self._connection)
+        self.pool.discard('key1', connection)
+        connection.close.assert_called_once()
+        self.alive.remove(connection)
+        self.pool.release('key1', self.pool.acquire('key1', self._connection))
+        self.assertIn('1 idle, 0 in use', self.pool.get_stats_message())
+
+    def test_close_stops_the_janitor(self):
+        self.pool.release('key1', self._connection())
+        janitor = self.pool._janitor
+        self.assertTrue(janitor.is_alive())
+        self.pool.close()
+        self.assertFalse(janitor.is_alive())
+
+    def test_close(self):
+        connection = self.pool.acquire('key1', self._connection)
+        self.pool.close()
+        self.pool.release('key1', connection)
+        connection.close.assert_called_once()
+        self.assertEqual(0, self.pool.get_idle_count())
+
+    def test_close_connection(self):
+        closed = []
+        pool = ConnectionPool(close_connection=closed.append)
+        connection = object()
+        pool.acquire('key1', lambda: connection)
+        pool.release('key1', connection)
+        pool.close()
+        self.assertEqual([connection], closed)
+
+    def test_credentials_fingerprint(self):
+        fingerprint = ConnectionPool.get_credentials_fingerprint('pass', None)
+        self.assertEqual(fingerprint, ConnectionPool.get_credentials_fingerprint(u'pass', ''))
+        self.assertNotEqual(fingerprint, ConnectionPool.get_credentials_fingerprint('pass2', None))
+        self.assertNotIn('pass', fingerprint)
@@ -4,6 +4,7 @@ from cloudshell.cm.customscript.domain.script_executor import ExcutorConnectionE
 from mock import patch, Mock
 
 from cloudshell.cm.customscript.customscript_shell import CustomScriptShell
+from cloudshell.cm.customscript.domain.port_probe import PortProbe
 from cloudshell.cm.customscript.domain.reservation_output_writer import ReservationOutputWriter
 from cloudshell.cm.customscript.domain.script_configuration import ScriptConfiguration
 from cloudshell.cm.customscript.domain.script_file import ScriptFile
@@ -16,6 +17,7 @@ class TestCustomScriptShell(TestCase):
         self.context = Mock()
         self.executor = Mock()
         self.executor.get_expected_file_extensions = Mock(return_value=[])
+        self.executor.get_connection_address = Mock(return_value=None)
         self.cancel_context = Mock()
         self.cancel_sampler = Mock()
         self.output_writer = Mock()
@@ -68,15 +70,28 @@ class TestCustomScriptShell(TestCase):
     def test_selector_is_called_with_host_details(self):
         CustomScriptShell().execute_script(self.context, '', self.cancel_context)
 
-        self.selector_get.assert_called_with(self.script_conf.host_conf, Any(), self.cancel_sampler)
+        self.selector_get.assert_called_with(self.script_conf.host_conf, Any(), self.cancel_sampler, Any(), Any(), Any(), Any())
 
     def test_execute_is_called(self):
         CustomScriptShell().execute_script(self.context, '', self.cancel_context)
 
-        self.selector_get.assert_called_with(self.script_conf.host_conf, Any(), self.cancel_sampler)
+        self.selector_get.assert_called_with(self.script_conf.host_conf, Any(), self.cancel_sampler, Any(), Any(), Any(), Any())
 
         self.executor.execute.assert_called_once()
 
+    def test_executor_is_closed(self):
+        CustomScriptShell().execute_script(self.context, '', self.cancel_context)
+
+        self.executor.close.assert_called_once()
+
+    def test_executor_is_closed_when_execute_fails(self):
+        self.executor.execute.side_effect = Exception('some error')
+
+        with self.assertRaises(Exception):
+            CustomScriptShell().execute_script(self.context, '', self.cancel_context)
+
+        self.executor.close.assert_called_once()
+
     def test_get_expected_file_extensions_pass(self):
         self.executor.get_expected_file_extensions = Mock(return_value=['A','B'])
         self.downloader.return_value = ScriptFile('file.A','')
@@ -141,6 +156,72 @@ class TestCustomScriptShell(TestCase):
             CustomScriptShell().execute_script(self.context, '', self.cancel_context)
         self.assertEqual(inner_error, error.exception)
 
+    def test_connect_retries_at_a_growing_interval(self):
+        self.script_conf.timeout_minutes = 1
+        self.executor.connect.side_effect = [ExcutorConnectionError(10060, Exception())] * 5 + [None]
+
+        CustomScriptShell().execute_script(self.context, '', self.cancel_context)
+
+        self.assertEqual([1, 2, 4, 8, 10], [c[0][0] for c in self.sleep.call_args_list])
+
+    def test_connect_waits_for_the_port_before_connecting(self):
+        self.executor.get_connection_address.return_value = ('1.2.3.4', 22)
+        with patch('cloudshell.cm.customscript.customscript_shell.PortProbe') as probe_class:
+            probe = probe_class.return_value
+            probe.wait_until_open.side_effect = lambda timeout: self.executor.connect.assert_not_called() or True
+            probe.attempts = 3
+            probe.time_to_open = 1.5
+            CustomScriptShell().execute_script(self.context, '', self.cancel_context)
+
+        probe_class.assert_called_once_with('1.2.3.4', 22, self.cancel_sampler)
+        self.executor.connect.assert_called_once()
+
+    def test_connect_fails_when_the_port_stays_closed(self):
+        self.executor.get_connection_address.return_value = ('1.2.3.4', 22)
+        with patch('cloudshell.cm.customscript.customscript_shell.PortProbe') as probe_class:
+            probe_class.return_value.wait_until_open.return_value = False
+            probe_class.return_value.get_error_message.return_value = 'Port 22 on host 1.2.3.4 is not reachable'
+            with self.assertRaises(Exception) as error:
+                CustomScriptShell().execute_script(self.context, '', self.cancel_context)
+
+        self.assertIn('Port 22 on host 1.2.3.4 is not reachable', str(error.exception))
+        self.executor.connect.assert_not_called()
+
+    def test_connect_with_zero_timeout_waits_for_a_slow_port(self):
+        self.assertEqual(0, self.script_conf.timeout_minutes)
+        self.executor.get_connection_address.return_value = ('1.2.3.4', 22)
+        # the port answers only to a probe which waits the full attempt timeout
+        is_open = lambda probe, timeout_seconds=PortProbe.ATTEMPT_TIMEOUT_SECONDS: \
+            timeout_seconds >= PortProbe.ATTEMPT_TIMEOUT_SECONDS
+        with patch.object(PortProbe, 'is_open', is_open):
+            CustomScriptShell().execute_script(self.context, '', self.cancel_context)
+
+        self.executor.connect.assert_called_once()
+
+    def test_prefetch_downloads_all_scripts(self):
+        confs = [ScriptConfiguration(), ScriptConfiguration()]
+        confs[0].script_repo.url = 'url1'
+        confs[1].script_repo.url = 'url2'
+        script_file = Mock()
+        self.downloader.return_value = script_file
+        with patch('cloudshell.cm.customscript.customscript_shell.ScriptConfigurationParser.json_to_prefetch_objects') as parse:
+            parse.return_value = confs
+            result = CustomScriptShell().prefetch_scripts(self.context, '', self.cancel_context)
+        self.assertEqual(2, self.downloader.call_count)
+        self.assertEqual(2, script_file.close.call_count)
+        self.assertEqual('Prefetched 2 of 2 scripts.', result)
+
+    def test_prefetch_reports_failures(self):
+        confs = [ScriptConfiguration(), ScriptConfiguration()]
+        confs[0].script_repo.url = 'url1'
+        confs[1].script_repo.url = 'url2'
+        self.downloader.side_effect = [Mock(), Exception('some error')]
+        with patch('cloudshell.cm.customscript.customscript_shell.ScriptConfigurationParser.json_to_prefetch_objects') as parse:
+            parse.return_value = confs
+            result = CustomScriptShell().prefetch_scripts(self.context, '', self.cancel_context)
+        self.assertEqual('Prefetched 1 of 2 scripts.', result)
+        self.api_session.WriteMessageToReservationOutput.assert_any_call(Any(), Any(lambda x: 'some error' in x))
+
             # def test_flow(self):
     #     script_file = ScriptFile('name','text')
     #     env_vars = Mock()
@@ -0,0 +1,39 @@
+from unittest import TestCase
+
+from cloudshell.cm.customscript.domain.download_policy import RetryPolicy, MirrorLatencyTracker
+
+
+class TestRetryPolicy(TestCase):
+
+    def test_delay_grows_exponentially_with_jitter(self):
+        policy = RetryPolicy(base_delay=1.0, max_delay=30.0, jitter=0.5)
+        for attempt, delay in [(0, 1), (1, 2), (2, 4), (10, 30)]:
+            self.assertTrue(delay * 0.5 <= policy.get_delay(attempt) <= delay)
+
+    def test_no_jitter(self):
+        self.assertEqual(4, RetryPolicy(base_delay=1.0, jitter=0).get_delay(2))
+
+
+class TestMirrorLatencyTracker(TestCase):
+
+    def test_unknown_mirrors_keep_their_order(self):
+        self.assertEqual(['a', 'b', 'c'], MirrorLatencyTracker().order(['a', 'b', 'c']))
+
+    def test_fastest_mirror_first(self):
+        tracker = MirrorLatencyTracker()
+        tracker.record('a', 0.5)
+        tracker.record('c', 0.1)
+        self.assertEqual(['c', 'a', 'b'], tracker.order(['a', 'b', 'c']))
+
+    def test_failure_is_penalized(self):
+        tracker = MirrorLatencyTracker()
+        tracker.record('a', 0.1)
+        tracker.record('b', 0.5)
+        tracker.record_failure('a')
+        self.assertEqual(['b', 'a'], tracker.order(['a', 'b']))
+
+    def test_latency_is_smoothed(self):
+        tracker = MirrorLatencyTracker()
+        tracker.record('a', 1.0)
+        tracker.record('a', 2.0)
+        self.assertAlmostEqual(1.3, tracker.get_latency('a'))
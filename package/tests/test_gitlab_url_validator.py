@@ -1,5 +1,5 @@
 from unittest import TestCase
-from cloudshell.cm.customscript.domain.gitlab_api_url_validator import is_gitlab_rest_url
+from cloudshell.cm.customscript.domain.gitlab_api_url_validator import is_gitlab_rest_url, is_gitlab_archive_url
 
 
 class TestCustomScriptShell(TestCase):
@@ -19,4 +19,15 @@ class TestCustomScriptShell(TestCase):
         # is_gitlab = is_gitlab_rest_url(input_url)
         with self.assertRaises(Exception) as context:
             is_gitlab_rest_url(input_url)
-        self.assertTrue(context.exception)
\ No newline at end of file
+        self.assertTrue(context.exception)
+
+    def test_archive_url(self):
+        self.assertTrue(is_gitlab_archive_url("http://192.168.85.62/api/v4/projects/4/repository/archive"))
+        self.assertTrue(is_gitlab_archive_url(
+            "https://192.168.85.62/api/v4/projects/4/repository/archive.tar.gz?sha=master&path=scripts"))
+        self.assertFalse(is_gitlab_archive_url(
+            "http://192.168.85.62/api/v4/projects/4/repository/files/hello_world.sh/raw?ref=master"))
+
+    def test_broken_archive_url(self):
+        with self.assertRaises(Exception):
+            is_gitlab_archive_url("http://192.168.85.62/api/v4/projects/4/repository/archive.rar?sha=master")
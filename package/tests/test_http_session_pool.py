@@ -0,0 +1,66 @@
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+from unittest import TestCase
+
+from cloudshell.cm.customscript.domain.http_session_pool import HttpSessionPool
+
+
+class _ScriptHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    received_cookies = []
+
+    def do_GET(self):
+        body = 'some script code'
+        _ScriptHandler.received_cookies.append(self.headers.getheader('Cookie'))
+        self.send_response(200)
+        self.send_header('Set-Cookie', '_gitlab_session=%s; Path=/' % self.headers.getheader('Authorization'))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHttpSessionPool(TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), _ScriptHandler)
+        self.server_thread = Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.url = 'http://127.0.0.1:%s' % self.server.server_port
+        self.pool = HttpSessionPool()
+        _ScriptHandler.received_cookies = []
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_session_per_origin(self):
+        self.assertIs(self.pool.get_session('http://server/a.sh'), self.pool.get_session('HTTP://Server/b/c.sh'))
+        self.assertIsNot(self.pool.get_session('http://server/a.sh'), self.pool.get_session('https://server/a.sh'))
+        self.assertIsNot(self.pool.get_session('http://server/a.sh'), self.pool.get_session('http://server:8081/a.sh'))
+
+    def test_connections_are_reused(self):
+        for i in range(0, 3):
+            response = self.pool.get_session(self.url + '/script%s.sh' % i).get(self.url + '/script%s.sh' % i)
+            self.assertEqual('some script code', response.content)
+        stats = self.pool.get_stats()
+        self.assertEqual(1, stats['origins'])
+        self.assertEqual(3, stats['requests'])
+        self.assertEqual(1, stats['connections'])
+        self.assertEqual(2, stats['reused'])
+
+    def test_no_keep_alive(self):
+        self.pool = HttpSessionPool(keep_alive=False)
+        self.assertEqual('close', self.pool.get_session(self.url).headers['Connection'])
+
+    def test_cookies_are_not_shared_between_credentials(self):
+        session = self.pool.get_session(self.url)
+        session.get(self.url + '/a.sh', auth=('user1', 'password1'))
+        session.get(self.url + '/a.sh', auth=('user2', 'password2'))
+        session.get(self.url + '/a.sh')
+        self.assertEqual([None, None, None], _ScriptHandler.received_cookies)
+        self.assertEqual(0, len(session.cookies))
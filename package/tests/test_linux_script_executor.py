@@ -1,12 +1,29 @@
+import gzip
+import os
+import shutil
+import socket
+import tarfile
+import subprocess
+import tempfile
+import time
+import zlib
+from StringIO import StringIO
+from threading import Event
 from unittest import TestCase
 from mock import patch, Mock
+from paramiko import SSHException
 from scpclient import SCPError
 
+from cloudshell.cm.customscript.domain.cancellation_sampler import CancellationException
+from cloudshell.cm.customscript.domain.connection_pool import ConnectionPool
 from cloudshell.cm.customscript.domain.script_configuration import HostConfiguration
 from cloudshell.cm.customscript.domain.script_executor import ErrorMsg
 from cloudshell.cm.customscript.domain.script_file import ScriptFile
+from cloudshell.cm.customscript.domain.output_capture import OutputCapture
+from cloudshell.cm.customscript.domain.private_key_loader import PrivateKeyLoader
 from cloudshell.cm.customscript.domain.linux_script_executor import LinuxScriptExecutor
-from tests.helpers import Any
+from cloudshell.cm.customscript.domain.worker_pool import WorkerPool
+from tests.helpers import Any, make_archive
 
 
 class TestLinuxScriptExecutor(TestCase):
@@ -14,6 +31,7 @@ class TestLinuxScriptExecutor(TestCase):
     def setUp(self):
         self.logger = Mock()
         self.cancel_sampler = Mock()
+        self.cancel_sampler.is_cancelled.return_value = False
         self.session = Mock()
         self.scp = Mock()
         self.scp_ctor = Mock()
@@ -33,12 +51,17 @@ class TestLinuxScriptExecutor(TestCase):
         self.scp_patcher.stop()
 
     def _mock_session_answer(self, exit_code, stdout, stderr):
-        stdout_mock = Mock()
-        stderr_mock = Mock()
-        stdout_mock.channel.recv_exit_status = Mock(return_value=exit_code)
-        stdout_mock.readlines = Mock(return_value=stdout)
-        stderr_mock.readlines = Mock(return_value=stderr)
-        self.session.exec_command = Mock(return_value=(None, stdout_mock, stderr_mock))
+        self.stdin_mock = Mock()
+
+        def exec_command(code):
+            outputs = {'stdout': list(stdout) if isinstance(stdout, list) else [stdout], 'stderr': [stderr]}
+            stdout_mock = Mock()
+            stdout_mock.channel.recv_exit_status = Mock(return_value=exit_code)
+            stdout_mock.channel.recv = Mock(side_effect=lambda size: outputs['stdout'].pop(0) if outputs['stdout'] else '')
+            stdout_mock.channel.recv_stderr = Mock(side_effect=lambda size: outputs['stderr'].pop(0) if outputs['stderr'] else '')
+            return self.stdin_mock, stdout_mock, Mock()
+
+        self.session.exec_command = Mock(side_effect=exec_command)
 
     def test_user_password(self):
         self.host.username = 'root'
@@ -51,12 +74,24 @@ class TestLinuxScriptExecutor(TestCase):
         self.host.username = 'root'
         self.host.access_key = 'just an access key'
         key_obj = Mock()
-        with patch('cloudshell.cm.customscript.domain.linux_script_executor.RSAKey.from_private_key') as from_private_key:
+        with patch('cloudshell.cm.customscript.domain.private_key_loader.RSAKey.from_private_key') as from_private_key:
             from_private_key.return_value = key_obj
-            executor = LinuxScriptExecutor(self.logger, self.host, self.cancel_sampler)
+            executor = LinuxScriptExecutor(self.logger, self.host, self.cancel_sampler, key_loader=PrivateKeyLoader())
             executor.connect()
         self.session.connect.assert_called_with('1.2.3.4', username='root', pkey=key_obj)
 
+    def test_pem_file_is_parsed_once_across_retries(self):
+        self.host.username = 'root'
+        self.host.access_key = 'just an access key'
+        key_loader = PrivateKeyLoader()
+        with patch('cloudshell.cm.customscript.domain.private_key_loader.RSAKey.from_private_key') as from_private_key:
+            executor = LinuxScriptExecutor(self.logger, self.host, self.cancel_sampler, key_loader=key_loader)
+            executor.connect()
+            executor.connect()
+            LinuxScriptExecutor(self.logger, self.host, self.cancel_sampler, key_loader=key_loader).connect()
+        from_private_key.assert_called_once()
+        self.assertEqual(2, key_loader.hits)
+
     def test_no_password_nor_pen_file(self):
         self.host.username = 'root'
         executor = LinuxScriptExecutor(self.logger, self.host, self.cancel_sampler)
@@ -70,6 +105,40 @@ class TestLinuxScriptExecutor(TestCase):
             executor.connect()
         self.assertEqual('Machine credentials are empty.', e.exception.inner_error.message)
 
+    def test_pooled_session_is_reused(self):
+        self.host.username = 'root'
+        self.host.password = '1234'
+        pool = ConnectionPool(is_alive=lambda session: True)
+        executor = LinuxScriptExecutor(self.logger, self.host, self.cancel_sampler, pool)
+        executor.connect()
+        executor.close()
+        executor = LinuxScriptExecutor(self.logger, self.host, self.cancel_sampler, pool)
+        executor.connect()
+        self.session.connect.assert_called_once_with('1.2.3.4', username='root', password='1234')
+        self.session.close.assert_not_called()
+        self.assertEqual(1, pool.reused)
+        pool.close()
+
+    def test_pooled_session_is_keyed_by_credentials(self):
+        self.host.username = 'root'
+        self.host.password = '1234'
+        key = LinuxScriptExecutor(self.logger, self.host, self.cancel_sampler).get_pool_key()
+        self.host.password = '4321'
+        self.assertNotEqual(key, LinuxScriptExecutor(self.logger, self.host, self.cancel_sampler).get_pool_key())
+        self.assertNotIn('4321', str(key))
+
+    def test_close_without_pool(self):
+        self.executor.close()
+        self.session.close.assert_called_once()
+
+    def test_session_liveness(self):
+        self.session.get_transport.return_value.is_active.return_value = True
+        self.assertTrue(LinuxScriptExecutor.is_session_alive(self.session))
+        self.session.get_transport.return_value.is_active.return_value = False
+        self.assertFalse(LinuxScriptExecutor.is_session_alive(self.session))
+        self.session.get_transport.return_value = None
+        self.assertFalse(LinuxScriptExecutor.is_session_alive(self.session))
+
     def test_create_temp_folder_success(self):
         self._mock_session_answer(0,'tmp123','')
         result = self.executor.create_temp_folder()
@@ -84,11 +153,109 @@ class TestLinuxScriptExecutor(TestCase):
     def test_copy_script_success(self):
         transport = Mock()
         self.session.get_transport.return_value = transport
-        self.executor.copy_script('tmp123', ScriptFile('script1','some script code'))
+        script_file = ScriptFile('script1','some script code')
+        self.executor.copy_script('tmp123', script_file)
         self.scp_ctor.assert_called_once_with(transport, 'tmp123')
-        self.scp.send.assert_called_once_with(Any(lambda x: x.getvalue() == 'some script code'),'script1', '0601', 16)
+        self.scp.send.assert_called_once_with(script_file,'script1', '0601', 16)
         self.scp.close.assert_called_once()
 
+    def test_copy_compressed_script(self):
+        self.host.compress_transfer = True
+        self._mock_session_answer(0, '/bin/gzip', '')
+        sent = []
+        self.scp.send.side_effect = lambda f, name, mode, size: sent.append((f.read(size), name))
+        self.executor.copy_script('tmp123', ScriptFile('script1', 'some script code'))
+        self.assertEqual([('some script code', 'script1.gz')], [(zlib.decompress(data, 16 + zlib.MAX_WBITS), name) for data, name in sent])
+        self.session.exec_command.assert_called_with('gzip -d -f tmp123/script1.gz')
+
+    def test_copy_compressed_script_falls_back_without_gzip(self):
+        self.host.compress_transfer = True
+        self._mock_session_answer(1, '', '')
+        script_file = ScriptFile('script1', 'some script code')
+        self.executor.copy_script('tmp123', script_file)
+        self.scp.send.assert_called_once_with(script_file, 'script1', '0601', 16)
+
+    def test_copy_bundle(self):
+        self._mock_session_answer(0, '', '')
+        script_file = ScriptFile('run.sh', make_archive({'root/a/run.sh': 'echo', 'root/lib.sh': 'x'}, 'zip'))
+        script_file.bundle_format = 'zip'
+        script_file.entry_point = 'a/run.sh'
+        sent = []
+        self.scp.send.side_effect = lambda f, name, mode, size: sent.append((f.read(size), name))
+        self.executor.copy_script('tmp123', script_file)
+        self.assertEqual('bundle.tar.gz', sent[0][1])
+        archive = tarfile.open(fileobj=StringIO(sent[0][0]), mode='r:gz')
+        self.assertEqual(['a/run.sh', 'lib.sh'], sorted(archive.getnames()))
+        self.session.exec_command.assert_called_with(
+            'mkdir tmp123/bundle && tar -xzf tmp123/bundle.tar.gz -C tmp123/bundle && rm -f tmp123/bundle.tar.gz')
+
+    def _mock_sftp(self):
+        sftp = Mock()
+        self.session.open_sftp.return_value = sftp
+        remote_file = Mock()
+        self.executor._sftp_create = Mock(return_value=remote_file)
+        return sftp, remote_file
+
+    def test_copy_script_with_sftp(self):
+        self.host.transfer_method = 'sftp'
+        self.host.sftp_request_size = 4
+        sftp, remote_file = self._mock_sftp()
+        self.executor.copy_script('tmp123', ScriptFile('script1', 'some script code'))
+        self.executor._sftp_create.assert_called_once_with(sftp, 'tmp123/script1', 0o601)
+        remote_file.set_pipelined.assert_called_once_with(True)
+        self.assertEqual(['some', ' scr', 'ipt ', 'code'], [c[0][0] for c in remote_file.write.call_args_list])
+        remote_file.close.assert_called_once()
+        sftp.close.assert_called_once()
+        self.scp.send.assert_not_called()
+
+    def test_copy_script_with_sftp_reports_progress(self):
+        self.host.transfer_method = 'sftp'
+        reporter = Mock()
+        self.executor.reporter = reporter
+        self._mock_sftp()
+        self.executor.copy_script('tmp123', ScriptFile('script1', 'a' * 2 * 1024 * 1024))
+        messages = [c[0][0] for c in reporter.info_out.call_args_list]
+        self.assertEqual(10, len(messages))
+        self.assertIn('100% (2097152 of 2097152 bytes)', messages[-1])
+
+    def test_copy_script_with_sftp_fail(self):
+        self.host.transfer_method = 'sftp'
+        sftp, remote_file = self._mock_sftp()
+        remote_file.close.side_effect = IOError('Permission denied')
+        with self.assertRaises(Exception) as e:
+            self.executor.copy_script('tmp123', ScriptFile('script1', 'some script code'))
+        self.assertIn(ErrorMsg.COPY_SCRIPT % 'Permission denied', e.exception.message)
+        sftp.close.assert_called_once()
+
+    def test_copy_script_auto_falls_back_to_scp(self):
+        self.host.transfer_method = 'auto'
+        self.session.open_sftp.side_effect = SSHException('subsystem request failed')
+        script_file = ScriptFile('script1', 'some script code')
+        self.executor.copy_script('tmp123', script_file)
+        self.scp.send.assert_called_once_with(script_file, 'script1', '0601', 16)
+
+    def test_copy_script_auto_prefers_sftp(self):
+        self.host.transfer_method = 'auto'
+        sftp, remote_file = self._mock_sftp()
+        self.executor.copy_script('tmp123', ScriptFile('script1', 'some script code'))
+        remote_file.write.assert_called_once_with('some script code')
+        self.scp.send.assert_not_called()
+
+    def test_sftp_file_is_created_with_mode(self):
+        sftp = Mock()
+        remote_file = self.executor._sftp_create(sftp, 'tmp123/script1', 0o601)
+        sftp.open.assert_called_once_with('tmp123/script1', 'wb')
+        self.assertIs(sftp.open.return_value, remote_file)
+        remote_file.chmod.assert_called_once_with(0o601)
+        remote_file.write.assert_not_called()
+
+    def test_sftp_file_is_closed_when_its_mode_cannot_be_set(self):
+        sftp = Mock()
+        sftp.open.return_value.chmod.side_effect = IOError('Permission denied')
+        with self.assertRaises(IOError):
+            self.executor._sftp_create(sftp, 'tmp123/script1', 0o601)
+        sftp.open.return_value.close.assert_called_once()
+
     def test_copy_script_fail(self):
         self.scp.send.side_effect = SCPError('some error')
         with self.assertRaises(Exception) as e:
@@ -103,6 +270,58 @@ class TestLinuxScriptExecutor(TestCase):
         self.executor.run_script('tmp123', ScriptFile('script1', 'some script code'), {'var1':'123'}, output_writer)
         output_writer.write.assert_any_call('some output')
 
+    def test_run_bundle_entry_point(self):
+        self._mock_session_answer(0, 'some output', '')
+        script_file = ScriptFile('run.sh')
+        script_file.entry_point = 'a/run.sh'
+        self.executor.run_script('tmp123', script_file, None, Mock())
+        self.session.exec_command.assert_called_with(
+            'cd %s && sh %s' % (self.executor._escape('tmp123/bundle/a'), self.executor._escape('run.sh')))
+
+    def test_run_script_output_is_streamed(self):
+        output_writer = Mock()
+        self._mock_session_answer(0, ['line1\n', socket.timeout(), 'line2\n'], 'warning\n')
+        self.session.exec_command.side_effect = self._with_timeouts(self.session.exec_command.side_effect)
+        self.executor.run_script('tmp123', ScriptFile('script1', 'some script code'), None, output_writer)
+        written = ''.join(c[0][0] for c in output_writer.write.call_args_list)
+        self.assertEqual(['line1', 'line2', 'warning'], sorted(written.splitlines()))
+
+    def _with_timeouts(self, exec_command):
+        def exec_command_with_timeouts(code):
+            stdin, stdout, stderr = exec_command(code)
+            recv = stdout.channel.recv.side_effect
+
+            def recv_with_timeouts(size):
+                data = recv(size)
+                if isinstance(data, Exception):
+                    raise data
+                return data
+            stdout.channel.recv.side_effect = recv_with_timeouts
+            return stdin, stdout, stderr
+        return exec_command_with_timeouts
+
+    def test_run_script_tail_mode(self):
+        self.host.output_tail_kb = 1
+        output_writer = Mock()
+        self._mock_session_answer(0, ['x' * 1024, 'y' * 1024], '')
+        self.executor.run_script('tmp123', ScriptFile('script1', 'some script code'), None, output_writer)
+        output_writer.write.assert_any_call('[... 1024 bytes of stdout truncated ...]\n' + 'y' * 1024)
+
+    def test_run_script_output_over_the_buffer_is_kept_as_artifact(self):
+        self.host.output_buffer_kb = 1
+        output_writer = Mock()
+        self._mock_session_answer(1, ['x' * 1024, 'y' * 1024], 'some error')
+        with patch.object(OutputCapture, 'ARTIFACTS_FOLDER', tempfile.mkdtemp()) as folder:
+            with self.assertRaises(Exception) as e:
+                self.executor.run_script('tmp123', ScriptFile('script1', 'some script code'), None, output_writer)
+            artifacts = os.listdir(folder)
+            self.assertEqual(1, len(artifacts))
+            self.assertTrue(artifacts[0].endswith('stdout.gz'))
+            self.assertEqual('x' * 1024 + 'y' * 1024, gzip.open(os.path.join(folder, artifacts[0])).read())
+            shutil.rmtree(folder)
+        self.assertEqual(ErrorMsg.RUN_SCRIPT % 'some error', e.exception.message)
+        output_writer.write.assert_any_call(Any(lambda msg: 'Full stdout (2048 bytes) is kept' in msg))
+
     def test_run_script_fail(self):
         output_writer = Mock()
         self._mock_session_answer(1, 'some output', 'some error')
@@ -112,6 +331,144 @@ class TestLinuxScriptExecutor(TestCase):
         output_writer.write.assert_any_call('some output')
         output_writer.write.assert_any_call('some error')
 
+    def test_single_round_trip(self):
+        self.host.single_round_trip = True
+        self.host.password = '1234'
+        output_writer = Mock()
+        self._mock_session_answer(0, 'some output', '')
+        self.executor.execute(ScriptFile('script1.sh', 'some script code'), {'var1': '123'}, output_writer)
+        self.session.exec_command.assert_called_once_with(
+            'tmp_folder=$(mktemp -d) || exit 1;'
+            'trap \'rm -rf "$tmp_folder"\' EXIT;'
+            'cat > "$tmp_folder/script1.sh" || exit 1;'
+            'export var1=%s;export cs_machine_pass=%s;'
+            'sh "$tmp_folder/script1.sh"' % (self.executor._escape('123'), self.executor._escape('1234')))
+        self.stdin_mock.write.assert_called_once_with('some script code')
+        self.stdin_mock.channel.shutdown_write.assert_called_once()
+        output_writer.write.assert_any_call('some output')
+        self.scp.send.assert_not_called()
+
+    def test_single_round_trip_with_env_file(self):
+        self.host.single_round_trip = True
+        self.host.env_file = True
+        self.host.password = '1234'
+        self._mock_session_answer(0, 'some output', '')
+        self.executor.execute(ScriptFile('script1.sh', 'some script code'), {'var1': "it's"}, Mock())
+        env_file = "export cs_machine_pass='1234'\nexport var1='it'\\''s'\n"
+        self.session.exec_command.assert_called_once_with(
+            'tmp_folder=$(mktemp -d) || exit 1;'
+            'trap \'rm -rf "$tmp_folder"\' EXIT;'
+            'dd bs=1 count=%d of="$tmp_folder/.customscript_env" 2>/dev/null || exit 1;'
+            'cat > "$tmp_folder/script1.sh" || exit 1;'
+            '. "$tmp_folder/.customscript_env";'
+            'sh "$tmp_folder/script1.sh"' % len(env_file))
+        self.assertEqual([env_file, 'some script code'], [c[0][0] for c in self.stdin_mock.write.call_args_list])
+
+    def test_single_round_trip_with_env_file_runs_in_sh(self):
+        self.host.single_round_trip = True
+        self.host.env_file = True
+        self._mock_session_answer(0, '', '')
+        self.executor.execute(ScriptFile('script1.sh', 'echo "$var1|$var2"'), {'var1': "it's", 'var2': 'x' * 5000},
+                              Mock())
+        process = subprocess.Popen(['/bin/sh', '-c', self.session.exec_command.call_args[0][0]],
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        stdout = process.communicate(''.join(c[0][0] for c in self.stdin_mock.write.call_args_list))[0]
+        self.assertEqual("it's|%s\n" % ('x' * 5000), stdout)
+        self.assertEqual(0, process.returncode)
+
+    def test_command_which_exits_before_reading_stdin_reports_its_error(self):
+        self.host.single_round_trip = True
+        self._mock_session_answer(126, '', 'sh: bad interpreter')
+        self.stdin_mock.write.side_effect = socket.error('Socket is closed')
+        with self.assertRaises(Exception) as e:
+            self.executor.execute(ScriptFile('script1.sh', 'some script code'), None, Mock())
+        self.assertEqual(ErrorMsg.RUN_SCRIPT % 'sh: bad interpreter', e.exception.message)
+
+    def test_stdin_error_is_raised_when_the_connection_dropped(self):
+        self.host.single_round_trip = True
+        self._mock_session_answer(-1, '', '')
+        self.stdin_mock.write.side_effect = socket.error('Socket is closed')
+        with self.assertRaises(socket.error):
+            self.executor.execute(ScriptFile('script1.sh', 'some script code'), None, Mock())
+
+    def test_stdin_content_error_closes_the_channel(self):
+        self.host.single_round_trip = True
+        self._mock_session_answer(-1, '', '')
+        script_file = ScriptFile('script1.sh', 'some script code')
+        script_file.iter_chunks = Mock(side_effect=IOError('download failed'))
+        with self.assertRaises(IOError):
+            self.executor.execute(script_file, None, Mock())
+        self.stdin_mock.channel.close.assert_called_once()
+
+    def test_run_script_with_env_file(self):
+        self.host.env_file = True
+        self._mock_session_answer(0, 'some output', '')
+        params = dict(('var%d' % i, 'x' * 100) for i in range(1000))
+        self.executor.run_script('tmp123', ScriptFile('script1', 'some script code'), params, Mock())
+        self.session.exec_command.assert_called_once_with(
+            '(umask 077; cat > tmp123/.customscript_env) && . tmp123/.customscript_env && sh tmp123/script1')
+        env_file = ''.join(c[0][0] for c in self.stdin_mock.write.call_args_list)
+        self.assertEqual(1000, env_file.count('\n'))
+        self.assertIn("export var999='%s'\n" % ('x' * 100), env_file)
+
+    def test_env_file_quoting(self):
+        env_file = self.executor._get_env_file({'a': u'caf\xe9', 'b': 'x\ny', 'c': 5, 'd': "'$HOME'"})
+        self.assertEqual("export a='caf\xc3\xa9'\n"
+                         "export b='x\ny'\n"
+                         "export c='5'\n"
+                         "export d=''\\''$HOME'\\'''\n", env_file.text)
+
+    def test_single_round_trip_fail(self):
+        self.host.single_round_trip = True
+        self._mock_session_answer(2, '', 'some error')
+        with self.assertRaises(Exception) as e:
+            self.executor.execute(ScriptFile('script1.sh', 'some script code'), None, Mock())
+        self.assertEqual(ErrorMsg.RUN_SCRIPT % 'some error', e.exception.message)
+        self.session.exec_command.assert_called_once()
+
+    def test_run_cancelable_wakes_up_on_completion(self):
+        self._mock_session_answer(0, 'tmp123', '')
+        start_time = time.time()
+        self.executor.create_temp_folder()
+        self.assertLess(time.time() - start_time, 0.5)
+
+    def test_run_cancelable_is_cancelled(self):
+        finish = Event()
+        self.executor._run = Mock(side_effect=lambda **kwargs: finish.wait(5))
+        self.cancel_sampler.is_cancelled.return_value = True
+        self.cancel_sampler.throw.side_effect = CancellationException()
+        start_time = time.time()
+        with self.assertRaises(CancellationException):
+            self.executor.create_temp_folder()
+        finish.set()
+        self.assertLess(time.time() - start_time, 1)
+        self.session.close.assert_called_once()
+
+    def test_cancelled_command_releases_its_worker(self):
+        channel = Mock()
+
+        def recv_nothing(size):
+            time.sleep(0.05)
+            raise socket.timeout()
+        channel.recv.side_effect = recv_nothing
+        channel.recv_stderr.side_effect = recv_nothing
+        self.session.exec_command.return_value = Mock(), Mock(channel=channel), Mock()
+        pool = WorkerPool(name='test-cancel')
+        executor = LinuxScriptExecutor(self.logger, self.host, self.cancel_sampler, worker_pool=pool)
+        self.cancel_sampler.is_cancelled.side_effect = lambda: self.session.exec_command.called
+        self.cancel_sampler.throw.side_effect = CancellationException()
+        try:
+            with self.assertRaises(CancellationException):
+                executor.create_temp_folder()
+            for i in range(50):
+                if pool.get_stats()['completed']:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(0, pool.get_stats()['busy'])
+            channel.close.assert_called_once()
+        finally:
+            pool.shutdown(timeout=5)
+
     def test_delete_temp_folder_success(self):
         self._mock_session_answer(0,'','')
         self.executor.delete_temp_folder('tmp123')
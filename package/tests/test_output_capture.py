@@ -0,0 +1,85 @@
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from mock import Mock, patch
+
+from cloudshell.cm.customscript.domain.output_capture import OutputCapture, write_captured_output
+
+
+class TestOutputCapture(TestCase):
+
+    def setUp(self):
+        self.artifacts_folder = tempfile.mkdtemp()
+        self.folder_patcher = patch.object(OutputCapture, 'ARTIFACTS_FOLDER', self.artifacts_folder)
+        self.folder_patcher.start()
+
+    def tearDown(self):
+        self.folder_patcher.stop()
+        shutil.rmtree(self.artifacts_folder)
+
+    def test_output_within_the_buffer(self):
+        capture = OutputCapture(10, 'stdout')
+        capture.write('abc')
+        capture.write('def')
+        self.assertEqual('abcdef', capture.get_text())
+        self.assertEqual('def', capture.get_tail(3))
+        self.assertFalse(capture.spilled)
+        self.assertIsNone(capture.keep_artifact('run'))
+        capture.close()
+
+    def test_buffer_keeps_the_tail(self):
+        capture = OutputCapture(4, 'stdout')
+        for data in ['abc', 'def', 'ghijk']:
+            capture.write(data)
+        self.assertEqual(11, capture.size)
+        self.assertEqual('hijk', capture.get_tail())
+        self.assertEqual('[... 7 bytes of stdout truncated ...]\nhijk', capture.get_text())
+        self.assertEqual('[... 9 bytes of stdout truncated ...]\njk', capture.get_text(2))
+        capture.close()
+
+    def test_full_output_is_spilled_and_kept_as_artifact(self):
+        capture = OutputCapture(4, 'stdout')
+        for data in ['abc', 'def', 'ghijk']:
+            capture.write(data)
+        path = capture.keep_artifact('1.2.3.4/run')
+        capture.close()
+        self.assertEqual(self.artifacts_folder, os.path.dirname(path))
+        self.assertEqual('1.2.3.4_run-stdout.gz', os.path.basename(path))
+        self.assertEqual('abcdefghijk', gzip.open(path).read())
+
+    def test_spill_file_is_deleted_when_not_kept(self):
+        capture = OutputCapture(4, 'stdout')
+        capture.write('abcdef')
+        spill_path = capture._spill_path
+        self.assertTrue(os.path.exists(spill_path))
+        capture.close()
+        self.assertFalse(os.path.exists(spill_path))
+
+    def test_oldest_artifacts_are_deleted(self):
+        with patch.object(OutputCapture, 'MAX_ARTIFACTS', 2):
+            for i in range(3):
+                capture = OutputCapture(1, 'stdout')
+                capture.write('ab')
+                path = capture.keep_artifact('run%d' % i)
+                os.utime(path, (i, i))
+                capture.close()
+        self.assertEqual(['run1-stdout.gz', 'run2-stdout.gz'], sorted(os.listdir(self.artifacts_folder)))
+
+    def test_write_captured_output_in_tail_mode(self):
+        stdout, stderr = OutputCapture(100, 'stdout'), OutputCapture(100, 'stderr')
+        stdout.write('line1\nline2\n')
+        output_writer = Mock()
+        write_captured_output([stdout, stderr], output_writer, True, 6, 'run')
+        output_writer.write.assert_called_once_with('[... 6 bytes of stdout truncated ...]\nline2\n')
+
+    def test_write_captured_output_without_printing(self):
+        stdout = OutputCapture(1, 'stdout')
+        stdout.write('ab')
+        output_writer = Mock()
+        write_captured_output([stdout], output_writer, False, 6, 'run')
+        output_writer.write.assert_called_once_with(
+            'Full stdout (2 bytes) is kept on the execution server at: %s' % os.path.join(self.artifacts_folder, 'run-stdout.gz'))
+        stdout.close()
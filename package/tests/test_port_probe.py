@@ -0,0 +1,67 @@
+import socket
+from unittest import TestCase
+
+from mock import Mock, patch
+
+from cloudshell.cm.customscript.domain.port_probe import PortProbe
+
+
+class TestPortProbe(TestCase):
+
+    def setUp(self):
+        self.cancel_sampler = Mock()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.port = self.listener.getsockname()[1]
+
+    def tearDown(self):
+        self.listener.close()
+
+    def test_open_port(self):
+        self.listener.listen(1)
+        probe = PortProbe('127.0.0.1', self.port, self.cancel_sampler)
+
+        self.assertTrue(probe.wait_until_open(5))
+        self.assertEqual(1, probe.attempts)
+        self.assertIsNotNone(probe.time_to_open)
+
+    def test_closed_port(self):
+        probe = PortProbe('127.0.0.1', self.port, self.cancel_sampler)
+
+        self.assertFalse(probe.is_open())
+        self.assertIn('ECONNREFUSED', probe.get_error_message())
+
+    def test_unresolvable_host(self):
+        probe = PortProbe('no-such-host.invalid', 22, self.cancel_sampler)
+
+        self.assertFalse(probe.is_open())
+        self.assertEqual(1, probe.attempts)
+
+    def test_probes_at_a_growing_interval_until_open(self):
+        probe = PortProbe('127.0.0.1', self.port, self.cancel_sampler)
+        probe.is_open = Mock(side_effect=[False, False, False, True])
+        with patch('cloudshell.cm.customscript.domain.port_probe.time.sleep') as sleep:
+            self.assertTrue(probe.wait_until_open(60))
+
+        self.assertEqual([0.25, 0.375, 0.5625], [c[0][0] for c in sleep.call_args_list])
+
+    def test_gives_up_after_the_timeout(self):
+        probe = PortProbe('127.0.0.1', self.port, self.cancel_sampler)
+        probe.is_open = Mock(return_value=False)
+
+        self.assertFalse(probe.wait_until_open(0))
+        self.assertEqual(1, probe.is_open.call_count)
+
+    def test_zero_timeout_gets_one_full_attempt(self):
+        probe = PortProbe('127.0.0.1', self.port, self.cancel_sampler)
+        probe.is_open = Mock(return_value=False)
+
+        self.assertFalse(probe.wait_until_open(0))
+        probe.is_open.assert_called_once_with(PortProbe.ATTEMPT_TIMEOUT_SECONDS)
+
+    def test_cancellation(self):
+        self.cancel_sampler.throw_if_canceled.side_effect = Exception('canceled')
+        probe = PortProbe('127.0.0.1', self.port, self.cancel_sampler)
+
+        with self.assertRaises(Exception):
+            probe.wait_until_open(60)
@@ -0,0 +1,161 @@
+import os
+from unittest import TestCase
+
+from mock import patch, Mock
+
+from cloudshell.cm.customscript.domain.cancellation_sampler import CancellationException
+from cloudshell.cm.customscript.domain.psrp_script_executor import PSRPScriptExecutor
+from cloudshell.cm.customscript.domain.reservation_output_writer import BatchedOutputWriter
+from cloudshell.cm.customscript.domain.script_configuration import HostConfiguration
+from cloudshell.cm.customscript.domain.script_executor import ErrorMsg, ExcutorConnectionError
+from cloudshell.cm.customscript.domain.script_file import ScriptFile
+from tests.helpers import make_archive
+from tests.psrp_stand_in import StandInHost, PSInvocationState
+
+
+class TestPSRPScriptExecutor(TestCase):
+
+    def setUp(self):
+        self.logger = Mock()
+        self.cancel_sampler = Mock()
+        self.cancel_sampler.is_cancelled.return_value = False
+        self.host = HostConfiguration()
+        self.host.connection_method = 'psrp'
+        self.host.username = 'admin'
+        self.host.password = '1234'
+        self.host.ip = '1.2.3.4'
+        self.stand_in = StandInHost()
+        self.import_patcher = patch('cloudshell.cm.customscript.domain.psrp_script_executor.import_pypsrp',
+                                    side_effect=self.stand_in.get_pypsrp)
+        self.import_patcher.start()
+        self.output_writer = Mock()
+
+    def tearDown(self):
+        self.import_patcher.stop()
+        self.stand_in.close()
+
+    def _execute(self, script_file, env_vars=None):
+        executor = PSRPScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        executor.connect()
+        try:
+            with patch('cloudshell.cm.customscript.domain.psrp_script_executor.BatchedOutputWriter',
+                       side_effect=lambda writer: BatchedOutputWriter(writer, flush_interval_seconds=0)):
+                executor.execute(script_file, env_vars or {}, self.output_writer)
+        finally:
+            executor.close()
+
+    def _get_written(self):
+        return ''.join(c[0][0] for c in self.output_writer.write.call_args_list)
+
+    def test_connection(self):
+        self.host.connection_secured = True
+        executor = PSRPScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        self.assertEqual(('1.2.3.4', 5986), executor.get_connection_address())
+        executor.connect()
+        executor.close()
+        self.assertEqual([('1.2.3.4', 5986, 'admin', '1234', True)], self.stand_in.wsman_args)
+        self.assertEqual((1, 1), (self.stand_in.opened_runspaces, self.stand_in.closed_runspaces))
+
+    def test_connection_error(self):
+        self.stand_in.refused_connections = 1
+        executor = PSRPScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        with self.assertRaises(ExcutorConnectionError) as e:
+            executor.connect()
+        self.assertEqual(111, e.exception.errno)
+
+    def test_missing_pypsrp(self):
+        self.import_patcher.stop()
+        try:
+            with patch.dict('sys.modules', {'pypsrp': None, 'pypsrp.wsman': None}):
+                with self.assertRaises(Exception) as e:
+                    PSRPScriptExecutor(self.logger, self.host, self.cancel_sampler).connect()
+        finally:
+            self.import_patcher.start()
+        self.assertNotIsInstance(e.exception, ExcutorConnectionError)
+        self.assertIn('requires the pypsrp package', str(e.exception))
+
+    def test_execute_in_one_runspace(self):
+        content = "Write-Output 'line1'\nWrite-Output $env:NAME\n" + '#' * (3 * 1024 * 1024) + '\n'
+        with patch.object(PSRPScriptExecutor, 'UPLOAD_CHUNK_SIZE', 1024 * 1024):
+            self._execute(ScriptFile('script1.ps1', content), {'NAME': "it's me"})
+        self.assertEqual("line1\nit's me\n", self._get_written())
+        self.assertEqual((1, 1), (self.stand_in.opened_runspaces, self.stand_in.closed_runspaces))
+        scripts = [script for script, parameters in self.stand_in.pipelines]
+        self.assertEqual([PSRPScriptExecutor.CREATE_TEMP_FOLDER_SCRIPT] + [PSRPScriptExecutor.APPEND_FILE_SCRIPT] * 4 +
+                         [PSRPScriptExecutor.RUN_SCRIPT, PSRPScriptExecutor.GET_EXIT_CODE_SCRIPT,
+                          PSRPScriptExecutor.DELETE_TEMP_FOLDER_SCRIPT], scripts)
+        # the temp folder was deleted
+        self.assertEqual([], os.listdir(self.stand_in.temp_folder))
+
+    def test_uploaded_file_is_complete(self):
+        content = ''.join(chr(i % 256) for i in range(5000))
+        executor = PSRPScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        executor.connect()
+        tmp_folder = executor.create_temp_folder()
+        with patch.object(PSRPScriptExecutor, 'UPLOAD_CHUNK_SIZE', 1024):
+            executor.copy_script(tmp_folder, ScriptFile('data.bin', content))
+        with open(os.path.join(tmp_folder, 'data.bin'), 'rb') as f:
+            self.assertEqual(content, f.read())
+        self.assertEqual(5, len([p for p in self.stand_in.pipelines if p[0] == PSRPScriptExecutor.APPEND_FILE_SCRIPT]))
+
+    def test_output_is_streamed(self):
+        written_while_running = []
+
+        def on_poll(power_shell):
+            if power_shell.state == PSInvocationState.RUNNING and power_shell.output:
+                written_while_running.append(self._get_written())
+        self.stand_in.on_poll = on_poll
+        self._execute(ScriptFile('script1.ps1', "Write-Output 'line1'\nWrite-Output 'line2'\nWrite-Output 'line3'"))
+        self.assertIn('line1\n', written_while_running)
+        self.assertIn('line1\nline2\n', written_while_running)
+
+    def test_bundle_runs_from_its_folder(self):
+        script_file = ScriptFile('run.ps1', make_archive({'root/a/run.ps1': "Write-Output 'from bundle'"}))
+        script_file.bundle_format = 'tar'
+        script_file.entry_point = 'a/run.ps1'
+        self._execute(script_file)
+        self.assertEqual('from bundle\n', self._get_written())
+        run_parameters = [parameters for script, parameters in self.stand_in.pipelines
+                          if script == PSRPScriptExecutor.RUN_SCRIPT][0]
+        self.assertEqual('bundle\\a\\run.ps1', run_parameters['Name'])
+        self.assertTrue(run_parameters['SetLocation'])
+
+    def test_exit_code_fails_the_script(self):
+        with self.assertRaises(Exception) as e:
+            self._execute(ScriptFile('script1.ps1', "Write-Output 'line1'\nexit 3"))
+        self.assertEqual(ErrorMsg.RUN_SCRIPT % 'exit code 3', e.exception.message)
+        self.assertEqual([], os.listdir(self.stand_in.temp_folder))
+
+    def test_terminating_error_fails_the_script(self):
+        with self.assertRaises(Exception) as e:
+            self._execute(ScriptFile('script1.ps1', "Write-Error 'warning'\nthrow 'failure'"))
+        self.assertEqual(ErrorMsg.RUN_SCRIPT % 'warning\nfailure', e.exception.message)
+
+    def test_non_terminating_error_is_written(self):
+        self._execute(ScriptFile('script1.ps1', "Write-Error 'some error'\nWrite-Output 'done'"))
+        self.assertEqual('done\nsome error', self._get_written())
+
+    def test_tail_mode(self):
+        self.host.output_tail_kb = 1
+        self._execute(ScriptFile('script1.ps1', "Write-Output 'line1'\nWrite-Output 'line2'"))
+        self.output_writer.write.assert_called_once_with('line1\nline2\n')
+
+    def test_cancelled_while_running(self):
+        pipelines = []
+
+        def on_poll(power_shell):
+            pipelines.append(power_shell)
+            if power_shell.output:
+                self.cancel_sampler.is_cancelled.return_value = True
+        self.stand_in.on_poll = on_poll
+        self.cancel_sampler.throw.side_effect = CancellationException('cancelled')
+        executor = PSRPScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        executor.connect()
+        tmp_folder = executor.create_temp_folder()
+        executor.copy_script(tmp_folder, ScriptFile('script1.ps1', "Write-Output 'line1'\nWrite-Output 'line2'\n"
+                                                                   "Write-Output 'line3'"))
+        with self.assertRaises(CancellationException):
+            executor.run_script(tmp_folder, ScriptFile('script1.ps1', ''), {}, self.output_writer)
+        # the pipeline is stopped before its last record
+        self.assertEqual(PSInvocationState.STOPPED, pipelines[-1].state)
+        self.output_writer.write.assert_called_once_with('line1\nline2\n')
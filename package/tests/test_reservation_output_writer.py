@@ -2,7 +2,7 @@ from unittest import TestCase
 
 from mock import Mock
 
-from cloudshell.cm.customscript.domain.reservation_output_writer import ReservationOutputWriter
+from cloudshell.cm.customscript.domain.reservation_output_writer import ReservationOutputWriter, BatchedOutputWriter
 
 
 class TestReservationOutputWriter(TestCase):
@@ -14,3 +14,42 @@ class TestReservationOutputWriter(TestCase):
         writer = ReservationOutputWriter(session, context)
         writer.write('some msg')
         session.WriteMessageToReservationOutput.assert_called_once_with('1234','some msg')
+
+
+class TestBatchedOutputWriter(TestCase):
+
+    def setUp(self):
+        self.output_writer = Mock()
+        self.writer = BatchedOutputWriter(self.output_writer, flush_interval_seconds=60, max_batch_size=20)
+
+    def _written(self):
+        return [c[0][0] for c in self.output_writer.write.call_args_list]
+
+    def test_lines_are_batched(self):
+        self.writer.write('line1\nli')
+        self.writer.write('ne2\n')
+        self.assertEqual([], self._written())
+        self.writer.close()
+        self.assertEqual(['line1\nline2\n'], self._written())
+
+    def test_flush_on_max_batch_size(self):
+        self.writer.write('line1\nline2\nline3\nline4\npartial')
+        self.assertEqual(['line1\nline2\nline3\nline4\n'], self._written())
+        self.writer.close()
+        self.assertEqual('partial', self._written()[-1])
+
+    def test_long_partial_line_is_flushed(self):
+        self.writer.write('x' * 25)
+        self.assertEqual(['x' * 25], self._written())
+
+    def test_flush_on_interval(self):
+        self.writer.flush_interval_seconds = 0
+        self.writer.write('line1\npartial')
+        self.assertEqual(['line1\n', 'partial'], self._written())
+
+    def test_streams_do_not_mix_partial_lines(self):
+        self.writer.write('out', 'stdout')
+        self.writer.write('err\n', 'stderr')
+        self.writer.write('put\n', 'stdout')
+        self.writer.close()
+        self.assertEqual(['err\noutput\n'], self._written())
@@ -0,0 +1,95 @@
+import os
+import tarfile
+import zipfile
+from unittest import TestCase
+
+from mock import patch
+
+from cloudshell.cm.customscript.domain.script_bundle import ScriptBundle, BundleFormat, get_bundle_format
+from cloudshell.cm.customscript.domain.script_file import ScriptFile
+from tests.helpers import make_archive
+
+
+class TestScriptBundle(TestCase):
+
+    def _bundle(self, files, bundle_format=BundleFormat.TAR):
+        return ScriptBundle(ScriptFile('archive', make_archive(files, bundle_format)), bundle_format)
+
+    def test_get_bundle_format(self):
+        self.assertEqual(BundleFormat.TAR, get_bundle_format(make_archive({'a.sh': 'echo'})))
+        self.assertEqual(BundleFormat.ZIP, get_bundle_format(make_archive({'a.sh': 'echo'}, BundleFormat.ZIP)))
+        self.assertIsNone(get_bundle_format('#!/bin/bash\necho'))
+
+    def test_top_level_folder_is_stripped(self):
+        bundle = self._bundle({'project-master-1a2b/scripts/run.sh': 'echo', 'project-master-1a2b/lib.sh': 'x'})
+        self.assertEqual(['lib.sh', 'scripts/run.sh'], bundle.get_member_paths())
+
+    def test_several_top_level_items_are_kept(self):
+        bundle = self._bundle({'scripts/run.sh': 'echo', 'lib.sh': 'x'}, BundleFormat.ZIP)
+        self.assertEqual(['lib.sh', 'scripts/run.sh'], bundle.get_member_paths())
+
+    def test_find_entry_point(self):
+        bundle = self._bundle({'root/scripts/run.sh': 'echo', 'root/run2.sh': 'x'})
+        self.assertEqual('scripts/run.sh', bundle.find_entry_point('scripts/run.sh'))
+        self.assertEqual('scripts/run.sh', bundle.find_entry_point('run.sh'))
+        self.assertEqual('scripts/run.sh', bundle.find_entry_point('scripts\\run.sh'))
+
+    def test_find_entry_point_fails(self):
+        bundle = self._bundle({'root/a/run.sh': 'echo', 'root/b/run.sh': 'x'})
+        with self.assertRaises(Exception) as e:
+            bundle.find_entry_point('missing.sh')
+        self.assertIn('was not found', e.exception.message)
+        with self.assertRaises(Exception) as e:
+            bundle.find_entry_point('run.sh')
+        self.assertIn('is ambiguous', e.exception.message)
+
+    def test_unsafe_path_is_rejected(self):
+        bundle = self._bundle({'../evil.sh': 'rm', 'run.sh': 'echo'})
+        with self.assertRaises(Exception) as e:
+            bundle.get_member_paths()
+        self.assertIn('unsafe path', e.exception.message)
+
+    def test_repack_zip_to_tar(self):
+        packed = self._bundle({'root/scripts/run.sh': 'echo', 'root/lib.sh': 'x'}, BundleFormat.ZIP).repack(BundleFormat.TAR)
+        self.assertEqual('bundle.tar.gz', packed.name)
+        packed.seek(0)
+        archive = tarfile.open(fileobj=packed, mode='r:gz')
+        self.assertEqual(['lib.sh', 'scripts/run.sh'], sorted(archive.getnames()))
+        self.assertEqual('echo', archive.extractfile('scripts/run.sh').read())
+
+    def test_repack_tar_to_zip(self):
+        packed = self._bundle({'root/scripts/run.ps1': 'echo', 'root/lib.ps1': 'x'}).repack(BundleFormat.ZIP)
+        self.assertEqual('bundle.zip', packed.name)
+        archive = zipfile.ZipFile(packed)
+        self.assertEqual(['lib.ps1', 'scripts/run.ps1'], sorted(archive.namelist()))
+        self.assertEqual('echo', archive.read('scripts/run.ps1'))
+
+    def test_repack_to_zip_copies_members_in_chunks(self):
+        content = os.urandom(10 * 1024)
+        bundle = self._bundle({'root/run.ps1': 'echo', 'root/data.bin': content})
+        open_member = bundle._open_member
+        reads = []
+
+        def read_sizes(member):
+            member_file = open_member(member)
+            read = member_file.read
+            member_file.read = lambda size=-1: reads.append(size) or read(size)
+            return member_file
+
+        with patch.object(ScriptFile, 'COPY_CHUNK_SIZE', 1024), patch.object(bundle, '_open_member', read_sizes):
+            packed = bundle.repack(BundleFormat.ZIP)
+        self.assertTrue(reads)
+        self.assertTrue(all(0 < size <= 1024 for size in reads))
+        self.assertEqual(content, zipfile.ZipFile(packed).read('data.bin'))
+
+    def test_close_closes_the_archive_reader(self):
+        for bundle_format in (BundleFormat.ZIP, BundleFormat.TAR):
+            archive_file = ScriptFile('archive', make_archive({'root/run.sh': 'echo'}, bundle_format))
+            bundle = ScriptBundle(archive_file, bundle_format)
+            bundle.find_entry_point('run.sh')
+            reader = bundle._zip or bundle._tar
+            bundle.close()
+            self.assertTrue(reader.fp is None if bundle_format == BundleFormat.ZIP else reader.closed)
+            self.assertIsNone(bundle._zip or bundle._tar)
+            self.assertEqual('run.sh', bundle.find_entry_point('run.sh'))
+            bundle.close()
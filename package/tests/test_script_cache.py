@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from mock import Mock, patch
+
+from cloudshell.cm.customscript.domain.script_cache import ScriptCache
+from cloudshell.cm.customscript.domain.script_file import ScriptFile
+
+
+class TestScriptCache(TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = ScriptCache(self.cache_dir, max_size=100)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def test_key_depends_on_credentials(self):
+        self.assertEqual(ScriptCache.get_key('url', 'admin', '1234'), ScriptCache.get_key('url', 'admin', '1234'))
+        self.assertNotEqual(ScriptCache.get_key('url', 'admin', '1234'), ScriptCache.get_key('url', 'admin', '4321'))
+        self.assertNotEqual(ScriptCache.get_key('url', None, None), ScriptCache.get_key('url2', None, None))
+
+    def test_miss(self):
+        self.assertIsNone(self.cache.get('key1'))
+        self.assertEqual(1, self.cache.misses)
+
+    def test_put_and_get(self):
+        self.cache.put('key1', ScriptFile('script.sh', 'some script code'), etag='"abc"', last_modified='Mon, 01 Jan 2018')
+        entry = self.cache.get('key1')
+        self.assertEqual('script.sh', entry.file_name)
+        self.assertEqual('some script code', self.cache.read(entry).text)
+        self.assertEqual({'If-None-Match': '"abc"', 'If-Modified-Since': 'Mon, 01 Jan 2018'},
+                         entry.get_conditional_headers())
+        self.assertEqual(1, self.cache.revalidations)
+
+    def test_index_is_persisted(self):
+        self.cache.put('key1', ScriptFile('script.sh', 'some script code'), etag='"abc"')
+        entry = ScriptCache(self.cache_dir).get('key1')
+        self.assertEqual('"abc"', entry.etag)
+
+    def test_same_content_is_stored_once(self):
+        self.cache.put('key1', ScriptFile('script.sh', 'some script code'))
+        self.cache.put('key2', ScriptFile('script.sh', 'some script code'))
+        self.assertIn('16 bytes', self.cache.get_stats_message())
+
+    def test_least_recently_used_is_evicted(self):
+        self.cache.put('key1', ScriptFile('script1.sh', 'a' * 40))
+        self.cache.put('key2', ScriptFile('script2.sh', 'b' * 40))
+        self.cache.mark_hit(self.cache.get('key1'))
+        self.cache.put('key3', ScriptFile('script3.sh', 'c' * 40))
+        self.assertIsNotNone(self.cache.get('key1'))
+        self.assertIsNone(self.cache.get('key2'))
+        self.assertIsNotNone(self.cache.get('key3'))
+
+    def test_unwritable_cache_folder_is_ignored(self):
+        not_a_folder = os.path.join(self.cache_dir, 'file')
+        open(not_a_folder, 'wb').close()
+        cache = ScriptCache(os.path.join(not_a_folder, 'cache'))
+        reporter = Mock()
+        self.assertIsNone(cache.put('key1', ScriptFile('script.sh', 'some script code'), reporter=reporter))
+        self.assertIn('continuing without the script cache', reporter.warn_out.call_args[0][0])
+        self.assertIsNone(cache.get('key1'))
+
+    def test_unreadable_entry_is_dropped(self):
+        entry = self.cache.put('key1', ScriptFile('script.sh', 'some script code'))
+        os.remove(os.path.join(self.cache_dir, ScriptCache.OBJECTS_FOLDER_NAME, entry.content_hash))
+        reporter = Mock()
+        self.assertIsNone(self.cache.read(entry, reporter))
+        reporter.warn_out.assert_called_once()
+        self.assertIsNone(self.cache.get('key1'))
+
+    def test_failed_rename_is_tolerated_when_another_writer_won(self):
+        path = os.path.join(self.cache_dir, 'file')
+
+        def rename(src, dst):
+            open(dst, 'wb').close()  # another process wrote the same file meanwhile
+            raise OSError('rename failed')
+
+        with patch('cloudshell.cm.customscript.domain.script_cache.os.rename', side_effect=rename):
+            self.cache._write_atomic(path, ['some script code'])
+        self.assertEqual(['file'], os.listdir(self.cache_dir))
@@ -117,4 +117,54 @@ class TestScriptConfiguration(TestCase):
         self.assertItemsEqual('K12', conf.host_conf.parameters['K11'])
         self.assertItemsEqual('K22', conf.host_conf.parameters['K21'])
         self.api.DecryptPassword.assert_any_call('G')
-        self.api.DecryptPassword.assert_any_call('H')
\ No newline at end of file
+        self.api.DecryptPassword.assert_any_call('H')
+
+    def test_prefetch_list(self):
+        json = """
+[
+    {"repositoryDetails": {"url": "A", "mirrors": ["A2"]}},
+    {"repositoryDetails": {"url": "B"}, "hostsDetails": [{"ip": "NA", "parameters": [{"name":"REPO_URL","value":"C"}]}]}
+]"""
+        confs = self.parser.json_to_prefetch_objects(json)
+        self.assertEqual(['A', 'C'], [c.script_repo.url for c in confs])
+        self.assertEqual(['A2'], confs[0].script_repo.mirrors)
+
+    def test_prefetch_single_configuration(self):
+        confs = self.parser.json_to_prefetch_objects('{"repositoryDetails": {"url": "A"}}')
+        self.assertEqual(['A'], [c.script_repo.url for c in confs])
+
+    def test_cannot_parse_prefetch_without_repository_url(self):
+        with self.assertRaises(SyntaxError) as context:
+            self.parser.json_to_prefetch_objects('[{"repositoryDetails": {"url": "A"}}, {"repositoryDetails": {}}]')
+        self.assertIn('Missing/Empty "repositoryDetails.url" node.', context.exception.message)
+
+    def test_cannot_parse_empty_prefetch_list(self):
+        with self.assertRaises(SyntaxError):
+            self.parser.json_to_prefetch_objects('[]')
+
+    def test_sftp_request_size_is_parsed(self):
+        json = '{"repositoryDetails": {"url": "A"}, "hostsDetails": [{"ip": "B", "connectionMethod": "ssh", ' \
+               '"sftpRequestSize": "16384"}]}'
+        self.assertEqual(16384, self.parser.json_to_object(json).host_conf.sftp_request_size)
+
+    def test_cannot_parse_invalid_sftp_request_size(self):
+        json = '{"repositoryDetails": {"url": "A"}, "hostsDetails": [{"ip": "B", "connectionMethod": "ssh", ' \
+               '"sftpRequestSize": "32k"}]}'
+        with self.assertRaises(SyntaxError) as context:
+            self.parser.json_to_object(json)
+        self.assertIn('Node "hostsDetails[0].sftpRequestSize" must be a non negative integer.',
+                      context.exception.message)
+
+    def test_output_sizes_are_parsed(self):
+        json = '{"repositoryDetails": {"url": "A"}, "hostsDetails": [{"ip": "B", "connectionMethod": "ssh", ' \
+               '"outputBufferKb": "64", "outputTailKb": 8}]}'
+        host_conf = self.parser.json_to_object(json).host_conf
+        self.assertEqual((64, 8), (host_conf.output_buffer_kb, host_conf.output_tail_kb))
+
+    def test_cannot_parse_invalid_output_sizes(self):
+        for node, value in [('outputBufferKb', '"64kb"'), ('outputTailKb', '-1'), ('uploadParallelism', '"x"')]:
+            json = '{"repositoryDetails": {"url": "A"}, "hostsDetails": [{"ip": "B", "connectionMethod": "ssh", ' \
+                   '"%s": %s}]}' % (node, value)
+            with self.assertRaises(SyntaxError) as context:
+                self.parser.json_to_object(json)
+            self.assertIn('Node "hostsDetails[0].%s" must be a non negative integer.' % node, context.exception.message)
@@ -0,0 +1,267 @@
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+from mock import patch, Mock
+from requests import ConnectionError
+
+from cloudshell.cm.customscript.domain.cancellation_sampler import CancellationException
+from cloudshell.cm.customscript.domain.download_policy import RetryPolicy, MirrorLatencyTracker
+
+from cloudshell.cm.customscript.domain.script_cache import ScriptCache
+from cloudshell.cm.customscript.domain.script_configuration import ScriptConfiguration
+from cloudshell.cm.customscript.domain.script_downloader import ScriptDownloader
+from cloudshell.cm.customscript.domain.script_file import StreamedScriptFile
+from tests.helpers import make_archive
+
+
+class TestScriptDownloader(TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = ScriptCache(self.cache_dir)
+        self.script_conf = ScriptConfiguration()
+        self.script_conf.script_repo.url = 'http://server/repo/script1.sh'
+        self.reporter = Mock()
+        self.cancel_sampler = Mock()
+        self.get_patcher = patch('cloudshell.cm.customscript.domain.script_downloader.requests.get')
+        self.get = self.get_patcher.start()
+
+    def tearDown(self):
+        self.get_patcher.stop()
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def _mock_response(self, status_code, content='', headers=None):
+        response = Mock()
+        response.status_code = status_code
+        response.reason = ''
+        response.url = self.script_conf.script_repo.url
+        response.content = content
+        response.headers = headers or {}
+        response.iter_content = Mock(return_value=[content])
+        self.get.return_value = response
+        return response
+
+    def _download(self):
+        return ScriptDownloader(self.script_conf, self.reporter, self.cancel_sampler, self.cache).download()
+
+    def test_download_without_cache(self):
+        self._mock_response(200, 'some script code')
+        script_file = ScriptDownloader(self.script_conf, self.reporter, self.cancel_sampler).download()
+        self.assertEqual('script1.sh', script_file.name)
+        self.assertEqual('some script code', script_file.text)
+
+    def test_download_is_revalidated_with_etag(self):
+        self._mock_response(200, 'some script code', {'ETag': '"v1"'})
+        self._download()
+        self._mock_response(304)
+        script_file = self._download()
+        self.assertEqual({'Accept-Encoding': 'gzip', 'If-None-Match': '"v1"'}, self.get.call_args[1]['headers'])
+        self.assertEqual('some script code', script_file.text)
+        self.assertEqual(1, self.cache.hits)
+
+    def test_modified_script_replaces_cached_copy(self):
+        self._mock_response(200, 'some script code', {'Last-Modified': 'Mon, 01 Jan 2018'})
+        self._download()
+        self._mock_response(200, 'new script code', {'Last-Modified': 'Tue, 02 Jan 2018'})
+        script_file = self._download()
+        self.assertEqual({'Accept-Encoding': 'gzip', 'If-Modified-Since': 'Mon, 01 Jan 2018'},
+                         self.get.call_args[1]['headers'])
+        self.assertEqual('new script code', script_file.text)
+        self.assertEqual(0, self.cache.hits)
+
+    def test_html_is_rejected(self):
+        response = self._mock_response(200)
+        response.iter_content = Mock(return_value=iter(['\n<!DOCTYPE html><html>', '</html>']))
+        with self.assertRaises(Exception) as e:
+            self._download()
+        self.assertIn('url points to an html file', e.exception.message)
+        response.close.assert_called_once()
+
+    def test_unwritable_cache_does_not_fail_the_download(self):
+        for stream_transfer in [False, True]:
+            self.script_conf.stream_transfer = stream_transfer
+            not_a_folder = os.path.join(self.cache_dir, 'file')
+            open(not_a_folder, 'wb').close()
+            self.cache = ScriptCache(os.path.join(not_a_folder, 'cache'))
+            self._mock_response(200, 'some script code')
+            script_file = self._download()
+            self.assertEqual('some script code', ''.join(script_file.iter_chunks(1024)))
+            script_file.close()
+            self.assertIn('continuing without the script cache', self.reporter.warn_out.call_args[0][0])
+
+    def test_unreadable_cached_copy_is_downloaded_again(self):
+        self._mock_response(200, 'some script code', {'ETag': '"v1"'})
+        self._download()
+        self.cache.read = Mock(return_value=None)
+        not_modified = Mock(status_code=304)
+        self.get.side_effect = [not_modified, self._mock_response(200, 'some script code')]
+        script_file = self._download()
+        self.assertEqual('some script code', script_file.text)
+        self.assertEqual({'Accept-Encoding': 'gzip'}, self.get.call_args[1]['headers'])
+        not_modified.close.assert_called_once()
+
+    def test_gzip_encoded_stream_has_no_expected_size(self):
+        self.script_conf.stream_transfer = True
+        self._mock_response(200, 'some script code', {'Content-Length': '10', 'Content-Encoding': 'gzip'})
+        script_file = self._download()
+        self.assertEqual('some script code', script_file.text)
+        self.assertEqual(16, script_file.expected_size)
+
+    def test_stream_transfer(self):
+        self.script_conf.stream_transfer = True
+        response = self._mock_response(200, headers={'Content-Length': '16', 'ETag': '"v1"'})
+        response.iter_content = Mock(return_value=iter(['some ', 'script ', 'code']))
+        script_file = self._download()
+        self.assertIsInstance(script_file, StreamedScriptFile)
+        self.assertEqual(16, script_file.expected_size)
+        self.assertEqual('some script code', ''.join(script_file.iter_chunks(1024)))
+        script_file._thread.join()
+        self.assertEqual('some script code', self.cache.read(self.cache.get(ScriptCache.get_key(
+            self.script_conf.script_repo.url, None, None))).text)
+        response.close.assert_called_once()
+
+    def _cancel_once_downloading(self, response):
+        def throw_if_canceled():
+            if response.iter_content.called:
+                raise CancellationException('Command was cancelled')
+        self.cancel_sampler.throw_if_canceled.side_effect = throw_if_canceled
+
+    def test_cancelled_stream_closes_the_response(self):
+        self.script_conf.stream_transfer = True
+        response = self._mock_response(200)
+        response.iter_content = Mock(return_value=iter(['some ', 'script ', 'code']))
+        self._cancel_once_downloading(response)
+        script_file = self._download()
+        with self.assertRaises(CancellationException):
+            script_file.wait_complete()
+        response.close.assert_called_once()
+
+    def test_cancelled_download_closes_the_response(self):
+        response = self._mock_response(200)
+        response.iter_content = Mock(return_value=iter(['some ', 'script ', 'code']))
+        self._cancel_once_downloading(response)
+        with self.assertRaises(CancellationException):
+            self._download()
+        response.close.assert_called_once()
+
+    def _mock_mirrors(self, answers):
+        """
+        :param dict answers: url -> (delay seconds, status code or exception)
+        """
+        def get(url, **kwargs):
+            delay, answer = answers[url]
+            time.sleep(delay)
+            if isinstance(answer, Exception):
+                raise answer
+            response = Mock()
+            response.status_code = answer
+            response.reason = ''
+            response.url = url
+            response.headers = {}
+            response.iter_content = Mock(return_value=['code from ' + url])
+            return response
+        self.get.side_effect = get
+
+    def test_mirror_is_used_when_repo_fails(self):
+        self.script_conf.script_repo.mirrors = ['http://mirror/repo/script1.sh']
+        self._mock_mirrors({'http://server/repo/script1.sh': (0, ConnectionError()),
+                            'http://mirror/repo/script1.sh': (0, 200)})
+        script_file = ScriptDownloader(self.script_conf, self.reporter, self.cancel_sampler).download()
+        self.assertEqual('code from http://mirror/repo/script1.sh', script_file.text)
+
+    def test_slow_repo_is_hedged_by_mirror(self):
+        self.script_conf.script_repo.mirrors = ['http://mirror/repo/script1.sh']
+        self._mock_mirrors({'http://server/repo/script1.sh': (1, 200),
+                            'http://mirror/repo/script1.sh': (0, 200)})
+        tracker = MirrorLatencyTracker()
+        with patch.object(ScriptDownloader, 'HEDGE_DELAY_SECONDS', 0.1):
+            script_file = ScriptDownloader(self.script_conf, self.reporter, self.cancel_sampler,
+                                           latency_tracker=tracker).download()
+        self.assertEqual('code from http://mirror/repo/script1.sh', script_file.text)
+        self.assertEqual(['http://mirror/repo/script1.sh', 'http://server/repo/script1.sh'],
+                         tracker.order(['http://server/repo/script1.sh', 'http://mirror/repo/script1.sh']))
+
+    def test_fast_mirror_error_does_not_beat_slow_repo(self):
+        self.script_conf.script_repo.mirrors = ['http://mirror/repo/script1.sh']
+        self._mock_mirrors({'http://server/repo/script1.sh': (0.5, 200),
+                            'http://mirror/repo/script1.sh': (0, 404)})
+        with patch.object(ScriptDownloader, 'HEDGE_DELAY_SECONDS', 0.1):
+            script_file = ScriptDownloader(self.script_conf, self.reporter, self.cancel_sampler).download()
+        self.assertEqual('code from http://server/repo/script1.sh', script_file.text)
+
+    def test_error_status_is_returned_when_every_url_fails(self):
+        self.script_conf.script_repo.mirrors = ['http://mirror/repo/script1.sh']
+        self._mock_mirrors({'http://server/repo/script1.sh': (0, 404),
+                            'http://mirror/repo/script1.sh': (0, 404)})
+        with self.assertRaises(Exception) as e:
+            ScriptDownloader(self.script_conf, self.reporter, self.cancel_sampler).download()
+        self.assertIn('Failed to download script file: 404', e.exception.message)
+        self.assertEqual(2, self.get.call_count)
+
+    def test_retries_with_backoff(self):
+        responses = [ConnectionError(), Mock(status_code=503, reason=''), self._mock_response(200, 'some script code')]
+        self.get.side_effect = responses
+        downloader = ScriptDownloader(self.script_conf, self.reporter, self.cancel_sampler)
+        downloader.retry_policy = RetryPolicy(attempts=3, base_delay=0.01)
+        self.assertEqual('some script code', downloader.download().text)
+        self.assertEqual(3, self.get.call_count)
+
+    def test_retries_give_up(self):
+        self.get.side_effect = ConnectionError()
+        downloader = ScriptDownloader(self.script_conf, self.reporter, self.cancel_sampler)
+        downloader.retry_policy = RetryPolicy(attempts=2, base_delay=0.01)
+        with self.assertRaises(ConnectionError):
+            downloader.download()
+        self.assertEqual(2, self.get.call_count)
+
+    def test_requests_have_timeouts(self):
+        self._mock_response(200, 'some script code')
+        self._download()
+        self.assertEqual((ScriptDownloader.CONNECT_TIMEOUT_SECONDS, ScriptDownloader.READ_TIMEOUT_SECONDS),
+                         self.get.call_args[1]['timeout'])
+
+    def test_bypass_cache(self):
+        self._mock_response(200, 'some script code', {'ETag': '"v1"'})
+        self._download()
+        self.script_conf.script_repo.bypass_cache = True
+        self._download()
+        self.assertEqual({'Accept-Encoding': 'gzip'}, self.get.call_args[1]['headers'])
+
+    def test_bundle_entry_point_is_resolved(self):
+        self.script_conf.script_repo.url = 'http://gitlab/api/v4/projects/4/repository/archive.zip?sha=master&path=app'
+        self.script_conf.script_repo.password = 'token'
+        self.script_conf.script_repo.entry_point = 'install.sh'
+        self.script_conf.stream_transfer = True
+        self._mock_response(200, make_archive({'app-master/app/install.sh': 'echo', 'app-master/app/lib.sh': 'x'}, 'zip'))
+        script_file = self._download()
+        self.assertNotIsInstance(script_file, StreamedScriptFile)
+        self.assertEqual('install.sh', script_file.name)
+        self.assertEqual('zip', script_file.bundle_format)
+        self.assertEqual('app/install.sh', script_file.entry_point)
+        self.assertEqual('token', self.get.call_args[1]['headers']['PRIVATE-TOKEN'])
+
+    def test_cached_bundle_entry_point_is_resolved(self):
+        self.script_conf.script_repo.url = 'http://server/repo/scripts.tar.gz'
+        self.script_conf.script_repo.entry_point = 'scripts/install.sh'
+        self._mock_response(200, make_archive({'scripts/install.sh': 'echo'}), {'ETag': '"v1"'})
+        self._download()
+        self._mock_response(304)
+        script_file = self._download()
+        self.assertEqual('tar', script_file.bundle_format)
+        self.assertEqual('install.sh', script_file.entry_point)
+
+    def test_bundle_must_be_an_archive(self):
+        self.script_conf.script_repo.entry_point = 'install.sh'
+        self._mock_response(200, 'some script code')
+        with self.assertRaises(Exception) as e:
+            self._download()
+        self.assertIn('does not point to a tar or zip archive', e.exception.message)
+
+    def test_gitlab_archive_requires_entry_point(self):
+        self.script_conf.script_repo.url = 'http://gitlab/api/v4/projects/4/repository/archive.zip?sha=master'
+        with self.assertRaises(Exception) as e:
+            self._download()
+        self.assertIn('entryPoint', e.exception.message)
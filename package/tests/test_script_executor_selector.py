@@ -23,4 +23,37 @@ class TestScriptExecutorSelector(TestCase):
             linux_executor = Mock()
             linux_ctor.return_value = linux_executor
             result = ScriptExecutorSelector().get(host_conf, Mock(), Mock())
-            self.assertEqual(result, linux_executor)
\ No newline at end of file
+            self.assertEqual(result, linux_executor)
+
+    def test_create_psrp_script_executor(self):
+        host_conf = HostConfiguration()
+        host_conf.connection_method = 'psrp'
+        with patch('cloudshell.cm.customscript.domain.script_executor_selector.PSRPScriptExecutor') as psrp_ctor:
+            logger = Mock()
+            cancel_sampler = Mock()
+            result = ScriptExecutorSelector().get(host_conf, logger, cancel_sampler)
+            self.assertEqual(result, psrp_ctor.return_value)
+            psrp_ctor.assert_called_once_with(logger, host_conf, cancel_sampler)
+
+    def test_linux_script_executor_gets_pools(self):
+        host_conf = HostConfiguration()
+        host_conf.connection_method = 'ssh'
+        pool = Mock()
+        with patch('cloudshell.cm.customscript.domain.script_executor_selector.LinuxScriptExecutor') as linux_ctor:
+            logger = Mock()
+            cancel_sampler = Mock()
+            worker_pool = Mock()
+            reporter = Mock()
+            ScriptExecutorSelector().get(host_conf, logger, cancel_sampler, pool, worker_pool, reporter)
+            linux_ctor.assert_called_once_with(logger, host_conf, cancel_sampler, pool, worker_pool, reporter)
+
+    def test_windows_script_executor_gets_pools(self):
+        host_conf = HostConfiguration()
+        host_conf.connection_method = 'winrm'
+        with patch('cloudshell.cm.customscript.domain.script_executor_selector.WindowsScriptExecutor') as win_ctor:
+            logger = Mock()
+            cancel_sampler = Mock()
+            worker_pool = Mock()
+            session_pool = Mock()
+            ScriptExecutorSelector().get(host_conf, logger, cancel_sampler, Mock(), worker_pool, Mock(), session_pool)
+            win_ctor.assert_called_once_with(logger, host_conf, cancel_sampler, worker_pool, session_pool)
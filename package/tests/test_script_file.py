@@ -0,0 +1,106 @@
+import hashlib
+import time
+import zlib
+from unittest import TestCase
+
+from mock import Mock
+
+from cloudshell.cm.customscript.domain.cancellation_sampler import CancellationException
+from cloudshell.cm.customscript.domain.script_file import ScriptFile, StreamedScriptFile
+
+
+class TestScriptFile(TestCase):
+
+    def test_size_and_hash(self):
+        script_file = ScriptFile('script1', 'some ')
+        script_file.write('script code')
+        self.assertEqual(16, script_file.size)
+        self.assertEqual(hashlib.sha256('some script code').hexdigest(), script_file.sha256)
+
+    def test_unicode_is_written_as_utf8(self):
+        script_file = ScriptFile('script1', u'\u05e9')
+        self.assertEqual(2, script_file.size)
+        self.assertEqual(u'\u05e9'.encode('utf-8'), script_file.text)
+
+    def test_iter_chunks(self):
+        script_file = ScriptFile('script1', 'a' * 4500)
+        self.assertEqual([2000, 2000, 500], [len(c) for c in script_file.iter_chunks(2000)])
+
+    def test_compress(self):
+        compressed = ScriptFile('script1.sh', 'some script code' * 100).compress()
+        self.assertEqual('script1.sh.gz', compressed.name)
+        self.assertLess(compressed.size, 1600)
+        self.assertEqual('some script code' * 100, zlib.decompress(compressed.text, 16 + zlib.MAX_WBITS))
+
+    def test_large_content_is_spooled_to_disk(self):
+        script_file = ScriptFile('script1')
+        for i in range(0, 3):
+            script_file.write('a' * ScriptFile.SPOOL_MAX_SIZE)
+        self.assertTrue(script_file._stream._rolled)
+        self.assertEqual('aaa', script_file.head(3))
+
+
+class TestStreamedScriptFile(TestCase):
+
+    def _slow_chunks(self, chunks, delay=0.05):
+        for chunk in chunks:
+            time.sleep(delay)
+            yield chunk
+
+    def test_chunks_are_read_while_downloading(self):
+        script_file = StreamedScriptFile('script1', self._slow_chunks(['aa', 'bb', 'cc']), expected_size=6)
+        self.assertEqual(6, script_file.expected_size)
+        self.assertEqual(['aabb', 'cc'], list(script_file.iter_chunks(4)))
+        self.assertEqual('aabbcc', script_file.text)
+
+    def test_read_blocks_until_data_arrives(self):
+        script_file = StreamedScriptFile('script1', self._slow_chunks(['aa', 'bb', 'cc']))
+        script_file.seek(0)
+        self.assertEqual('aabb', script_file.read(4))
+        self.assertEqual('cc', script_file.read(4))
+        self.assertEqual('', script_file.read(4))
+        self.assertEqual(6, script_file.expected_size)
+
+    def test_on_complete(self):
+        on_complete = Mock()
+        script_file = StreamedScriptFile('script1', iter(['aa']), on_complete=on_complete)
+        script_file.wait_complete()
+        script_file._thread.join()
+        on_complete.assert_called_once_with(script_file)
+
+    def test_close_waits_for_on_complete(self):
+        read_by_on_complete = []
+
+        def on_complete(script_file):
+            time.sleep(0.2)
+            read_by_on_complete.append(''.join(script_file.iter_chunks(1)))
+        script_file = StreamedScriptFile('script1', iter(['aa', 'bb']), on_complete=on_complete)
+        script_file.wait_complete()
+        script_file.close()
+        self.assertEqual(['aabb'], read_by_on_complete)
+        self.assertFalse(script_file._thread.is_alive())
+
+    def test_truncated_download_fails_the_reader(self):
+        script_file = StreamedScriptFile('script1', iter(['aa']), expected_size=10)
+        with self.assertRaises(Exception) as e:
+            list(script_file.iter_chunks(4))
+        self.assertIn('after 2 bytes out of 10', e.exception.message)
+
+    def test_cancellation_fails_the_reader(self):
+        cancel_sampler = Mock()
+        cancel_sampler.throw_if_canceled.side_effect = CancellationException('Command was cancelled')
+        script_file = StreamedScriptFile('script1', self._slow_chunks(['aa', 'bb']), cancel_sampler=cancel_sampler)
+        with self.assertRaises(CancellationException):
+            script_file.wait_complete()
+
+    def test_on_close_is_called_when_the_download_ends(self):
+        cancel_sampler = Mock()
+        cancel_sampler.throw_if_canceled.side_effect = [None, CancellationException('Command was cancelled')]
+        for chunks, sampler in [(iter(['aa']), None), (iter(['aa', 'bb', 'cc']), cancel_sampler)]:
+            on_close = Mock()
+            script_file = StreamedScriptFile('script1', chunks, cancel_sampler=sampler, on_close=on_close)
+            try:
+                script_file.wait_complete()
+            except CancellationException:
+                pass
+            on_close.assert_called_once_with()
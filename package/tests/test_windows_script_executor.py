@@ -1,11 +1,23 @@
+import base64
+import re
+import socket
+import time
+from threading import Event, Lock
 from unittest import TestCase
+import xmltodict
 from mock import patch, Mock
+from winrm.exceptions import WinRMOperationTimeoutError
 
+from cloudshell.cm.customscript.domain.cancellation_sampler import CancellationException
+from cloudshell.cm.customscript.domain.connection_pool import ConnectionPool
+from cloudshell.cm.customscript.domain.reservation_output_writer import BatchedOutputWriter
 from cloudshell.cm.customscript.domain.script_configuration import HostConfiguration
-from cloudshell.cm.customscript.domain.script_executor import ErrorMsg
+from cloudshell.cm.customscript.domain.script_executor import ErrorMsg, ExcutorConnectionError
 from cloudshell.cm.customscript.domain.script_file import ScriptFile
 from cloudshell.cm.customscript.domain.windows_script_executor import WindowsScriptExecutor
-from tests.helpers import Any
+from cloudshell.cm.customscript.domain.winrm_uploader import WinRMUploader
+from cloudshell.cm.customscript.domain.worker_pool import WorkerPool
+from tests.helpers import Any, make_archive
 
 
 class TestWindowsScriptExecutor(TestCase):
@@ -15,6 +27,7 @@ class TestWindowsScriptExecutor(TestCase):
         self.session = Mock()
         self.session_ctor = Mock()
         self.cancel_sampler = Mock()
+        self.cancel_sampler.is_cancelled.return_value = False
         self.host = HostConfiguration()
         self.host.username = 'admin'
         self.host.password = '1234'
@@ -23,10 +36,33 @@ class TestWindowsScriptExecutor(TestCase):
         self.session_patcher = patch('cloudshell.cm.customscript.domain.windows_script_executor.winrm.Session')
         self.session_ctor = self.session_patcher.start()
         self.session_ctor.return_value = self.session
-
+        self.session.protocol._get_soap_header = Mock(side_effect=lambda **kwargs: {'env:Header': {}})
+        self.send_message = Mock(side_effect=self._answer_ws_man)
+        self.session.protocol.send_message = self.send_message
+        self.max_envelope_size_kb = '150'
+        self.max_shells_per_user = '30'
+        # by default a command's output comes in a single Receive response, the one the test sets in get_command_output
+        self.session.protocol._raw_get_command_output = Mock(
+            side_effect=lambda shell_id, command_id: self.session.protocol.get_command_output(shell_id, command_id) + (True,))
 
     def tearDown(self):
         self.session_patcher.stop()
+        WinRMUploader._host_configs.clear()
+
+    def _answer_ws_man(self, message):
+        if 'rsp:Send' in message:
+            return '<Envelope/>'
+        return '<Envelope><Body><Config><MaxEnvelopeSizekb>%s</MaxEnvelopeSizekb><Winrs><MaxShellsPerUser>%s' \
+               '</MaxShellsPerUser></Winrs></Config></Body></Envelope>' % (self.max_envelope_size_kb,
+                                                                         self.max_shells_per_user)
+
+    def _get_sent_chunks(self):
+        streams = [xmltodict.parse(c[0][0])['env:Envelope']['env:Body']['rsp:Send']['rsp:Stream']
+                   for c in self.send_message.call_args_list if 'rsp:Send' in c[0][0]]
+        return [base64.b64decode(stream.get('#text') or '') for stream in streams]
+
+    def _get_ps_code(self, run_command_call):
+        return base64.b64decode(run_command_call[0][1].split(' ')[-1]).decode('utf_16_le')
 
     def test_http(self):
         WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
@@ -37,6 +73,86 @@ class TestWindowsScriptExecutor(TestCase):
         WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
         self.session_ctor.assert_called_with('1.2.3.4', auth=('admin','1234'), transport='ssl')
 
+    def test_connection_address(self):
+        self.assertEqual(('1.2.3.4', 5985), WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler).get_connection_address())
+        self.host.connection_secured = True
+        self.assertEqual(('1.2.3.4', 5986), WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler).get_connection_address())
+
+    # Session pool
+
+    def test_pooled_session_is_acquired_on_connect_and_released_on_close(self):
+        pool = ConnectionPool(is_alive=lambda session: True, close_connection=WindowsScriptExecutor.close_session)
+        self.session.run_cmd.side_effect = lambda code: Mock(std_out=code.split(' ')[-1])
+        for i in range(2):
+            executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler, connection_pool=pool)
+            executor.connect()
+            self.assertIs(self.session, executor.session)
+            executor.close()
+        self.session_ctor.assert_called_once_with('1.2.3.4', auth=('admin', '1234'))
+        self.assertEqual((1, 1), (pool.created, pool.reused))
+        self.assertEqual(1, pool.get_idle_count())
+
+    def test_failing_pooled_session_is_not_released(self):
+        pool = ConnectionPool(is_alive=lambda session: True, close_connection=WindowsScriptExecutor.close_session)
+        self.session.run_cmd.side_effect = Exception('connection reset')
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler, connection_pool=pool)
+        with self.assertRaises(ExcutorConnectionError):
+            executor.connect()
+        executor.close()
+        self.session.protocol.transport.session.close.assert_called_once()
+        self.assertEqual(0, pool.get_idle_count())
+
+    def test_pooled_session_is_closed_while_a_cancelled_command_is_received(self):
+        pool = ConnectionPool(is_alive=lambda session: True, close_connection=WindowsScriptExecutor.close_session)
+        self.session.run_cmd.side_effect = lambda code: Mock(std_out=code.split(' ')[-1])
+        receiving = Event()
+        release = Event()
+
+        def receive(shell_id, command_id):
+            receiving.set()
+            release.wait(5)
+            return '', '', 1, True
+
+        self.session.protocol._raw_get_command_output = Mock(side_effect=receive)
+        self.cancel_sampler.is_cancelled.side_effect = lambda: receiving.is_set()
+        self.cancel_sampler.throw.side_effect = CancellationException()
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler, connection_pool=pool)
+        executor.connect()
+        try:
+            with self.assertRaises(CancellationException):
+                executor.run_script('tmp123', ScriptFile('script1', 'some script code'), {}, Mock())
+            executor.close()
+        finally:
+            release.set()
+        self.session.protocol.transport.session.close.assert_called_once()
+        self.assertEqual(0, pool.get_idle_count())
+
+    def test_pool_key(self):
+        key = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler).get_pool_key()
+        self.assertEqual(('1.2.3.4', 5985, 'plaintext', 'admin'), key[:4])
+        self.assertNotIn('1234', key)
+        self.host.connection_secured = True
+        self.assertEqual(('1.2.3.4', 5986, 'ssl', 'admin'),
+                         WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler).get_pool_key()[:4])
+
+    def test_session_is_alive_while_a_keep_alive_connection_is_open(self):
+        local, remote = socket.socketpair()
+        try:
+            host_pool = Mock()
+            host_pool.pool.queue = [None, Mock(sock=local)]
+            adapter = Mock()
+            adapter.poolmanager.pools = {('http', '1.2.3.4', 5985): host_pool}
+            session = Mock()
+            session.protocol.transport.session.adapters.values.return_value = [adapter]
+            self.assertTrue(WindowsScriptExecutor.is_session_alive(session))
+            remote.close()
+            self.assertFalse(WindowsScriptExecutor.is_session_alive(session))
+            session.protocol.transport.session = None
+            self.assertFalse(WindowsScriptExecutor.is_session_alive(session))
+        finally:
+            local.close()
+            remote.close()
+
     # Create temp folder
 
     def test_create_temp_folder_success(self):
@@ -59,11 +175,174 @@ class TestWindowsScriptExecutor(TestCase):
         self.session.protocol.get_command_output = Mock(return_value=('','',0))
         executor.copy_script('tmp123', ScriptFile('script1','some script code'))
 
-    def test_copy_long_script_in_bulks(self):
+    def test_copy_script_through_stdin_in_envelope_sized_chunks(self):
+        self.max_envelope_size_kb = '8'
         executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
         self.session.protocol.get_command_output = Mock(return_value=('','',0))
-        executor.copy_script('tmp123', ScriptFile('script1',''.join(['a' for i in range(0,4500)]))) # 3 bulks: 2000,2000,500
+        executor.copy_script('tmp123', ScriptFile('script1',''.join(['a' for i in range(0,4500)])))
+        # (8KB - 4KB envelope overhead) * 3/4 base64 = 3072 bytes per chunk, and an empty chunk which ends the stdin
+        self.assertEqual(['a' * 3072, 'a' * 1428, ''], self._get_sent_chunks())
+        self.session.protocol.open_shell.assert_called_once()
+        self.session.protocol.run_command.assert_called_once_with(Any(), Any(), console_mode_stdin=False)
+        self.assertIn('OpenStandardInput', self._get_ps_code(self.session.protocol.run_command.call_args))
+        self.assertEqual(1, self.session.protocol.get_command_output.call_count)
+        self.session.protocol.close_shell.assert_called_once()
+
+    def test_max_envelope_size_is_queried_once_per_host(self):
+        self.session.protocol.get_command_output = Mock(return_value=('','',0))
+        for i in range(2):
+            WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler).copy_script('tmp123', ScriptFile('script1', 'a'))
+        config_queries = [c for c in self.send_message.call_args_list if 'rsp:Send' not in c[0][0]]
+        self.assertEqual(1, len(config_queries))
+
+    def test_default_max_envelope_size_when_config_is_denied(self):
+        self.send_message.side_effect = lambda message: '<Envelope/>'
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        self.assertEqual((150 * 1024 - 4096) * 3 // 4, executor.uploader.get_chunk_size())
+
+    def test_copy_compressed_script(self):
+        self.host.compress_transfer = True
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        self.session.protocol.get_command_output = Mock(return_value=('','',0))
+        executor.copy_script('tmp123', ScriptFile('script1',''.join(['a' for i in range(0,4500)])))
+        # availability check, one compressed bulk, decompression
         self.assertEqual(3, self.session.protocol.get_command_output.call_count)
+        self.assertIn('GZipStream', self._get_ps_code(self.session.protocol.run_command.call_args_list[-1]))
+
+    def test_copy_compressed_script_falls_back_without_gzip_stream(self):
+        self.host.compress_transfer = True
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        self.session.protocol.get_command_output = Mock(side_effect=[('','',1)] + [('','',0)] * 3)
+        executor.copy_script('tmp123', ScriptFile('script1',''.join(['a' for i in range(0,4500)])))
+        # availability check, uncompressed upload
+        self.assertEqual(2, self.session.protocol.get_command_output.call_count)
+
+    def test_copy_bundle(self):
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        self.session.protocol.get_command_output = Mock(return_value=('','',0))
+        script_file = ScriptFile('run.ps1', make_archive({'root/a/run.ps1': 'echo', 'root/lib.ps1': 'x'}))
+        script_file.bundle_format = 'tar'
+        script_file.entry_point = 'a/run.ps1'
+        executor.copy_script('tmp123', script_file)
+        self.assertIn('bundle.zip', self._get_ps_code(self.session.protocol.run_command.call_args_list[0]))
+        self.assertIn('ExtractToDirectory', self._get_ps_code(self.session.protocol.run_command.call_args_list[-1]))
+
+    def _get_uploaded_parts(self):
+        # part file name -> content, from the chunks sent to the stdin of the receiving command of each part
+        parts = {}
+        for c in self.send_message.call_args_list:
+            if 'rsp:Send' in c[0][0]:
+                stream = xmltodict.parse(c[0][0])['env:Envelope']['env:Body']['rsp:Send']['rsp:Stream']
+                name = self.part_names[stream['@CommandId']]
+                parts[name] = parts.get(name, '') + base64.b64decode(stream.get('#text') or '')
+        return parts
+
+    def _run_commands_with_ids(self):
+        self.part_names = {}
+        lock = Lock()
+
+        def run_command(shell_id, command, **kwargs):
+            with lock:
+                command_id = 'command%d' % len(self.part_names)
+                match = re.search(r'"(\w+\.part\d+)"', self._get_ps_code(((shell_id, command),)))
+                self.part_names[command_id] = match.group(1) if match else None
+            return command_id
+        self.session.protocol.run_command = Mock(side_effect=run_command)
+
+    @patch('cloudshell.cm.customscript.domain.windows_script_executor.WindowsScriptExecutor.MIN_UPLOAD_PART_SIZE', 1000)
+    def test_copy_script_in_parts_over_concurrent_shells(self):
+        self.max_envelope_size_kb = '8'
+        self.host.upload_parallelism = 3
+        self._run_commands_with_ids()
+        self.session.protocol.open_shell = Mock(side_effect=['shell1', 'shell2'])
+        # created up front, the concurrent parts would race to create the child mock (and lose a call)
+        self.session.protocol.close_shell = Mock()
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        executor._shell_id = 'shell0'  # as in 'execute'
+        self.session.protocol.get_command_output = Mock(return_value=('','',0))
+        content = ''.join(chr(ord('a') + i % 26) for i in range(4500))
+        script_file = ScriptFile('script1', content)
+        executor.copy_script('tmp123', script_file)
+        parts = self._get_uploaded_parts()
+        self.assertEqual({'script1.part0': content[:1500], 'script1.part1': content[1500:3000],
+                          'script1.part2': content[3000:]}, parts)
+        # a shell of its own for each part but the first, which is uploaded over the shell of the execution
+        self.assertEqual(2, self.session.protocol.open_shell.call_count)
+        self.assertEqual(['shell1', 'shell2'], sorted(c[0][0] for c in self.session.protocol.close_shell.call_args_list))
+        self.assertEqual(['shell0', 'shell0', 'shell1', 'shell2'],
+                         sorted(c[0][0] for c in self.session.protocol.run_command.call_args_list))
+        merge_code = self._get_ps_code(self.session.protocol.run_command.call_args_list[-1])
+        self.assertIn('-lt 3', merge_code)
+        self.assertIn(script_file.sha256.upper(), merge_code)
+
+    @patch('cloudshell.cm.customscript.domain.windows_script_executor.WindowsScriptExecutor.MIN_UPLOAD_PART_SIZE', 1000)
+    def test_upload_parts_are_capped_by_max_shells_per_user(self):
+        self.host.upload_parallelism = 8
+        self.max_shells_per_user = '2'
+        self._run_commands_with_ids()
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        self.session.protocol.get_command_output = Mock(return_value=('','',0))
+        executor.copy_script('tmp123', ScriptFile('script1', 'a' * 4500))
+        self.assertEqual(['script1.part0', 'script1.part1'], sorted(self._get_uploaded_parts().keys()))
+
+    def test_small_files_are_uploaded_in_one_part(self):
+        self.host.upload_parallelism = 8
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        self.session.protocol.get_command_output = Mock(return_value=('','',0))
+        executor.copy_script('tmp123', ScriptFile('script1', 'a' * 4500))
+        self.session.protocol.run_command.assert_called_once()
+        self.assertNotIn('.part', self._get_ps_code(self.session.protocol.run_command.call_args))
+
+    @patch('cloudshell.cm.customscript.domain.windows_script_executor.WindowsScriptExecutor.MIN_UPLOAD_PART_SIZE', 1000)
+    def test_copy_script_in_parts_fail(self):
+        self.host.upload_parallelism = 2
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        self.session.protocol.get_command_output = Mock(side_effect=[('','',0), ('','some error',1)])
+        with self.assertRaises(Exception) as e:
+            executor.copy_script('tmp123', ScriptFile('script1', 'a' * 4500))
+        self.assertEqual(ErrorMsg.COPY_SCRIPT % 'some error', e.exception.message)
+
+    @patch('cloudshell.cm.customscript.domain.windows_script_executor.WindowsScriptExecutor.MIN_UPLOAD_PART_SIZE', 1000)
+    def test_first_failing_part_stops_the_others(self):
+        self.host.upload_parallelism = 2
+        self.max_envelope_size_kb = '8'
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        self.session.protocol.get_command_output = Mock(return_value=('', '', 0))
+
+        def run_command(shell_id, command, **kwargs):
+            if 'script1.part1' in self._get_ps_code(((shell_id, command),)):
+                raise Exception('part failed')
+            return 'command1'
+        self.session.protocol.run_command = Mock(side_effect=run_command)
+        self.send_message.side_effect = lambda message: time.sleep(0.05) or self._answer_ws_man(message)
+        with self.assertRaises(Exception) as e:
+            executor.copy_script('tmp123', ScriptFile('script1', 'a' * 40000))
+        self.assertEqual('part failed', e.exception.message)
+        # part0 has 7 chunks and the end of its stdin to send, it stopped before
+        self.assertLess(len(self._get_sent_chunks()), 8)
+
+    @patch('cloudshell.cm.customscript.domain.windows_script_executor.WindowsScriptExecutor.MIN_UPLOAD_PART_SIZE', 1000)
+    def test_copy_script_in_parts_is_cancelled(self):
+        self.host.upload_parallelism = 2
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        sending = Event()
+        release = Event()
+
+        def send_message(message):
+            if 'rsp:Send' in message:
+                sending.set()
+                release.wait(5)
+            return self._answer_ws_man(message)
+        self.send_message.side_effect = send_message
+        self.cancel_sampler.is_cancelled.side_effect = lambda: sending.is_set()
+        self.cancel_sampler.throw.side_effect = CancellationException()
+        start_time = time.time()
+        try:
+            with self.assertRaises(CancellationException):
+                executor.copy_script('tmp123', ScriptFile('script1', 'a' * 4500))
+            self.assertLess(time.time() - start_time, 2)
+        finally:
+            release.set()
 
     def test_copy_script_fail(self):
         executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
@@ -88,6 +367,93 @@ class TestWindowsScriptExecutor(TestCase):
         output_writer.write.assert_any_call('some output')
         output_writer.write.assert_any_call('some error')
 
+    def test_run_script_with_env_file(self):
+        self.host.env_file = True
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        self.session.protocol.get_command_output = Mock(return_value=('', '', 0))
+        executor.run_script('tmp123', ScriptFile('script1', 'some script code'), {'var1': "it's"}, Mock())
+        upload_code = self._get_ps_code(self.session.protocol.run_command.call_args_list[0])
+        self.assertIn('customscript_env.ps1', upload_code)
+        self.assertEqual("\xef\xbb\xbf$env:var1 = 'it''s'\r\n", ''.join(self._get_sent_chunks()))
+        run_code = self._get_ps_code(self.session.protocol.run_command.call_args_list[1])
+        self.assertIn('. (Join-Path "tmp123" "customscript_env.ps1")', run_code)
+        self.assertNotIn('var1', run_code)
+
+    def test_run_script_output_is_streamed(self):
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        output_writer = Mock()
+        written_before_done = []
+        responses = [('line1\n', '', -1, False), WinRMOperationTimeoutError(), ('line2\n', '', -1, False),
+                     ('', '', 0, True)]
+
+        def receive(shell_id, command_id):
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            if response[3]:
+                written_before_done.extend(c[0][0] for c in output_writer.write.call_args_list)
+            return response
+
+        self.session.protocol._raw_get_command_output = Mock(side_effect=receive)
+        with patch('cloudshell.cm.customscript.domain.windows_script_executor.BatchedOutputWriter',
+                   side_effect=lambda writer: BatchedOutputWriter(writer, flush_interval_seconds=0)):
+            executor.run_script('tmp123', ScriptFile('script1', 'some script code'), {}, output_writer)
+        self.assertEqual('line1\nline2\n', ''.join(written_before_done))
+        self.assertEqual(4, self.session.protocol._raw_get_command_output.call_count)
+
+    def test_run_script_is_cancelled_while_receiving(self):
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        receiving = Event()
+        terminated = Event()
+
+        def receive(shell_id, command_id):
+            receiving.set()
+            terminated.wait(5)
+            return '', '', 1, True
+
+        self.session.protocol._raw_get_command_output = Mock(side_effect=receive)
+        self.session.protocol.cleanup_command.side_effect = lambda shell_id, command_id: terminated.set()
+        self.cancel_sampler.is_cancelled.side_effect = lambda: receiving.is_set()
+        self.cancel_sampler.throw.side_effect = CancellationException()
+        with self.assertRaises(CancellationException):
+            executor.run_script('tmp123', ScriptFile('script1', 'some script code'), {}, Mock())
+        self.session.protocol.cleanup_command.assert_called_once()
+
+    def test_receive_loop_stops_after_a_cancelled_command(self):
+        pool = WorkerPool(name='test-receive')
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler, worker_pool=pool)
+        receiving = Event()
+
+        def receive(shell_id, command_id):
+            # the host keeps the command alive, and the terminate signal fails
+            receiving.set()
+            time.sleep(0.05)
+            raise WinRMOperationTimeoutError()
+
+        self.session.protocol._raw_get_command_output = Mock(side_effect=receive)
+        self.session.protocol.cleanup_command.side_effect = Exception('terminate failed')
+        self.cancel_sampler.is_cancelled.side_effect = lambda: receiving.is_set()
+        self.cancel_sampler.throw.side_effect = CancellationException()
+        try:
+            with self.assertRaises(Exception):
+                executor.run_script('tmp123', ScriptFile('script1', 'some script code'), {}, Mock())
+            for i in range(50):
+                if pool.get_stats()['completed']:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(0, pool.get_stats()['busy'])
+        finally:
+            pool.shutdown(timeout=5)
+
+    def test_run_script_tail_mode(self):
+        self.host.output_tail_kb = 1
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        output_writer = Mock()
+        self.session.protocol.get_command_output = Mock(return_value=('x' * 1024 + 'y' * 1024, '', 0))
+        executor.run_script('tmp123', ScriptFile('script1', 'some script code'), {}, output_writer)
+        output_writer.write.assert_any_call('[... 1024 bytes of stdout truncated ...]\n' + 'y' * 1024)
+        self.assertEqual(1, output_writer.write.call_count)
+
     def test_run_script_fail(self):
         executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
         output_writer = Mock()
@@ -114,6 +480,46 @@ class TestWindowsScriptExecutor(TestCase):
         output_writer.write.assert_any_call('some output')
         output_writer.write.assert_any_call('some error1\r\nsome error2')
 
+    def test_run_script_stderr_is_decoded_as_it_arrives(self):
+        self.host.output_buffer_kb = 1
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        progress = '<Obj S="progress" RefId="0"><MS><S N="StatusDescription">%s</S></MS></Obj>' % ('x' * 500)
+        # the raw stderr outgrows the 1KB capture buffer, the decoder sees all of it
+        responses = [('', '#< CLIXML\r\n<Objs Version="1.1.0.1" xmlns="http://schemas.microsoft.com/powershell/2004/04">',
+                      -1, False)] + [('', progress, -1, False)] * 4 + \
+                    [('', '<S S="Error">the error_x000D__x000A_</S></Objs>', 1, True)]
+        self.session.protocol._raw_get_command_output = Mock(side_effect=responses)
+        with self.assertRaises(Exception) as e:
+            executor.run_script('tmp123', ScriptFile('script1', 'some script code'), {}, Mock())
+        self.assertEqual(ErrorMsg.RUN_SCRIPT % 'the error\r\n', e.exception.message)
+
+    # Execute
+
+    def test_execute_runs_all_commands_in_one_shell(self):
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        self.session.protocol.get_command_output = Mock(return_value=('tmp123', '', 0))
+        executor.execute(ScriptFile('script1.ps1', 'some script code'), {}, Mock())
+        # create temp folder, upload, run, delete temp folder
+        self.assertEqual(4, self.session.protocol.run_command.call_count)
+        self.session.protocol.open_shell.assert_called_once()
+        self.session.protocol.close_shell.assert_called_once_with(self.session.protocol.open_shell.return_value)
+        self.logger.info.assert_any_call('WS-Man round trips: 3')  # MaxEnvelopeSizekb query, upload chunk, end of stdin
+
+    def test_execute_closes_the_shell_on_failure(self):
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        self.session.protocol.get_command_output = Mock(side_effect=[('tmp123', '', 0), ('', 'some error', 1), ('', '', 0)])
+        with self.assertRaises(Exception):
+            executor.execute(ScriptFile('script1.ps1', 'some script code'), {}, Mock())
+        self.session.protocol.open_shell.assert_called_once()
+        self.session.protocol.close_shell.assert_called_once()
+
+    def test_round_trips_are_counted_once_per_protocol(self):
+        first = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        second = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        self.assertIs(first.round_trip_counter, second.round_trip_counter)
+        self.session.protocol.send_message('<a/>')
+        self.assertEqual(1, first.round_trip_counter.count)
+
     # Delete temp folder
 
     def test_delete_temp_folder_success(self):
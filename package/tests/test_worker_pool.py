@@ -0,0 +1,175 @@
+import threading
+import time
+from threading import Event
+from unittest import TestCase
+
+from mock import Mock, patch
+
+from cloudshell.cm.customscript.customscript_shell import CustomScriptShell
+from cloudshell.cm.customscript.domain.linux_script_executor import LinuxScriptExecutor
+from cloudshell.cm.customscript.domain.script_configuration import HostConfiguration
+from cloudshell.cm.customscript.domain.script_file import ScriptFile
+from cloudshell.cm.customscript.domain.worker_pool import WorkerPool, WorkerPoolFullError
+
+
+class TestWorkerPool(TestCase):
+
+    def setUp(self):
+        self.pool = WorkerPool(max_workers=2, name='test-worker')
+
+    def tearDown(self):
+        self.pool.shutdown(timeout=5)
+
+    def test_result(self):
+        future = self.pool.apply_async(lambda a, b: a + b, args=(1,), kwds={'b': 2})
+        self.assertEqual(3, future.get(5))
+        self.assertTrue(future.ready())
+
+    def test_error(self):
+        def fail():
+            raise ValueError('some error')
+        future = self.pool.apply_async(fail)
+        with self.assertRaises(ValueError) as e:
+            future.get(5)
+        self.assertEqual('some error', e.exception.message)
+
+    def test_workers_are_bounded_and_named(self):
+        release = Event()
+        futures = [self.pool.apply_async(release.wait, args=(5,)) for i in range(4)]
+        self.assertEqual(2, self.pool.get_stats()['workers'])
+        self.assertEqual(['test-worker-1', 'test-worker-2'],
+                         sorted(t.name for t in threading.enumerate() if t.name.startswith('test-worker')))
+        release.set()
+        for future in futures:
+            future.get(5)
+        self.assertEqual(4, self.pool.get_stats()['completed'])
+
+    def test_no_cap_by_default(self):
+        pool = WorkerPool(name='test-unbounded')
+        try:
+            release = Event()
+            started = [Event() for i in range(20)]
+            futures = [pool.apply_async(lambda e: (e.set(), release.wait(5)), args=(started[i],)) for i in range(20)]
+            for e in started:
+                self.assertTrue(e.wait(5))
+            self.assertEqual(20, pool.get_stats()['workers'])
+            release.set()
+            for future in futures:
+                future.get(5)
+        finally:
+            pool.shutdown(timeout=5)
+
+    def test_idle_workers_stop(self):
+        pool = WorkerPool(name='test-idle', idle_timeout_seconds=0.1)
+        try:
+            pool.apply_async(lambda: None).get(5)
+            time.sleep(0.5)
+            self.assertEqual(0, pool.get_stats()['workers'])
+            self.assertEqual([], [t for t in threading.enumerate() if t.name.startswith('test-idle')])
+            self.assertEqual(3, pool.apply_async(lambda: 3).get(5))
+        finally:
+            pool.shutdown(timeout=5)
+
+    def test_queue_depth(self):
+        release = Event()
+        started = [Event(), Event()]
+        for i in range(2):
+            self.pool.apply_async(lambda e: (e.set(), release.wait(5)), args=(started[i],))
+        for e in started:
+            e.wait(5)
+        futures = [self.pool.apply_async(lambda: None) for i in range(3)]
+        self.assertEqual(3, self.pool.get_stats()['queued'])
+        self.assertEqual(3, self.pool.max_queue_depth)
+        release.set()
+        for future in futures:
+            future.get(5)
+        self.assertIn('0 queued (max 3)', self.pool.get_stats_message())
+
+    def test_unqueued_task_fails_fast_when_all_workers_are_busy(self):
+        release = Event()
+        futures = [self.pool.apply_async(release.wait, args=(5,), queue=False) for i in range(2)]
+        with self.assertRaises(WorkerPoolFullError):
+            self.pool.apply_async(lambda: None, queue=False)
+        futures.append(self.pool.apply_async(lambda: 3))
+        release.set()
+        self.assertEqual(3, futures[-1].get(5))
+        self.assertEqual(1, self.pool.get_stats()['rejected'])
+        self.assertEqual(3, self.pool.get_stats()['submitted'])
+
+    def test_shutdown(self):
+        self.pool.apply_async(lambda: None).get(5)
+        self.pool.shutdown(timeout=5)
+        self.assertEqual([], [t for t in threading.enumerate() if t.name.startswith('test-worker')])
+        with self.assertRaises(Exception):
+            self.pool.apply_async(lambda: None)
+
+    def test_shared_pool_is_renewed_after_shutdown(self):
+        shared = WorkerPool.shared()
+        self.assertIs(shared, WorkerPool.shared())
+        shared.shutdown()
+        self.assertIsNot(shared, WorkerPool.shared())
+
+    def _mock_ssh(self, command_seconds=0):
+        session = Mock()
+
+        def exec_command(code):
+            stdout = Mock()
+            stdout.channel.recv_exit_status.return_value = 0
+            stdout.channel.recv.side_effect = lambda size: time.sleep(command_seconds) or ''
+            stdout.channel.recv_stderr.return_value = ''
+            if code == 'mktemp -d':
+                stdout.channel.recv.side_effect = ['tmp123\n', '']
+            return Mock(), stdout, Mock()
+        session.exec_command.side_effect = exec_command
+        return patch('cloudshell.cm.customscript.domain.linux_script_executor.SSHClient', return_value=session)
+
+    def _execute(self, pool):
+        cancel_sampler = Mock()
+        cancel_sampler.is_cancelled.return_value = False
+        executor = LinuxScriptExecutor(Mock(), HostConfiguration(), cancel_sampler, worker_pool=pool)
+        with patch('cloudshell.cm.customscript.domain.linux_script_executor.Write'):
+            executor.execute(ScriptFile('script1.sh', 'some script code'), None, Mock())
+
+    def _soak(self, pool):
+        with self._mock_ssh():
+            self._execute(pool)
+            threads = set(threading.enumerate())
+            for i in range(1000):
+                self._execute(pool)
+            self.assertEqual([], [t.name for t in threading.enumerate() if t not in threads])
+
+    def test_thread_count_stays_flat_under_soak(self):
+        self._soak(self.pool)
+        self.assertLessEqual(self.pool.get_stats()['workers'], 2)
+
+    def test_shell_pool_under_soak(self):
+        shell = CustomScriptShell()
+        try:
+            self._soak(shell.worker_pool)
+            self.assertEqual(CustomScriptShell.MAX_WORKERS, shell.worker_pool.max_workers)
+        finally:
+            shell.cleanup()
+
+    def test_shell_pool_is_bounded_under_a_burst(self):
+        shell = CustomScriptShell()
+        errors = []
+
+        def execute():
+            try:
+                self._execute(shell.worker_pool)
+            except WorkerPoolFullError as e:
+                errors.append(e)
+
+        try:
+            with self._mock_ssh(command_seconds=0.2):
+                executions = [threading.Thread(target=execute) for i in range(CustomScriptShell.MAX_WORKERS * 2)]
+                for execution in executions:
+                    execution.start()
+                for execution in executions:
+                    execution.join(30)
+            stats = shell.worker_pool.get_stats()
+            self.assertLessEqual(stats['workers'], CustomScriptShell.MAX_WORKERS)
+            self.assertGreater(stats['rejected'], 0)
+            self.assertGreater(len(errors), 0)
+        finally:
+            shell.cleanup()